@@ -0,0 +1,1002 @@
+"""
+amira_emulator.py
+
+This module is a software Amira for running the test scripts without an instrument, a reference thermometer or an
+operator.  AmiraEmulator implements the commands the scripts use, answers them with the JSON responses of the
+firmware and emits the matching events after configurable latencies.  The heater is a simulated first-order thermal
+plant under PI control that also drives a fake reference thermometer, and the operator prompts are answered from a
+script.  EmulatedTestRunner executes a test_step_list in-process against the emulator with the step semantics of the
+test tool, so the host-side cost of a sequence can be measured and regressed without hardware.
+
+With a VirtualClock the runner doesn't wait for anything - delays, timeouts and the latencies of the emulator advance
+the clock instantly, and the heater script's timers follow the same clock, so a full sequence completes in well under
+a second of wall-clock time.
+
+Run a script against the emulator with:
+    python amira_emulator.py smoke_test_windowsV5.py [--answers C0FFEE123456 '' y y y] [--virtual-time]
+    python amira_emulator.py shortheatercalFruit4_windows.py [--virtual-time]
+
+@copyright LumiraDx, 2021. All rights reserved. This code is provided on an
+           "AS IS" basis. LumiraDx DISCLAIMS ALL WARRANTIES, TERMS AND
+           CONDITIONS WITH RESPECT TO THE CODE, EXPRESS, IMPLIED, STATUTORY
+           OR OTHERWISE, INCLUDING WARRANTIES, TERMS OR CONDITIONS OF
+           MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NONINFRINGEMENT
+           AND SATISFACTORY QUALITY. TO THE FULL EXTENT ALLOWED BY LAW,
+           LUMIRADX ALSO EXCLUDES ANY LIABILITY, WHETHER BASED IN CONTRACT
+           OR TORT (INCLUDING NEGLIGENCE), FOR INCIDENTAL, CONSEQUENTIAL,
+           INDIRECT, SPECIAL OR PUNITIVE DAMAGES OF ANY KIND, OR FOR LOSS
+           OF REVENUE OR PROFITS, LOSS OF BUSINESS, LOSS OF INFORMATION OR
+           DATA, OR OTHER FINANCIAL LOSS ARISING OUT OF OR IN CONNECTION
+           WITH THE USE OR PERFORMANCE OF THE CODE.
+"""
+
+import argparse
+import asyncio
+import builtins
+import collections
+import heapq
+import importlib.util
+import itertools
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Union
+
+from amira_parser import AmiraErrorCodes, AmiraEventCodes
+from amira_test_state_machine import AmiraTestEventParserReturnValues, AmiraTestOperations
+from twisted.python import log
+
+import ble_scan_service
+
+
+# wireless ID and firmware version reported by the emulated instrument
+EMULATOR_WIRELESS_ID = 'C0FFEE123456'
+EMULATOR_VERSION = '0.16.1_d'
+
+# seconds between a command and its response unless the command is listed in EMULATOR_RESPONSE_LATENCIES_S
+EMULATOR_COMMAND_LATENCY_S = 0.005
+
+# seconds between a command and its response for the commands that take longer (longest command prefix wins)
+EMULATOR_RESPONSE_LATENCIES_S = {
+    'ins fluidics init': 4.0,
+    'ins door init': 3.0,
+    'ins optics init': 0.5,
+}
+
+# seconds between the command and the event it triggers
+EMULATOR_EVENT_LATENCIES_S = {
+    'startup': 2.0,  # "mfg reset" -> app_general_startup_complete (after the 1 s commandDelay of the reset step)
+    'motor': 1.5,  # "ins motor move..." -> motor_fsm_move_complete
+    'measurement': 0.5,  # "ins optics measure single" -> optics_measurement_complete
+    'door open': 2.0,  # "ins door get-state" with the door initialized -> app_fsm_door_open (the operator opens it)
+    'advertising': 0.2,  # "ble radio-on" -> first BLE advertisement
+}
+
+# period in seconds of the heater debug events - they are sent while heater debug output is enabled once the heater
+# has been started
+EMULATOR_HEATER_DEBUG_PERIOD_S = 1.0
+
+# period in seconds of the fake reference thermometer samples
+EMULATOR_THERMOMETER_PERIOD_S = 0.5
+
+# advertised name of the emulated instrument with {0} replaced by the end of its wireless ID - an assumption, the
+# matching of ble_discovery.AMIRA_NAME_PATTERN against it says nothing about the advertisements of real units
+EMULATOR_BLE_NAME_FORMAT = 'Amira {0}'
+
+# RSSI in dBm and interval in seconds of the emulated BLE advertisements
+EMULATOR_BLE_RSSI_DBM = -50
+EMULATOR_BLE_ADVERTISING_INTERVAL_S = 0.1
+
+# main photodiode counts of an optics measurement at full LED power
+EMULATOR_MAIN_PD_COUNTS = 20000
+
+# fraction of full LED power set by the values the scripts write to optics register 22
+EMULATOR_LED_POWER_REGISTER_VALUES = {0x303F: 1.0, 0x3038: 0.6, 0x3034: 0.4}
+
+# timeout in seconds of a step that doesn't define one
+EMULATOR_DEFAULT_TIMEOUT_S = 10
+
+# thermal plant of the heater - temperature rises towards AMBIENT_C + HEATER_GAIN_C * duty cycle with the time constant
+AMBIENT_C = 22.0
+HEATER_GAIN_C = 70.0
+HEATER_TIME_CONSTANT_S = 15.0
+HEATER_KP = 20.0
+HEATER_KI = 1.5
+THERMAL_STEP_S = 0.1
+
+# heater ADC counts are linear in temperature (the calibration points of "mfg htr-cal set" are 1800 and 2800 counts)
+HEATER_ADC_AT_30C = 1800
+HEATER_ADC_PER_C = 50.0
+
+# RTC tick period of the instrument
+RTC_TICK_PERIOD_S = 30.5e-6
+
+
+class EmulatedResponse(NamedTuple):
+    """
+    JSON formatted command response of the emulated instrument.
+    """
+    command_str: str
+    error_code: AmiraErrorCodes
+    payload: dict
+
+
+class EmulatedEvent(NamedTuple):
+    """
+    JSON formatted event of the emulated instrument.
+    """
+    event_code: AmiraEventCodes
+    payload: dict
+    rtc_ticks: int
+
+
+EmulatedMessage = Union[EmulatedResponse, EmulatedEvent]
+
+
+class EmulatedStepFailure(Exception):
+    """
+    Raised by EmulatedTestRunner when a test step fails the test sequence.
+    """
+
+
+class ThermalPlant(object):
+    """
+    This class simulates the heater as a first-order thermal plant driven by a PI controller towards the setpoint.
+    """
+
+    def __init__(self, ambient: float = AMBIENT_C, gain: float = HEATER_GAIN_C,
+                 time_constant: float = HEATER_TIME_CONSTANT_S, kp: float = HEATER_KP, ki: float = HEATER_KI):
+        """
+        Class initializer.
+
+        :param ambient: Ambient temperature in degrees C.
+        :param gain: Temperature rise above ambient in degrees C at a 100 percent duty cycle.
+        :param time_constant: Time constant of the plant in seconds.
+        :param kp: Proportional gain of the controller in percent duty cycle per degree C.
+        :param ki: Integral gain of the controller in percent duty cycle per degree C second.
+        """
+        self.ambient = ambient
+        self.gain = gain
+        self.time_constant = time_constant
+        self.kp = kp
+        self.ki = ki
+        self.temperature = ambient
+        self.setpoint = None  # type: Optional[float]
+        self.duty_cycle = 0.0
+        self._integral = 0.0
+
+    def set_setpoint(self, setpoint: Optional[float]) -> None:
+        """
+        This routine starts the controller at a new setpoint or stops the heater.
+
+        :param setpoint: Setpoint in degrees C or None to turn the heater off.
+        :return: None
+        """
+        self.setpoint = setpoint
+        self._integral = 0.0
+        if setpoint is None:
+            self.duty_cycle = 0.0
+
+    def step(self, dt: float) -> None:
+        """
+        This routine advances the plant and the controller by dt seconds.
+
+        :param dt: Time step in seconds.
+        :return: None
+        """
+        if self.setpoint is not None:
+            error = self.setpoint - self.temperature
+            duty_cycle = self.kp * error + self.ki * (self._integral + error * dt)
+            # only integrate while the output isn't saturated so the integral doesn't wind up during the warm up
+            if 0.0 < duty_cycle < 100.0:
+                self._integral += error * dt
+            self.duty_cycle = min(max(duty_cycle, 0.0), 100.0)
+        target = self.ambient + self.gain * self.duty_cycle / 100.0
+        self.temperature += dt * (target - self.temperature) / self.time_constant
+
+    def adc_counts(self) -> int:
+        """
+        This routine converts the temperature of the plant into heater ADC counts.
+
+        :return: Heater ADC counts.
+        """
+        return int(round(HEATER_ADC_AT_30C + (self.temperature - 30.0) * HEATER_ADC_PER_C))
+
+
+class FakeThermometer(object):
+    """
+    This class is the reference thermometer of the emulated station - it reads the temperature of the thermal plant
+    with a fixed offset and some noise.
+    """
+
+    def __init__(self, plant: ThermalPlant, offset: float = 0.0, noise: float = 0.02, seed: Optional[int] = 0):
+        """
+        Class initializer.
+
+        :param plant: Thermal plant the thermometer measures.
+        :param offset: Offset of the reading in degrees C.
+        :param noise: Standard deviation of the reading noise in degrees C.
+        :param seed: Seed of the noise or None for a random seed.
+        """
+        self.plant = plant
+        self.offset = offset
+        self.noise = noise
+        self._random = random.Random(seed)
+
+    def read(self) -> float:
+        """
+        This routine reads the temperature.
+
+        :return: Temperature in degrees C rounded to the 0.01 degree resolution of the thermometer.
+        """
+        return round(self.plant.temperature + self.offset + self._random.gauss(0.0, self.noise), 2)
+
+
+class ScriptedOperator(object):
+    """
+    This class answers the operator prompts of a test run from a script.
+    """
+
+    def __init__(self, answers: Sequence[str] = (), default_answer: str = 'y'):
+        """
+        Class initializer.
+
+        :param answers: Answers to the prompts in the order the prompts are shown.
+        :param default_answer: Answer to the prompts after the scripted answers have been used up.
+        """
+        self.answers = collections.deque(answers)
+        self.default_answer = default_answer
+        self.prompts = []  # type: List[str]
+
+    def answer(self, prompt: str = '') -> str:
+        """
+        This routine answers a prompt - it has the signature of input() so it can stand in for it.
+
+        :param prompt: Prompt shown to the operator.
+        :return: Answer of the operator.
+        """
+        self.prompts.append(prompt)
+        return self.answers.popleft() if self.answers else self.default_answer
+
+
+class RealClock(object):
+    """
+    This class is the clock of a run against the emulator in real time.  Its time base is time.perf_counter() which
+    is also the time base of the timestamps in the test scripts.
+    """
+
+    @staticmethod
+    def now() -> float:
+        """
+        :return: Current time in seconds.
+        """
+        return time.perf_counter()
+
+    @staticmethod
+    def sleep(seconds: float) -> None:
+        """
+        This routine waits for the given time.
+
+        :param seconds: Time to wait in seconds.
+        :return: None
+        """
+        if seconds > 0:
+            time.sleep(seconds)
+
+
+class VirtualClock(object):
+    """
+    This class is the clock of a run against the emulator in virtual time.  Sleeping advances the clock instantly,
+    so a run takes only as long as the host-side processing of the test sequence.
+    """
+
+    def __init__(self, start: float = 0.0):
+        """
+        Class initializer.
+
+        :param start: Initial time in seconds.
+        """
+        self._now = start
+
+    def now(self) -> float:
+        """
+        :return: Current virtual time in seconds.
+        """
+        return self._now
+
+    def sleep(self, seconds: float) -> None:
+        """
+        This routine advances the virtual time.
+
+        :param seconds: Time to advance in seconds.
+        :return: None
+        """
+        if seconds > 0:
+            self._now += seconds
+
+
+class AmiraEmulator(object):
+    """
+    This class emulates an Amira instrument.  Commands are sent with send() and the responses and events are collected
+    with poll() once they are due - the emulator has no clock of its own and is advanced by the times it's given.
+    """
+
+    def __init__(self, wireless_id: str = EMULATOR_WIRELESS_ID, version: str = EMULATOR_VERSION,
+                 response_latencies: Optional[Dict[str, float]] = None,
+                 event_latencies: Optional[Dict[str, float]] = None,
+                 plant: Optional[ThermalPlant] = None, thermometer: Optional[FakeThermometer] = None,
+                 thermometer_sink: Optional[Callable[[float, float], None]] = None, start_time: float = 0.0):
+        """
+        Class initializer.
+
+        :param wireless_id: Full wireless ID reported by "mfg getwid" and advertised over BLE.
+        :param version: Firmware version reported by "mfg app-info".
+        :param response_latencies: Response latencies in seconds keyed by command prefix, merged over
+                                   EMULATOR_RESPONSE_LATENCIES_S.
+        :param event_latencies: Event latencies in seconds, merged over EMULATOR_EVENT_LATENCIES_S.
+        :param plant: Thermal plant of the heater - defaults to a ThermalPlant with the default parameters.
+        :param thermometer: Reference thermometer of the station - defaults to a FakeThermometer of the plant.
+        :param thermometer_sink: Callable that receives the (timestamp, temperature) reference thermometer samples
+                                 (i.e. ReferenceThermometerReader.add_sample) or None to not sample the thermometer.
+        :param start_time: Time in seconds at which the emulated instrument is powered on.
+        """
+        self.wireless_id = wireless_id
+        self.version = version
+        self.response_latencies = dict(EMULATOR_RESPONSE_LATENCIES_S, **(response_latencies or {}))
+        self.event_latencies = dict(EMULATOR_EVENT_LATENCIES_S, **(event_latencies or {}))
+        self.plant = plant or ThermalPlant()
+        self.thermometer = thermometer or FakeThermometer(self.plant)
+        self.thermometer_sink = thermometer_sink
+        self.commands = []  # type: List[str]
+        self.unknown_commands = []  # type: List[str]
+        # the heater calibration is stored in flash so it survives resets
+        self.heater_calibration = {'highTemp': 50.0, 'adcHigh': 2800, 'lowTemp': 30.0, 'adcLow': 1800}
+        self._queue = []  # heap of (due time, sequence number, message)
+        self._sequence = itertools.count()
+        self._now = start_time
+        self._plant_time = start_time
+        self._next_thermometer_sample = start_time
+        self._handlers = {
+            ('cli', 'echo'): self._no_response,
+            ('mfg', 'reset'): self._reset,
+            ('mfg', 'getwid'): self._getwid,
+            ('mfg', 'setwid'): self._setwid,
+            ('mfg', 'app-info'): self._app_info,
+            ('mfg', 'htr-cal', 'set'): self._htr_cal_set,
+            ('mfg', 'htr-cal', 'get'): self._htr_cal_get,
+            ('ble', 'radio-on'): self._radio_on,
+            ('ins', 'heater', 'debug'): self._heater_debug,
+            ('ins', 'heater', 'init'): self._heater_init,
+            ('ins', 'heater', 'start'): self._heater_start,
+            ('ins', 'heater', 'stop'): self._heater_stop,
+            ('ins', 'fluidics', 'init'): self._success,
+            ('ins', 'door', 'init'): self._door_init,
+            ('ins', 'door', 'uninit'): self._door_uninit,
+            ('ins', 'door', 'get-state'): self._door_get_state,
+            ('ins', 'motor', 'move'): self._motor_move,
+            ('ins', 'motor', 'moveto'): self._motor_move,
+            ('ins', 'optics', 'reg'): self._optics_reg,
+            ('ins', 'optics', 'measure'): self._optics_measure,
+        }
+        # commands that are acknowledged without changing the emulated state
+        for prefix in (('mfg', 'props-erase'), ('ins', 'state'), ('ins', 'pwr'), ('ins', 'ui-led'),
+                       ('ins', 'fluidics', 'uninit'), ('ins', 'optics', 'init'), ('ins', 'optics', 'uninit'),
+                       ('ins', 'optics', 'led-current'), ('ins', 'motor', 'config'), ('ins', 'motor', 'mode')):
+            self._handlers[prefix] = self._success
+        self._power_on(start_time)
+
+    def _power_on(self, now: float) -> None:
+        """
+        This routine resets the state of the emulated instrument as at power on or after a reset.
+
+        :param now: Time in seconds.
+        :return: None
+        """
+        self._boot_time = now
+        self.heater_initialized = False
+        self.heater_debug = False
+        self.door_initialized = False
+        self.door_open = False
+        self.advertising_since = None  # type: Optional[float]
+        self.optics_power = 1.0
+        self.motor_position = 0
+        self._next_heater_debug = None  # type: Optional[float]
+        self.plant.set_setpoint(None)
+
+    def latency(self, command: str) -> float:
+        """
+        This routine looks up the response latency of a command.
+
+        :param command: Full command string.
+        :return: Latency in seconds.
+        """
+        matches = [prefix for prefix in self.response_latencies if command.startswith(prefix)]
+        return self.response_latencies[max(matches, key=len)] if matches else EMULATOR_COMMAND_LATENCY_S
+
+    def send(self, command: str, now: float) -> None:
+        """
+        This routine receives a command.
+
+        :param command: Full command string (i.e. 'ins heater start 40').
+        :param now: Time in seconds at which the command is received.
+        :return: None
+        """
+        self._advance(now)
+        self.commands.append(command)
+        words = command.split()
+        for length in (3, 2, 1):
+            handler = self._handlers.get(tuple(words[:length]))
+            if handler is not None:
+                handler(command, words)
+                return
+        log.msg('emulator: unknown command "{0}" acknowledged'.format(command), logLevel=logging.WARNING)
+        self.unknown_commands.append(command)
+        self._success(command, words)
+
+    def poll(self, now: float) -> List[EmulatedMessage]:
+        """
+        This routine advances the emulated instrument to the given time and collects the messages that are due.
+
+        :param now: Time in seconds.
+        :return: List of the due responses and events in the order they were sent by the instrument.
+        """
+        self._advance(now)
+        messages = []
+        while self._queue and self._queue[0][0] <= now:
+            messages.append(heapq.heappop(self._queue)[2])
+        return messages
+
+    def next_due(self) -> Optional[float]:
+        """
+        This routine returns the time of the next message, thermometer sample or change of the BLE advertisement.
+
+        :return: Time in seconds or None if nothing is scheduled.
+        """
+        times = [self._queue[0][0]] if self._queue else []
+        if self._next_heater_debug is not None:
+            times.append(self._next_heater_debug)
+        if self.thermometer_sink is not None:
+            times.append(self._next_thermometer_sample)
+        if self.advertising_since is not None and self.advertising_since > self._now:
+            times.append(self.advertising_since)
+        return min(times) if times else None
+
+    def advertisement(self) -> Optional[dict]:
+        """
+        This routine returns the BLE advertisement of the instrument.
+
+        :return: Dictionary with the address, name and rssi of the advertisement or None while the radio is off.
+        """
+        if self.advertising_since is None or self._now < self.advertising_since:
+            return None
+        return {'address': 'EE:00:00:00:{0}:{1}'.format(self.wireless_id[-4:-2], self.wireless_id[-2:]),
+                'name': EMULATOR_BLE_NAME_FORMAT.format(self.wireless_id[-3:]), 'rssi': EMULATOR_BLE_RSSI_DBM}
+
+    def _advance(self, now: float) -> None:
+        """
+        This routine runs the thermal plant, the heater debug events and the thermometer samples up to the given time.
+
+        :param now: Time in seconds.
+        :return: None
+        """
+        while True:
+            due = [due for due in (self._next_heater_debug,
+                                   self._next_thermometer_sample if self.thermometer_sink is not None else None)
+                   if due is not None and due <= now]
+            if not due:
+                break
+            due_time = min(due)
+            self._step_plant(due_time)
+            if due_time == self._next_heater_debug:
+                self._emit(due_time, AmiraEventCodes.heater_debug_log,
+                           {'adc-counts': self.plant.adc_counts(), 'duty-cycle-percent': int(round(self.plant.duty_cycle)),
+                            'temperature-c': round(self.plant.temperature, 2)})
+                self._next_heater_debug += EMULATOR_HEATER_DEBUG_PERIOD_S
+            else:
+                self.thermometer_sink(due_time, self.thermometer.read())
+                self._next_thermometer_sample += EMULATOR_THERMOMETER_PERIOD_S
+        self._step_plant(now)
+        self._now = max(self._now, now)
+
+    def _step_plant(self, until: float) -> None:
+        """
+        This routine runs the thermal plant in THERMAL_STEP_S steps up to the given time.
+
+        :param until: Time in seconds.
+        :return: None
+        """
+        while self._plant_time < until:
+            dt = min(THERMAL_STEP_S, until - self._plant_time)
+            self.plant.step(dt)
+            self._plant_time += dt
+
+    def _schedule(self, due: float, message: EmulatedMessage) -> None:
+        heapq.heappush(self._queue, (due, next(self._sequence), message))
+
+    def _respond(self, words: List[str], payload: Optional[dict] = None,
+                 error_code: AmiraErrorCodes = AmiraErrorCodes.NRF_SUCCESS) -> None:
+        """
+        This routine schedules the response to the command being handled.
+
+        :param words: Words of the command.
+        :param payload: JSON payload of the response.
+        :param error_code: Error code of the response.
+        :return: None
+        """
+        command = ' '.join(words)
+        self._schedule(self._now + self.latency(command),
+                       EmulatedResponse(' '.join(words[1:]), error_code, payload or {}))
+
+    def _emit(self, due: float, event_code: AmiraEventCodes, payload: Optional[dict] = None) -> None:
+        """
+        This routine schedules an event.
+
+        :param due: Time in seconds at which the event is sent.
+        :param event_code: Code of the event.
+        :param payload: JSON payload of the event.
+        :return: None
+        """
+        self._schedule(due, EmulatedEvent(event_code, payload or {}, int((due - self._boot_time) / RTC_TICK_PERIOD_S)))
+
+    def _no_response(self, _command: str, _words: List[str]) -> None:
+        pass
+
+    def _success(self, _command: str, words: List[str]) -> None:
+        self._respond(words)
+
+    def _reset(self, _command: str, _words: List[str]) -> None:
+        self._power_on(self._now)
+        self._queue = []
+        self._emit(self._now + self.event_latencies['startup'], AmiraEventCodes.app_general_startup_complete)
+
+    def _getwid(self, _command: str, words: List[str]) -> None:
+        self._respond(words, {'wirelessIdFull': self.wireless_id})
+
+    def _setwid(self, _command: str, words: List[str]) -> None:
+        # the firmware stores the short form of the wireless ID and keeps reporting the full ID
+        self._respond(words)
+
+    def _app_info(self, _command: str, words: List[str]) -> None:
+        self._respond(words, {'productName': 'Amira', 'versionString': self.version,
+                              'gitTag': '{0}.emulator'.format(self.version.split('_')[0])})
+
+    def _htr_cal_set(self, _command: str, words: List[str]) -> None:
+        try:
+            high_temp, adc_high, low_temp, adc_low = words[3:7]
+            self.heater_calibration = {'highTemp': float(high_temp), 'adcHigh': int(adc_high),
+                                       'lowTemp': float(low_temp), 'adcLow': int(adc_low)}
+        except ValueError:
+            log.msg('emulator: bad heater calibration "{0}"'.format(' '.join(words)), logLevel=logging.WARNING)
+        self._respond(words)
+
+    def _htr_cal_get(self, _command: str, words: List[str]) -> None:
+        self._respond(words, dict(self.heater_calibration))
+
+    def _radio_on(self, _command: str, words: List[str]) -> None:
+        self.advertising_since = self._now + self.event_latencies['advertising']
+        self._respond(words)
+
+    def _heater_debug(self, _command: str, words: List[str]) -> None:
+        self.heater_debug = words[-1] == 'enable'
+        if not self.heater_debug:
+            self._next_heater_debug = None
+        self._respond(words)
+
+    def _heater_init(self, _command: str, words: List[str]) -> None:
+        already_initialized = self.heater_initialized
+        self.heater_initialized = True
+        self._respond(words, error_code=AmiraErrorCodes.NRFX_ERROR_ALREADY_INITIALIZED if already_initialized
+                      else AmiraErrorCodes.NRF_SUCCESS)
+
+    def _heater_start(self, _command: str, words: List[str]) -> None:
+        self.plant.set_setpoint(float(words[3]))
+        if self.heater_debug and self._next_heater_debug is None:
+            self._next_heater_debug = self._now + EMULATOR_HEATER_DEBUG_PERIOD_S
+        self._respond(words)
+
+    def _heater_stop(self, _command: str, words: List[str]) -> None:
+        self.plant.set_setpoint(None)
+        self._respond(words)
+
+    def _door_init(self, _command: str, words: List[str]) -> None:
+        self.door_initialized = True
+        self._respond(words)
+
+    def _door_uninit(self, _command: str, words: List[str]) -> None:
+        self.door_initialized = False
+        self._respond(words)
+
+    def _door_get_state(self, _command: str, words: List[str]) -> None:
+        self._respond(words, {'state': 'open' if self.door_open else 'closed'})
+        if self.door_initialized and not self.door_open:
+            # the operator opens the door after it has been checked
+            self.door_open = True
+            self._emit(self._now + self.event_latencies['door open'], AmiraEventCodes.app_fsm_door_open)
+
+    def _motor_move(self, _command: str, words: List[str]) -> None:
+        if words[2] == 'moveto':
+            self.motor_position = int(words[3])
+        elif words[-1] == 'home':
+            self.motor_position = 0
+        self._respond(words)
+        self._emit(self._now + self.event_latencies['motor'], AmiraEventCodes.motor_fsm_move_complete,
+                   {'position': self.motor_position})
+
+    def _optics_reg(self, _command: str, words: List[str]) -> None:
+        # register 22 sets the LED power
+        if words[3:5] == ['write', '22']:
+            self.optics_power = EMULATOR_LED_POWER_REGISTER_VALUES.get(int(words[5], 16), self.optics_power)
+        self._respond(words)
+
+    def _optics_measure(self, _command: str, words: List[str]) -> None:
+        self._respond(words)
+        due = self._now + self.event_latencies['measurement']
+        self._emit(due, AmiraEventCodes.optics_measurement_complete,
+                   {'main-pd': int(EMULATOR_MAIN_PD_COUNTS * self.optics_power), 'ref-pd': 1000})
+        self._emit(due, AmiraEventCodes.app_fsm_measurement_complete,
+                   {'main-pd': int(EMULATOR_MAIN_PD_COUNTS * self.optics_power), 'ref-pd': 1000})
+
+
+class EmulatedRunResult(NamedTuple):
+    """
+    Result of a test sequence run against the emulator.
+    """
+    passed: bool
+    failed_step_index: Optional[int]
+    error: Optional[str]
+    duration: float
+    steps_executed: int
+
+
+class EmulatedTestRunner(object):
+    """
+    This class executes a test_step_list against an AmiraEmulator the way the test tool executes it against an
+    instrument.  Responses and events are delivered to the custom parsers of the step that is executing when they
+    arrive, and the step fails the sequence in the same cases (parser failures, handler failures and timeouts).
+    Regex and log parsing are not emulated.
+    """
+
+    def __init__(self, emulator: AmiraEmulator, operator: Optional[ScriptedOperator] = None, clock=None):
+        """
+        Class initializer.
+
+        :param emulator: Emulated instrument.
+        :param operator: Answers to the wait_for_user_input steps - defaults to answering 'y' to everything.
+        :param clock: Clock with now() and sleep() - defaults to RealClock.  The emulator has to be driven by the
+                      same clock (i.e. created with start_time=clock.now()).
+        """
+        self.emulator = emulator
+        self.operator = operator or ScriptedOperator()
+        self.clock = clock or RealClock()
+
+    def run(self, test_step_list: List[dict]) -> EmulatedRunResult:
+        """
+        This routine executes a list of test steps.
+
+        :param test_step_list: List of test steps.
+        :return: Result of the run.
+        """
+        start = self.clock.now()
+        loops = []  # stack of [index of the start_loop step, remaining loops]
+        index = 0
+        executed = 0
+        while index < len(test_step_list):
+            step = test_step_list[index]
+            action = step['action']
+            try:
+                self._run_step(index, step)
+            except EmulatedStepFailure as error:
+                log.msg('emulated run: step {0} failed: {1}'.format(index, error), logLevel=logging.ERROR)
+                return EmulatedRunResult(False, index, str(error), self.clock.now() - start, executed)
+            executed += 1
+            if action == AmiraTestOperations.start_loop:
+                num_loops = self._value(index, step, 'numLoops', 'customNumLoopsGenerator', 1)
+                loops.append([index, num_loops])
+            elif action == AmiraTestOperations.end_loop and loops:
+                loops[-1][1] -= 1
+                if loops[-1][1] > 0:
+                    index = loops[-1][0]
+                else:
+                    loops.pop()
+            index += 1
+        return EmulatedRunResult(True, None, None, self.clock.now() - start, executed)
+
+    @staticmethod
+    def _value(index: int, step: dict, key: str, generator_key: str, default=None):
+        """
+        This routine looks up a step value that can be given directly or by a generator.
+
+        :param index: Index of the step.
+        :param step: Test step.
+        :param key: Key of the value.
+        :param generator_key: Key of the generator of the value.
+        :param default: Value if the step defines neither.
+        :return: Value.
+        """
+        if generator_key in step:
+            return step[generator_key](index)
+        return step.get(key, default)
+
+    def _run_step(self, index: int, step: dict) -> None:
+        """
+        This routine executes one test step.
+
+        :param index: Index of the step.
+        :param step: Test step.
+        :return: None
+        :raises EmulatedStepFailure: If the step fails the test sequence.
+        """
+        if 'customOnEntryHandler' in step and not step['customOnEntryHandler'](index):
+            raise EmulatedStepFailure('test_step_custom_on_entry_failure')
+        message = self._value(index, step, 'customStepDisplayMessage', 'customMessageGenerator')
+        if message:
+            log.msg('emulated run: step {0}: {1}'.format(index, message), logLevel=logging.INFO)
+
+        action = step['action']
+        if action in (AmiraTestOperations.send_command, AmiraTestOperations.send_repeat_command):
+            timeout = self._value(index, step, 'timeout', 'customTimeoutGenerator', EMULATOR_DEFAULT_TIMEOUT_S)
+            repeats = self._value(index, step, 'repeats', 'customRepeatsGenerator', 1) \
+                if action == AmiraTestOperations.send_repeat_command else 1
+            for _ in range(repeats):
+                self._send(index, step)
+                if not self._wait(index, step, self.clock.now() + timeout, ends_on_response=True):
+                    raise EmulatedStepFailure('timeout')
+        elif action == AmiraTestOperations.send_raw_command:
+            self._send(index, step)
+            self._wait(index, step, self.clock.now() + self._value(index, step, 'commandDelay',
+                                                                   'customCommandDelayGenerator', 0))
+        elif action == AmiraTestOperations.delay:
+            self._wait(index, step, self.clock.now() + self._value(index, step, 'timeout', 'customTimeoutGenerator', 0),
+                       ends_on_event=True)
+        elif action == AmiraTestOperations.wait_for_event:
+            timeout = self._value(index, step, 'timeout', 'customTimeoutGenerator', EMULATOR_DEFAULT_TIMEOUT_S)
+            if not self._wait(index, step, self.clock.now() + timeout, ends_on_event=True):
+                raise EmulatedStepFailure('timeout')
+        elif action == AmiraTestOperations.wait_for_user_input:
+            user_input = self.operator.answer(message or '')
+            if 'customUserInputParser' in step:
+                step['customUserInputParser'](index, user_input)
+
+        if 'customOnExitHandler' in step and not step['customOnExitHandler'](index):
+            raise EmulatedStepFailure('test_step_custom_on_exit_failure')
+
+    def _send(self, index: int, step: dict) -> None:
+        command = self._value(index, step, 'command', 'customCommandGenerator')
+        self.emulator.send(command, self.clock.now())
+
+    def _wait(self, index: int, step: dict, deadline: float, ends_on_response: bool = False,
+              ends_on_event: bool = False) -> bool:
+        """
+        This routine delivers the messages of the emulated instrument to the step until the step ends or the deadline
+        passes.
+
+        :param index: Index of the step.
+        :param step: Test step.
+        :param deadline: Time in seconds at which the wait ends.
+        :param ends_on_response: True if a response ends the step (send_command).
+        :param ends_on_event: True if an event parsed successfully (or the awaited event) ends the step.
+        :return: True if the step has ended before the deadline, otherwise False.
+        :raises EmulatedStepFailure: If a parser fails the test sequence.
+        """
+        while True:
+            for message in self.emulator.poll(self.clock.now()):
+                if isinstance(message, EmulatedResponse):
+                    if self._deliver_response(index, step, message) and ends_on_response:
+                        return True
+                elif self._deliver_event(index, step, message) and ends_on_event:
+                    return True
+            now = self.clock.now()
+            if now >= deadline:
+                return False
+            due = self.emulator.next_due()
+            self.clock.sleep(min(deadline, due if due is not None and due > now else deadline) - now)
+
+    @staticmethod
+    def _deliver_response(index: int, step: dict, response: EmulatedResponse) -> bool:
+        """
+        :return: True once the response has been accepted.
+        :raises EmulatedStepFailure: If the response fails the test sequence.
+        """
+        if 'customResponseParser' in step:
+            if not step['customResponseParser'](index, True, response.error_code, response.command_str,
+                                                response.payload):
+                raise EmulatedStepFailure('test_step_custom_response_parser_failure')
+        elif step['action'] in (AmiraTestOperations.send_command, AmiraTestOperations.send_repeat_command) and \
+                response.error_code not in (AmiraErrorCodes.NRF_SUCCESS, AmiraErrorCodes.NRFX_SUCCESS):
+            raise EmulatedStepFailure('error response {0} to {1}'.format(response.error_code, response.command_str))
+        return True
+
+    @staticmethod
+    def _deliver_event(index: int, step: dict, event: EmulatedEvent) -> bool:
+        """
+        :return: True if the event ends a delay or wait_for_event step.
+        :raises EmulatedStepFailure: If the event parser fails the test sequence.
+        """
+        if 'customEventParser' not in step:
+            return step['action'] == AmiraTestOperations.wait_for_event and event.event_code == step.get('event')
+        now = datetime.now()
+        result = step['customEventParser'](index, event.event_code, int(now.timestamp()),
+                                           now.strftime('%m/%d/%y %I:%M:%S %p'), event.rtc_ticks, event.payload)
+        if result == AmiraTestEventParserReturnValues.failure:
+            raise EmulatedStepFailure('test_step_custom_event_parser_failure')
+        return result == AmiraTestEventParserReturnValues.success
+
+
+class EmulatedBleScanService(ble_scan_service.BleScanService):
+    """
+    This class is a BLE scan service (see ble_scan_service.py) that sees the advertisements of the emulated
+    instrument instead of scanning, so the Bluetooth check of the smoke test runs without a radio.
+    """
+
+    def __init__(self, emulator: AmiraEmulator, host: str = ble_scan_service.BLE_SCAN_SERVICE_HOST,
+                 port: int = ble_scan_service.BLE_SCAN_SERVICE_PORT,
+                 ttl: float = ble_scan_service.BLE_SCAN_CACHE_TTL_S):
+        """
+        Class initializer.
+
+        :param emulator: Emulated instrument whose advertisements are seen.
+        :param host: Address the service listens on.
+        :param port: Port the service listens on.
+        :param ttl: Seconds an advertisement stays in the cache after it was last seen.
+        """
+        super().__init__(host, port, ttl)
+        self.emulator = emulator
+        self._loop = None  # type: Optional[asyncio.AbstractEventLoop]
+        self._task = None  # type: Optional[asyncio.Task]
+        self._thread = None  # type: Optional[threading.Thread]
+        self._ready = threading.Event()
+
+    async def run(self) -> None:
+        """
+        This routine runs the socket server and adds the advertisements of the emulated instrument to the cache.
+
+        :return: None
+        """
+        server = await asyncio.start_server(self._handle_client, self.host, self.port)
+        self._ready.set()
+        async with server:
+            while True:
+                advertisement = self.emulator.advertisement()
+                if advertisement is not None:
+                    self.cache.add(advertisement['address'], advertisement['name'], advertisement['rssi'])
+                await asyncio.sleep(EMULATOR_BLE_ADVERTISING_INTERVAL_S)
+
+    def start(self) -> None:
+        """
+        This routine starts the service on a background thread and waits until it's listening.
+
+        :return: None
+        """
+        self._thread = threading.Thread(target=self._serve, name='emulated-ble-scan-service', daemon=True)
+        self._thread.start()
+        self._ready.wait(5)
+
+    def stop(self) -> None:
+        """
+        This routine stops the service.
+
+        :return: None
+        """
+        if self._loop is not None and self._task is not None:
+            self._loop.call_soon_threadsafe(self._task.cancel)
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+            self._thread = None
+
+    def _serve(self) -> None:
+        self._loop = asyncio.new_event_loop()
+        self._task = self._loop.create_task(self.run())
+        try:
+            self._loop.run_until_complete(self._task)
+        except (asyncio.CancelledError, OSError) as error:
+            if isinstance(error, OSError):
+                log.msg('emulated BLE scan service: {0}'.format(error), logLevel=logging.ERROR)
+        finally:
+            self._loop.close()
+
+
+def load_test_script(script_filename: str, operator: ScriptedOperator):
+    """
+    This routine imports a test script with its operator prompts (the input() calls at module level) answered by
+    the scripted operator.
+
+    :param script_filename: Path of the test script.
+    :param operator: Answers to the prompts.
+    :return: Module of the test script.
+    """
+    script_dir = os.path.dirname(os.path.abspath(script_filename))
+    if script_dir not in sys.path:
+        sys.path.insert(0, script_dir)
+    spec = importlib.util.spec_from_file_location(os.path.splitext(os.path.basename(script_filename))[0],
+                                                  script_filename)
+    module = importlib.util.module_from_spec(spec)
+    real_input = builtins.input
+    builtins.input = operator.answer
+    try:
+        spec.loader.exec_module(module)
+    finally:
+        builtins.input = real_input
+    return module
+
+
+def attach_reference_thermometer(reader, emulator: AmiraEmulator) -> None:
+    """
+    This routine feeds a ReferenceThermometerReader of the heater script from the fake thermometer of the emulator
+    instead of its serial port.
+
+    :param reader: ReferenceThermometerReader of the heater script.
+    :param emulator: Emulated instrument.
+    :return: None
+    """
+    reader.port = None
+    emulator.thermometer_sink = reader.add_sample
+
+
+def use_run_clock(module, clock) -> None:
+    """
+    This routine puts the timers of a test script on the clock of the run if the script supports it (the heater
+    script's HeaterRunContext.use_clock() and the step timing trace of a script that has one).
+
+    :param module: Module of the test script.
+    :param clock: RealClock or VirtualClock of the run.
+    :return: None
+    """
+    run_context = getattr(module, 'run_context', None)
+    if run_context is not None and hasattr(run_context, 'use_clock'):
+        run_context.use_clock(clock.now)
+    step_trace = getattr(module, 'step_trace', None)
+    if step_trace is not None and hasattr(step_trace, 'clock'):
+        step_trace.clock = clock.now
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """
+    This routine runs a test script against the emulator.
+
+    :param argv: Command line arguments - defaults to sys.argv.
+    :return: Process exit code - 0 if the test sequence passed.
+    """
+    parser = argparse.ArgumentParser(description='Run a test script against the Amira emulator.')
+    parser.add_argument('script', help='test script with a test_step_list')
+    parser.add_argument('--answers', nargs='*', default=None,
+                        help='answers to the operator prompts in order (defaults to the wireless ID for the serial '
+                             'number prompt and "y" for everything else)')
+    parser.add_argument('--wireless-id', default=EMULATOR_WIRELESS_ID)
+    parser.add_argument('--ble-port', type=int, default=ble_scan_service.BLE_SCAN_SERVICE_PORT,
+                        help='port of the emulated BLE scan service or 0 to not run it')
+    parser.add_argument('--virtual-time', action='store_true',
+                        help='advance delays, timeouts and instrument latencies instantly')
+    args = parser.parse_args(argv)
+    log.startLogging(sys.stdout)
+
+    operator = ScriptedOperator([args.wireless_id] if args.answers is None else args.answers)
+    clock = VirtualClock() if args.virtual_time else RealClock()
+    emulator = AmiraEmulator(args.wireless_id, start_time=clock.now())
+    ble_service = EmulatedBleScanService(emulator, port=args.ble_port) if args.ble_port else None
+    if ble_service is not None:
+        ble_service.start()
+    try:
+        module = load_test_script(args.script, operator)
+        test_handler = getattr(module, 'test_handler', None)
+        if test_handler is not None and hasattr(test_handler, 'reference_thermometer'):
+            attach_reference_thermometer(test_handler.reference_thermometer, emulator)
+        use_run_clock(module, clock)
+        result = EmulatedTestRunner(emulator, operator, clock).run(module.test_step_list)
+    finally:
+        if ble_service is not None:
+            ble_service.stop()
+    print('{0}: {1} in {2:.1f} s{3} ({4} steps){5}'.format(
+        args.script, 'PASSED' if result.passed else 'FAILED', result.duration,
+        ' of virtual time' if args.virtual_time else '', result.steps_executed,
+        '' if result.passed else ' - step {0}: {1}'.format(result.failed_step_index, result.error)))
+    if emulator.unknown_commands:
+        print('unknown commands: {0}'.format(', '.join(sorted(set(emulator.unknown_commands)))))
+    return 0 if result.passed else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
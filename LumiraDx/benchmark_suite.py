@@ -0,0 +1,400 @@
+"""
+benchmark_suite.py
+
+This module benchmarks the smoke test and heater calibration scripts against the Amira emulator (see
+amira_emulator.py), so the effect of a change on their speed is measured instead of guessed.  Both test sequences
+are run back to back in virtual time for a number of soak runs, with every custom callback profiled (see
+callback_profiling.py), and the suite reports:
+
+- the host wall-clock time and the (virtual) cycle time of each sequence
+- the host CPU time per heater debug event (heater_debug_capture_event_parser)
+- the rows per second of the smoke test results file (SmokeResultSink)
+- the latency of the Bluetooth check of the smoke test against the emulated BLE scan service
+- the render time of a heater plot, with every sample and decimated
+- the peak RSS of the process over the soak
+
+The results are written as JSON and compared with a stored baseline - the suite fails if a metric is worse than the
+baseline by more than the tolerance.  Baselines are specific to a computer, so record one on the computer that runs
+the comparison.
+
+Run the suite with:  python benchmark_suite.py [--baseline benchmark_baseline.json] [--update-baseline]
+
+@copyright LumiraDx, 2021. All rights reserved. This code is provided on an
+           "AS IS" basis. LumiraDx DISCLAIMS ALL WARRANTIES, TERMS AND
+           CONDITIONS WITH RESPECT TO THE CODE, EXPRESS, IMPLIED, STATUTORY
+           OR OTHERWISE, INCLUDING WARRANTIES, TERMS OR CONDITIONS OF
+           MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NONINFRINGEMENT
+           AND SATISFACTORY QUALITY. TO THE FULL EXTENT ALLOWED BY LAW,
+           LUMIRADX ALSO EXCLUDES ANY LIABILITY, WHETHER BASED IN CONTRACT
+           OR TORT (INCLUDING NEGLIGENCE), FOR INCIDENTAL, CONSEQUENTIAL,
+           INDIRECT, SPECIAL OR PUNITIVE DAMAGES OF ANY KIND, OR FOR LOSS
+           OF REVENUE OR PROFITS, LOSS OF BUSINESS, LOSS OF INFORMATION OR
+           DATA, OR OTHER FINANCIAL LOSS ARISING OUT OF OR IN CONNECTION
+           WITH THE USE OR PERFORMANCE OF THE CODE.
+"""
+
+import argparse
+import atexit
+import json
+import os
+import platform
+import socket
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Dict, List, NamedTuple, Optional
+
+import numpy as np
+from twisted.python import log
+
+import amira_emulator
+import callback_profiling
+import heater_plotting
+
+
+# the benchmarked test scripts, relative to this module
+BENCHMARK_SMOKE_SCRIPT = 'smoke_test_windowsV5.py'
+BENCHMARK_HEATER_SCRIPT = 'shortheatercalFruit4_windows.py'
+
+# default baseline file the results are compared with
+BENCHMARK_BASELINE_FILENAME = 'benchmark_baseline.json'
+
+# number of times both sequences are run - the timings are the medians of the runs and the peak RSS is taken after
+# the last run
+BENCHMARK_SOAK_RUNS = 10
+
+# a metric fails if it's worse than the baseline by more than this fraction of the baseline value...
+BENCHMARK_TOLERANCE = 0.25
+
+# number of rows written in the results file benchmark
+BENCHMARK_CSV_ROWS = 20000
+
+# number of samples of the benchmarked heater plot - a long run of the 1 second heater debug events
+BENCHMARK_PLOT_SAMPLES = 3600
+
+# qualified names of the callbacks the per-callback metrics are taken from
+HEATER_EVENT_CALLBACK = 'TestHandler.heater_debug_capture_event_parser'
+BLE_CHECK_CALLBACK = 'InitDebugCapture.bluetooth_response_parser'
+
+
+class BenchmarkMetric(NamedTuple):
+    """
+    Description of a benchmark metric.
+    """
+    unit: str
+    higher_is_better: bool
+    slack: float  # ...and by more than this absolute amount, so tiny values don't fail on noise
+    description: str
+
+
+BENCHMARK_METRICS = {
+    'smoke_wall_s': BenchmarkMetric('s', False, 0.05, 'host wall-clock time of the smoke test sequence'),
+    'smoke_cycle_s': BenchmarkMetric('s', False, 0.5, 'cycle time of the smoke test sequence (virtual time)'),
+    'heater_wall_s': BenchmarkMetric('s', False, 0.1, 'host wall-clock time of the heater sequence with its plots'),
+    'heater_cycle_s': BenchmarkMetric('s', False, 0.5, 'cycle time of the heater sequence (virtual time)'),
+    'heater_event_cpu_us': BenchmarkMetric('us', False, 50.0, 'host CPU time per heater debug event'),
+    'csv_rows_per_s': BenchmarkMetric('rows/s', True, 0.0, 'rows per second written to the smoke results file'),
+    'ble_check_s': BenchmarkMetric('s', False, 0.05, 'latency of the Bluetooth check of the smoke test'),
+    'plot_render_s': BenchmarkMetric('s', False, 0.05, 'render time of a heater plot with every sample'),
+    'plot_render_decimated_s': BenchmarkMetric('s', False, 0.05, 'render time of a decimated heater plot'),
+    'peak_rss_mb': BenchmarkMetric('MB', False, 10.0, 'peak resident set size of the process over the soak'),
+}
+
+
+class SequenceRun(NamedTuple):
+    """
+    Result of one run of a test sequence against the emulator.
+    """
+    passed: bool
+    error: Optional[str]
+    wall: float
+    cycle: float
+    callbacks: Dict[str, callback_profiling.CallbackStats]
+
+
+def free_port() -> int:
+    """
+    This routine finds a free local TCP port for the emulated BLE scan service.
+
+    :return: Port number.
+    """
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def close_test_script(module) -> None:
+    """
+    This routine releases the resources of a test script the way its atexit handlers do at the end of a run, and
+    removes the handlers so the script can be garbage collected.
+
+    :param module: Module of the test script.
+    :return: None
+    """
+    for name in ('inits_debug', 'test_handler'):
+        handler = getattr(module, name, None)
+        if handler is not None:
+            handler.close()
+            atexit.unregister(handler.close)
+
+
+def run_sequence(script_filename: str, work_dir: str,
+                 wireless_id: str = amira_emulator.EMULATOR_WIRELESS_ID) -> SequenceRun:
+    """
+    This routine runs a test script against the emulator in virtual time with its callbacks profiled.
+
+    :param script_filename: Path of the test script.
+    :param work_dir: Directory the callback profile is written to.
+    :param wireless_id: Wireless ID of the emulated instrument.
+    :return: Result of the run - the wall time includes closing the script, so the heater plots are rendered.
+    """
+    operator = amira_emulator.ScriptedOperator([wireless_id])
+    clock = amira_emulator.VirtualClock()
+    emulator = amira_emulator.AmiraEmulator(wireless_id, start_time=clock.now())
+    ble_service = amira_emulator.EmulatedBleScanService(emulator, port=free_port())
+    ble_service.start()
+    try:
+        wall_start = time.perf_counter()
+        module = amira_emulator.load_test_script(script_filename, operator)
+        if hasattr(module, 'SMOKE_BLE_SCAN_SERVICE'):
+            module.SMOKE_BLE_SCAN_SERVICE = (ble_service.host, ble_service.port)
+        test_handler = getattr(module, 'test_handler', None)
+        if test_handler is not None and hasattr(test_handler, 'reference_thermometer'):
+            amira_emulator.attach_reference_thermometer(test_handler.reference_thermometer, emulator)
+        amira_emulator.use_run_clock(module, clock)
+        profiler = callback_profiling.CallbackProfiler(work_dir, trace_allocations=False, sample_interval=None)
+        result = amira_emulator.EmulatedTestRunner(emulator, operator, clock).run(
+            profiler.instrument(module.test_step_list))
+        close_test_script(module)
+        wall = time.perf_counter() - wall_start
+    finally:
+        ble_service.stop()
+    error = None if result.passed else 'step {0}: {1}'.format(result.failed_step_index, result.error)
+    return SequenceRun(result.passed, error, wall, result.duration, dict(profiler.stats))
+
+
+def benchmark_csv_rows(smoke_module, work_dir: str, num_rows: int = BENCHMARK_CSV_ROWS) -> float:
+    """
+    This routine measures the write rate of the smoke test results file.
+
+    :param smoke_module: Module of the smoke test script.
+    :param work_dir: Directory of the results file.
+    :param num_rows: Number of rows to write.
+    :return: Rows per second, including closing (flushing and syncing) the file.
+    """
+    results_filename = os.path.join(work_dir, 'benchmark_results.csv')
+    start = time.perf_counter()
+    sink = smoke_module.SmokeResultSink(results_filename)
+    for _ in range(num_rows):
+        sink.write_row({'UUT': amira_emulator.EMULATOR_WIRELESS_ID, 'FirmVersion': '1.0.0',
+                        'DateTimeStamp': datetime.today(), 'Description': 'Motor Away Movement', 'Units': 'Position',
+                        'LowerRangeValue': 1700, 'HigherRangeValue': 2000, 'MeasuredValue': 1740, 'Result': 'Pass'})
+    sink.close()
+    return num_rows / (time.perf_counter() - start)
+
+
+def benchmark_plot(work_dir: str, buckets: Optional[int], num_samples: int = BENCHMARK_PLOT_SAMPLES) -> float:
+    """
+    This routine measures the render time of a heater plot of a long run.
+
+    :param work_dir: Directory of the plot file.
+    :param buckets: Number of min/max buckets of the decimated plot or None to draw every sample.
+    :param num_samples: Number of samples of the run.
+    :return: Render time in seconds.
+    """
+    rng = np.random.default_rng(0)
+    seconds = np.arange(num_samples)
+    temperature_data = 40 - 15 * np.exp(-seconds / 120.0) + rng.normal(0, 0.05, num_samples)
+    adc_counts_data = np.round(20000 + 300 * temperature_data)
+    duty_cycle_data = np.clip(100 * np.exp(-seconds / 200.0) + rng.normal(20, 2, num_samples), 0, 100)
+    start = time.perf_counter()
+    heater_plotting.render_heater_plot(os.path.join(work_dir, 'benchmark_plot.png'), 40, adc_counts_data,
+                                       temperature_data, duty_cycle_data, 300, buckets)
+    return time.perf_counter() - start
+
+
+def peak_rss_mb() -> Optional[float]:
+    """
+    This routine reads the peak resident set size of the process - the peak working set on Windows.
+
+    :return: Peak RSS in MB or None if the platform doesn't report it.
+    """
+    if sys.platform == 'win32':
+        # the resource module doesn't exist on Windows - ask the process status API instead
+        import ctypes
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                        ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                        ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                        ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        get_current_process = ctypes.windll.kernel32.GetCurrentProcess
+        get_current_process.restype = wintypes.HANDLE
+        get_process_memory_info = ctypes.windll.psapi.GetProcessMemoryInfo
+        get_process_memory_info.argtypes = [wintypes.HANDLE, ctypes.POINTER(ProcessMemoryCounters), wintypes.DWORD]
+        get_process_memory_info.restype = wintypes.BOOL
+        if not get_process_memory_info(get_current_process(), ctypes.byref(counters), counters.cb):
+            return None
+        return round(counters.PeakWorkingSetSize / (1024 * 1024), 1)
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes everywhere else
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def run_benchmarks(soak_runs: int = BENCHMARK_SOAK_RUNS) -> dict:
+    """
+    This routine runs the benchmark suite in a temporary working directory.
+
+    :param soak_runs: Number of times both sequences are run.
+    :return: Dictionary with the metrics and a description of the computer.
+    :raises RuntimeError: If a test sequence fails against the emulator or a metric of BENCHMARK_METRICS can't be
+                          measured on this computer.
+    """
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    smoke_script = os.path.join(script_dir, BENCHMARK_SMOKE_SCRIPT)
+    heater_script = os.path.join(script_dir, BENCHMARK_HEATER_SCRIPT)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix='benchmark_') as work_dir:
+        # the scripts write their results relative to the working directory
+        os.chdir(work_dir)
+        try:
+            runs = {'smoke': [], 'heater': []}
+            for run in range(soak_runs):
+                for name, script in (('smoke', smoke_script), ('heater', heater_script)):
+                    sequence_run = run_sequence(script, work_dir)
+                    if not sequence_run.passed:
+                        raise RuntimeError('{0} sequence failed in soak run {1}: {2}'.format(
+                            name, run + 1, sequence_run.error))
+                    runs[name].append(sequence_run)
+            metrics = {'peak_rss_mb': peak_rss_mb()}
+            for name, sequence_runs in runs.items():
+                metrics['{0}_wall_s'.format(name)] = statistics.median(run.wall for run in sequence_runs)
+                metrics['{0}_cycle_s'.format(name)] = statistics.median(run.cycle for run in sequence_runs)
+            heater_events = [run.callbacks[HEATER_EVENT_CALLBACK] for run in runs['heater']]
+            metrics['heater_event_cpu_us'] = 1e6 * sum(stats.cpu_total for stats in heater_events) / \
+                max(1, sum(stats.calls for stats in heater_events))
+            metrics['ble_check_s'] = statistics.median(run.callbacks[BLE_CHECK_CALLBACK].wall_max
+                                                       for run in runs['smoke'])
+            smoke_module = amira_emulator.load_test_script(smoke_script, amira_emulator.ScriptedOperator(
+                [amira_emulator.EMULATOR_WIRELESS_ID]))
+            close_test_script(smoke_module)
+            metrics['csv_rows_per_s'] = benchmark_csv_rows(smoke_module, work_dir)
+            metrics['plot_render_s'] = benchmark_plot(work_dir, None)
+            metrics['plot_render_decimated_s'] = benchmark_plot(work_dir, heater_plotting.HEATER_PLOT_BUCKETS)
+        finally:
+            os.chdir(cwd)
+    # a metric that can't be measured would silently drop out of the comparison with the baseline
+    unmeasured = [name for name in BENCHMARK_METRICS if metrics.get(name) is None]
+    if unmeasured:
+        raise RuntimeError('{0} could not be measured on {1}'.format(', '.join(unmeasured), platform.platform()))
+    return {'created': datetime.today().isoformat(timespec='seconds'), 'platform': platform.platform(),
+            'python': platform.python_version(), 'soakRuns': soak_runs,
+            'metrics': {name: None if value is None else round(value, 4) for name, value in metrics.items()}}
+
+
+def compare(results: dict, baseline: dict, tolerance: float = BENCHMARK_TOLERANCE) -> List[str]:
+    """
+    This routine compares benchmark results with a baseline.
+
+    :param results: Benchmark results (see run_benchmarks()).
+    :param baseline: Baseline benchmark results.
+    :param tolerance: Fraction of the baseline value a metric may be worse by.
+    :return: List with a description of every regression - empty if there is none.
+    """
+    regressions = []
+    for name, metric in BENCHMARK_METRICS.items():
+        value = results['metrics'].get(name)
+        base = baseline['metrics'].get(name)
+        if value is None and base is not None:
+            regressions.append('{0}: not measured against a baseline of {1} {2} ({3})'.format(
+                name, base, metric.unit, metric.description))
+            continue
+        if value is None or base is None:
+            continue
+        worse_by = base - value if metric.higher_is_better else value - base
+        if worse_by > tolerance * abs(base) and worse_by > metric.slack:
+            regressions.append('{0}: {1} {2} against a baseline of {3} {2} ({4})'.format(
+                name, value, metric.unit, base, metric.description))
+    return regressions
+
+
+def format_results(results: dict, baseline: Optional[dict] = None) -> str:
+    """
+    This routine formats benchmark results as a table.
+
+    :param results: Benchmark results (see run_benchmarks()).
+    :param baseline: Baseline benchmark results or None.
+    :return: Table text.
+    """
+    lines = ['{0:<26} {1:>12} {2:>12} {3:>8}  {4}'.format('metric', 'value', 'baseline', 'change', 'unit')]
+    for name, metric in BENCHMARK_METRICS.items():
+        value = results['metrics'].get(name)
+        base = None if baseline is None else baseline['metrics'].get(name)
+        change = '' if value is None or not base else '{0:+.0%}'.format((value - base) / base)
+        lines.append('{0:<26} {1:>12} {2:>12} {3:>8}  {4}'.format(
+            name, '-' if value is None else value, '-' if base is None else base, change, metric.unit))
+    return '\n'.join(lines)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """
+    This routine runs the benchmark suite and compares the results with the baseline.
+
+    :param argv: Command line arguments - defaults to sys.argv.
+    :return: Process exit code - 1 if a metric regressed or a sequence failed.
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the test scripts against the Amira emulator.')
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON file the results are written to')
+    parser.add_argument('--baseline', default=BENCHMARK_BASELINE_FILENAME, help='JSON file of the baseline results')
+    parser.add_argument('--update-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--soak-runs', type=int, default=BENCHMARK_SOAK_RUNS)
+    parser.add_argument('--tolerance', type=float, default=BENCHMARK_TOLERANCE,
+                        help='fraction of the baseline value a metric may be worse by')
+    parser.add_argument('--log', help='file the log of the test scripts is written to')
+    args = parser.parse_args(argv)
+    output = os.path.abspath(args.output)
+    baseline_filename = os.path.abspath(args.baseline)
+    if args.log:
+        log.startLogging(open(args.log, 'w'), setStdout=False)
+
+    try:
+        results = run_benchmarks(args.soak_runs)
+    except RuntimeError as error:
+        print('benchmark failed: {0}'.format(error))
+        return 1
+    with open(output, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+
+    baseline = None
+    if os.path.exists(baseline_filename) and not args.update_baseline:
+        with open(baseline_filename) as baseline_file:
+            baseline = json.load(baseline_file)
+    print(format_results(results, baseline))
+    print('results written to {0}'.format(output))
+    if args.update_baseline:
+        with open(baseline_filename, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+        print('baseline written to {0}'.format(baseline_filename))
+        return 0
+    if baseline is None:
+        print('no baseline {0} - run with --update-baseline to record one'.format(baseline_filename))
+        return 0
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print('REGRESSION {0}'.format(regression))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
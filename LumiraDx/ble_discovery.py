@@ -0,0 +1,276 @@
+"""
+ble_discovery.py
+
+This module scans for the BLE advertisements of an Amira in the background.  The scan runs on its own thread with its
+own asyncio event loop so it never blocks the twisted reactor that runs the test sequence, and it stops as soon as
+the advertisement of the expected unit has been seen.  If a shared BLE scan service (see ble_scan_service.py) is
+running, it's asked first and the local scan is only used when the service can't be reached.
+
+@copyright LumiraDx, 2021. All rights reserved. This code is provided on an
+           "AS IS" basis. LumiraDx DISCLAIMS ALL WARRANTIES, TERMS AND
+           CONDITIONS WITH RESPECT TO THE CODE, EXPRESS, IMPLIED, STATUTORY
+           OR OTHERWISE, INCLUDING WARRANTIES, TERMS OR CONDITIONS OF
+           MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NONINFRINGEMENT
+           AND SATISFACTORY QUALITY. TO THE FULL EXTENT ALLOWED BY LAW,
+           LUMIRADX ALSO EXCLUDES ANY LIABILITY, WHETHER BASED IN CONTRACT
+           OR TORT (INCLUDING NEGLIGENCE), FOR INCIDENTAL, CONSEQUENTIAL,
+           INDIRECT, SPECIAL OR PUNITIVE DAMAGES OF ANY KIND, OR FOR LOSS
+           OF REVENUE OR PROFITS, LOSS OF BUSINESS, LOSS OF INFORMATION OR
+           DATA, OR OTHER FINANCIAL LOSS ARISING OUT OF OR IN CONNECTION
+           WITH THE USE OR PERFORMANCE OF THE CODE.
+"""
+
+import asyncio
+import logging
+import re
+import threading
+import time
+from typing import NamedTuple, Optional, Tuple
+
+from bleak import BleakScanner
+from twisted.python import log
+
+
+# maximum time in seconds to scan for the expected unit - the scan stops early once it has been seen
+BLE_SCAN_TIMEOUT_S = 30.0
+
+# name all Amira advertisements contain
+AMIRA_NAME = 'Amira'
+
+# the advertised name of a unit ends with the last AMIRA_NAME_SUFFIX_LENGTH characters of its wireless ID
+AMIRA_NAME_SUFFIX_LENGTH = 3
+
+# regular expression the advertised name of a unit has to match (case insensitive), with {name} replaced by AMIRA_NAME
+# and {suffix} by the end of the unit's wireless ID - only the suffix at the end of an Amira name is known from the
+# advertisements of real units, so anything may come between them.  Tighten it (i.e. to r'^{name}[\s_-]*{suffix}$')
+# once the exact name format has been confirmed against a real advertisement
+AMIRA_NAME_PATTERN = r'{name}.*{suffix}$'
+
+# Bluetooth SIG company identifier in the manufacturer data of the Amira advertisements or None to not check it
+AMIRA_COMPANY_ID = None
+
+# advertisements received weaker than this (in dBm) are ignored - the unit in the dock is close to the scanner so a
+# weak advertisement is from a neighbouring station
+BLE_MIN_RSSI_DBM = -75
+
+
+def amira_name_pattern(wireless_id: str) -> re.Pattern:
+    """
+    This routine builds the regular expression of the advertised name of the unit with the given wireless ID from
+    AMIRA_NAME_PATTERN.
+
+    :param wireless_id: Full wireless ID of the unit (i.e. the 'wirelessIdFull' of "mfg getwid").
+    :return: Compiled regular expression that is searched for in the advertised name.
+    """
+    suffix = str(wireless_id)[-AMIRA_NAME_SUFFIX_LENGTH:]
+    return re.compile(AMIRA_NAME_PATTERN.format(name=re.escape(AMIRA_NAME), suffix=re.escape(suffix)),
+                      re.IGNORECASE)
+
+
+def is_amira_match(name: Optional[str], wireless_id: str, manufacturer_data: Optional[dict] = None) -> bool:
+    """
+    This routine checks whether an advertisement is the one of the unit with the given wireless ID - the advertised
+    name has to match AMIRA_NAME_PATTERN, and the manufacturer data has to have the Amira company identifier if it's
+    configured.
+
+    :param name: Advertised name of the device.
+    :param wireless_id: Full wireless ID of the unit (i.e. the 'wirelessIdFull' of "mfg getwid").
+    :param manufacturer_data: Manufacturer data of the advertisement keyed by company identifier or None if unknown.
+    :return: True if the advertisement is the one of the unit.
+    """
+    if not name or not amira_name_pattern(wireless_id).search(name):
+        return False
+    return AMIRA_COMPANY_ID is None or manufacturer_data is None or AMIRA_COMPANY_ID in manufacturer_data
+
+
+class BleDiscoveryResult(NamedTuple):
+    """
+    Advertisement of the unit found by a BLE discovery.
+    """
+    description: str
+    rssi: Optional[int]
+    discovery_time: float
+
+
+class BleDiscovery(object):
+    """
+    This class scans for the advertisement of one unit on a background thread and measures the RSSI of the
+    advertisement and the time it took to discover it.  The result is published once as an immutable
+    BleDiscoveryResult, so a reader never sees a partially recorded advertisement.
+    """
+
+    def __init__(self, wireless_id: str, scan_timeout: float = BLE_SCAN_TIMEOUT_S,
+                 service_address: Optional[Tuple[str, int]] = None, min_rssi: Optional[int] = BLE_MIN_RSSI_DBM):
+        """
+        Class initializer.
+
+        :param wireless_id: Full wireless ID of the unit to scan for.
+        :param scan_timeout: Maximum time in seconds to scan.
+        :param service_address: (host, port) of the shared BLE scan service to ask first or None to always scan.
+        :param min_rssi: Advertisements weaker than this (in dBm) are ignored or None to accept any signal strength.
+        """
+        self.wireless_id = wireless_id
+        self.scan_timeout = scan_timeout
+        self.service_address = service_address
+        self.min_rssi = min_rssi
+        self.first_amira_description = None  # type: Optional[str]
+        self._result = None  # type: Optional[BleDiscoveryResult]
+        self._closed = False
+        self._lock = threading.Lock()
+        self._start_time = None  # type: Optional[float]
+        self._done = threading.Event()
+        self._thread = None  # type: Optional[threading.Thread]
+        self._loop = None  # type: Optional[asyncio.AbstractEventLoop]
+        self._found = None  # type: Optional[asyncio.Event]
+
+    def start(self) -> None:
+        """
+        This routine starts the scan on a background thread.  Calling it again while a scan is running does nothing.
+
+        :return: None
+        """
+        if self._thread is not None:
+            return
+        self._start_time = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name='ble-discovery', daemon=True)
+        self._thread.start()
+
+    @property
+    def result(self) -> Optional[BleDiscoveryResult]:
+        """
+        This routine returns the advertisement of the unit found so far.
+
+        :return: Advertisement of the unit or None if it hasn't been seen.
+        """
+        with self._lock:
+            return self._result
+
+    def wait(self, timeout: Optional[float] = None) -> Optional[BleDiscoveryResult]:
+        """
+        This routine waits for the scan to find the unit or finish.  If the wait times out the discovery is closed:
+        the scan is stopped and an advertisement seen afterwards is no longer recorded, so the returned result is
+        final.
+
+        :param timeout: Maximum time in seconds to wait or None to wait for the scan to finish.
+        :return: Advertisement of the unit or None if the unit wasn't seen.
+        """
+        self.start()
+        if not self._done.wait(timeout):
+            log.msg('BLE discovery: no result for {0} after waiting {1} seconds'.format(self.wireless_id, timeout),
+                    logLevel=logging.INFO)
+            self.stop()
+        with self._lock:
+            self._closed = True
+            result = self._result
+        if result is None and self.first_amira_description is not None:
+            # another unit is never reported as this one, but it tells a dead radio apart from a wrong wireless ID
+            log.msg('BLE discovery: {0} not seen, first Amira seen was {1}'.format(
+                self.wireless_id, self.first_amira_description), logLevel=logging.INFO)
+        return result
+
+    def stop(self) -> None:
+        """
+        This routine stops a running local scan early.  A query of the scan service can't be interrupted, its answer
+        is dropped instead once the discovery has been closed by wait().
+
+        :return: None
+        """
+        loop, found = self._loop, self._found
+        if loop is not None and found is not None:
+            try:
+                loop.call_soon_threadsafe(found.set)
+            except RuntimeError:
+                # the scan has already finished and closed its loop
+                pass
+
+    def _found_device(self, address: str, name: str, rssi: Optional[int]) -> None:
+        """
+        This routine records the advertisement of the unit.
+
+        :param address: Address of the unit.
+        :param name: Advertised name of the unit.
+        :param rssi: Received signal strength in dBm or None if unknown.
+        :return: None
+        """
+        with self._lock:
+            if self._result is None and not self._closed:
+                self._result = BleDiscoveryResult('{0}: {1}'.format(address, name), rssi,
+                                                  time.monotonic() - self._start_time)
+
+    def _detection_callback(self, device, advertisement_data) -> None:
+        """
+        This routine is called by the scanner on the scan thread for every received advertisement.
+
+        :param device: BLEDevice that sent the advertisement.
+        :param advertisement_data: AdvertisementData of the advertisement.
+        :return: None
+        """
+        name = getattr(advertisement_data, 'local_name', None) or device.name
+        if not name or AMIRA_NAME.lower() not in name.lower():
+            return
+        if self.first_amira_description is None:
+            self.first_amira_description = '{0}: {1}'.format(device.address, name)
+        rssi = getattr(advertisement_data, 'rssi', None)
+        if self.min_rssi is not None and rssi is not None and rssi < self.min_rssi:
+            return
+        if self.result is None and \
+                is_amira_match(name, self.wireless_id, getattr(advertisement_data, 'manufacturer_data', None)):
+            self._found_device(device.address, name, rssi)
+            self._found.set()
+
+    async def _scan(self) -> None:
+        """
+        This routine scans until the unit has been found or the scan times out.
+
+        :return: None
+        """
+        self._found = asyncio.Event()
+        scanner = BleakScanner(detection_callback=self._detection_callback)
+        await scanner.start()
+        try:
+            await asyncio.wait_for(self._found.wait(), self.scan_timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            await scanner.stop()
+
+    def _query_service(self) -> bool:
+        """
+        This routine asks the shared BLE scan service for the advertisement of the unit.
+
+        :return: True if the service answered, False if it couldn't be reached and a local scan is needed.
+        """
+        # imported here since the service module imports this one
+        import ble_scan_service
+        host, port = self.service_address
+        try:
+            device = ble_scan_service.query_ble_scan_service(self.wireless_id, self.scan_timeout, host, port,
+                                                             min_rssi=self.min_rssi)
+        except (OSError, ValueError) as error:
+            log.msg('BLE discovery: scan service {0}:{1} not available ({2}) - scanning locally'.format(
+                host, port, error), logLevel=logging.INFO)
+            return False
+        if device is not None:
+            self._found_device(device['address'], device['name'], device['rssi'])
+        return True
+
+    def _run(self) -> None:
+        """
+        This routine is the body of the scan thread.
+
+        :return: None
+        """
+        if self.service_address is not None and self._query_service():
+            self._done.set()
+            log.msg('BLE discovery: {0} -> {1} (scan service)'.format(self.wireless_id, self.result),
+                    logLevel=logging.INFO)
+            return
+        self._loop = asyncio.new_event_loop()
+        try:
+            self._loop.run_until_complete(self._scan())
+        except Exception as error:
+            log.msg('BLE discovery: scan failed: {0}'.format(error), logLevel=logging.ERROR)
+        finally:
+            self._loop.close()
+            self._done.set()
+        log.msg('BLE discovery: {0} -> {1}'.format(self.wireless_id, self.result), logLevel=logging.INFO)
@@ -0,0 +1,279 @@
+"""
+ble_scan_service.py
+
+This module is a local BLE scanning service for labs with several smoke test stations side by side.  One process runs
+a single continuous BLE scan and keeps a cache of the Amira advertisements it has seen in the last BLE_SCAN_CACHE_TTL_S
+seconds, keyed by address and name.  The stations query it over a local socket with the wireless ID of their unit
+instead of each running its own scan, so queries are answered from the cache and the stations no longer compete for
+the radio.
+
+The protocol is one JSON object per line.  The request is {"wirelessId": "<wirelessIdFull>", "wait": <seconds>,
+"minRssi": <dBm or null>} and the service answers {"device": {"address": ..., "name": ..., "rssi": ..., "age": ...}} as soon as a matching
+advertisement is in the cache, or {"device": null} if none has been seen within the wait time.
+
+Run the service with:  python ble_scan_service.py [--host 127.0.0.1] [--port 47800] [--ttl 30]
+
+@copyright LumiraDx, 2021. All rights reserved. This code is provided on an
+           "AS IS" basis. LumiraDx DISCLAIMS ALL WARRANTIES, TERMS AND
+           CONDITIONS WITH RESPECT TO THE CODE, EXPRESS, IMPLIED, STATUTORY
+           OR OTHERWISE, INCLUDING WARRANTIES, TERMS OR CONDITIONS OF
+           MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NONINFRINGEMENT
+           AND SATISFACTORY QUALITY. TO THE FULL EXTENT ALLOWED BY LAW,
+           LUMIRADX ALSO EXCLUDES ANY LIABILITY, WHETHER BASED IN CONTRACT
+           OR TORT (INCLUDING NEGLIGENCE), FOR INCIDENTAL, CONSEQUENTIAL,
+           INDIRECT, SPECIAL OR PUNITIVE DAMAGES OF ANY KIND, OR FOR LOSS
+           OF REVENUE OR PROFITS, LOSS OF BUSINESS, LOSS OF INFORMATION OR
+           DATA, OR OTHER FINANCIAL LOSS ARISING OUT OF OR IN CONNECTION
+           WITH THE USE OR PERFORMANCE OF THE CODE.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import socket
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+from twisted.python import log
+
+import ble_discovery
+
+
+# address the service listens on - local connections only
+BLE_SCAN_SERVICE_HOST = '127.0.0.1'
+BLE_SCAN_SERVICE_PORT = 47800
+
+# seconds an advertisement stays in the cache after it was last seen
+BLE_SCAN_CACHE_TTL_S = 30.0
+
+# seconds a client waits to connect to the service before falling back to its own scan
+BLE_SCAN_SERVICE_CONNECT_TIMEOUT_S = 1.0
+
+
+class BleAdvertisementCache(object):
+    """
+    This class is the cache of the Amira advertisements seen by the service, keyed by address and name.
+    """
+
+    def __init__(self, ttl: float = BLE_SCAN_CACHE_TTL_S):
+        """
+        Class initializer.
+
+        :param ttl: Seconds an advertisement stays in the cache after it was last seen.
+        """
+        self.ttl = ttl
+        self._entries = {}  # type: Dict[Tuple[str, str], dict]
+        self._changed = asyncio.Event()
+
+    def add(self, address: str, name: str, rssi: Optional[int], manufacturer_data: Optional[dict] = None,
+            now: Optional[float] = None) -> None:
+        """
+        This routine adds or refreshes an advertisement and wakes up the waiting queries.
+
+        :param address: Address of the device.
+        :param name: Advertised name of the device.
+        :param rssi: Received signal strength in dBm or None if unknown.
+        :param manufacturer_data: Manufacturer data of the advertisement keyed by company identifier or None.
+        :param now: Monotonic time of the advertisement - defaults to now.
+        :return: None
+        """
+        now = time.monotonic() if now is None else now
+        entry = self._entries.setdefault((address, name), {'address': address, 'name': name, 'firstSeen': now})
+        entry['rssi'] = rssi
+        entry['manufacturerData'] = manufacturer_data
+        entry['lastSeen'] = now
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def expire(self, now: Optional[float] = None) -> None:
+        """
+        This routine removes the advertisements that have not been seen within the TTL.
+
+        :param now: Monotonic time - defaults to now.
+        :return: None
+        """
+        now = time.monotonic() if now is None else now
+        for key in [key for key, entry in self._entries.items() if now - entry['lastSeen'] > self.ttl]:
+            del self._entries[key]
+
+    def find(self, wireless_id: str, min_rssi: Optional[int] = None, now: Optional[float] = None) -> Optional[dict]:
+        """
+        This routine finds the most recently seen advertisement of the unit with the given wireless ID.
+
+        :param wireless_id: Full wireless ID of the unit.
+        :param min_rssi: Advertisements last received weaker than this (in dBm) are ignored or None.
+        :param now: Monotonic time - defaults to now.
+        :return: Dictionary with the address, name, rssi and age in seconds of the advertisement or None.
+        """
+        now = time.monotonic() if now is None else now
+        self.expire(now)
+        matches = [entry for entry in self._entries.values()
+                   if ble_discovery.is_amira_match(entry['name'], wireless_id, entry['manufacturerData']) and
+                   (min_rssi is None or entry['rssi'] is None or entry['rssi'] >= min_rssi)]
+        if not matches:
+            return None
+        entry = max(matches, key=lambda match: match['lastSeen'])
+        return {'address': entry['address'], 'name': entry['name'], 'rssi': entry['rssi'],
+                'age': round(now - entry['lastSeen'], 3)}
+
+    async def wait_for(self, wireless_id: str, timeout: float, min_rssi: Optional[int] = None) -> Optional[dict]:
+        """
+        This routine waits until an advertisement of the unit with the given wireless ID is in the cache.
+
+        :param wireless_id: Full wireless ID of the unit.
+        :param timeout: Maximum time in seconds to wait.
+        :param min_rssi: Advertisements last received weaker than this (in dBm) are ignored or None.
+        :return: Dictionary with the advertisement (see find()) or None if it hasn't been seen within the timeout.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            device = self.find(wireless_id, min_rssi)
+            remaining = deadline - time.monotonic()
+            if device is not None or remaining <= 0:
+                return device
+            try:
+                await asyncio.wait_for(self._changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class BleScanService(object):
+    """
+    This class runs the continuous BLE scan and answers the queries of the stations.
+    """
+
+    def __init__(self, host: str = BLE_SCAN_SERVICE_HOST, port: int = BLE_SCAN_SERVICE_PORT,
+                 ttl: float = BLE_SCAN_CACHE_TTL_S):
+        """
+        Class initializer.
+
+        :param host: Address the service listens on.
+        :param port: Port the service listens on.
+        :param ttl: Seconds an advertisement stays in the cache after it was last seen.
+        """
+        self.host = host
+        self.port = port
+        self.cache = BleAdvertisementCache(ttl)
+
+    def _detection_callback(self, device, advertisement_data) -> None:
+        """
+        This routine is called by the scanner for every received advertisement.
+
+        :param device: BLEDevice that sent the advertisement.
+        :param advertisement_data: AdvertisementData of the advertisement.
+        :return: None
+        """
+        name = getattr(advertisement_data, 'local_name', None) or device.name
+        if name and ble_discovery.AMIRA_NAME.lower() in name.lower():
+            self.cache.add(device.address, name, getattr(advertisement_data, 'rssi', None),
+                           getattr(advertisement_data, 'manufacturer_data', None))
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        This routine answers the queries of one station connection.
+
+        :param reader: Stream of the requests.
+        :param writer: Stream of the responses.
+        :return: None
+        """
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    min_rssi = request.get('minRssi')
+                    device = await self.cache.wait_for(str(request['wirelessId']), float(request.get('wait', 0)),
+                                                       None if min_rssi is None else int(min_rssi))
+                    response = {'device': device}
+                except (ValueError, KeyError, TypeError) as error:
+                    response = {'error': str(error)}
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def run(self) -> None:
+        """
+        This routine runs the scan and the socket server until the process is stopped.  The server is started first
+        so a port that is already in use (i.e. by a second instance of the service) fails before the radio is taken.
+
+        :return: None
+        :raises OSError: If the server can't listen on the port.
+        """
+        server = await asyncio.start_server(self._handle_client, self.host, self.port)
+        async with server:
+            scanner = ble_discovery.BleakScanner(detection_callback=self._detection_callback)
+            await scanner.start()
+            log.msg('BLE scan service: listening on {0}:{1}'.format(self.host, self.port), logLevel=logging.INFO)
+            try:
+                while True:
+                    await asyncio.sleep(self.cache.ttl)
+                    self.cache.expire()
+            finally:
+                await scanner.stop()
+
+
+def query_ble_scan_service(wireless_id: str, wait: float, host: str = BLE_SCAN_SERVICE_HOST,
+                           port: int = BLE_SCAN_SERVICE_PORT,
+                           connect_timeout: float = BLE_SCAN_SERVICE_CONNECT_TIMEOUT_S,
+                           min_rssi: Optional[int] = None) -> Optional[dict]:
+    """
+    This routine asks the BLE scan service for the advertisement of a unit.
+
+    :param wireless_id: Full wireless ID of the unit.
+    :param wait: Maximum time in seconds the service waits for the advertisement.
+    :param host: Address of the service.
+    :param port: Port of the service.
+    :param connect_timeout: Maximum time in seconds to wait to connect to the service.
+    :param min_rssi: Advertisements weaker than this (in dBm) are ignored or None to accept any signal strength.
+    :return: Dictionary with the address, name, rssi and age of the advertisement or None if the service hasn't
+             seen it.
+    :raises OSError: If the service can't be reached.
+    """
+    with socket.create_connection((host, port), timeout=connect_timeout) as connection:
+        connection.settimeout(wait + connect_timeout)
+        connection.sendall(json.dumps({'wirelessId': wireless_id, 'wait': wait, 'minRssi': min_rssi}).encode() + b'\n')
+        response = b''
+        while not response.endswith(b'\n'):
+            data = connection.recv(4096)
+            if not data:
+                raise ConnectionError('BLE scan service closed the connection')
+            response += data
+    response = json.loads(response)
+    if 'error' in response:
+        raise ValueError('BLE scan service: {0}'.format(response['error']))
+    return response['device']
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """
+    This routine runs the BLE scan service.
+
+    :param argv: Command line arguments - defaults to sys.argv.
+    :return: Process exit code.
+    """
+    parser = argparse.ArgumentParser(description='Shared BLE scan service for smoke test stations.')
+    parser.add_argument('--host', default=BLE_SCAN_SERVICE_HOST)
+    parser.add_argument('--port', type=int, default=BLE_SCAN_SERVICE_PORT)
+    parser.add_argument('--ttl', type=float, default=BLE_SCAN_CACHE_TTL_S,
+                        help='seconds an advertisement stays in the cache after it was last seen')
+    args = parser.parse_args(argv)
+    log.startLogging(sys.stdout)
+    try:
+        asyncio.run(BleScanService(args.host, args.port, args.ttl).run())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
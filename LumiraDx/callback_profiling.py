@@ -0,0 +1,296 @@
+"""
+callback_profiling.py
+
+This module profiles the custom callbacks of a test sequence.  The parsers, generators and handlers of the test steps
+run inline on the event path of the test engine, so a slow one delays every event and response behind it.
+CallbackProfiler wraps every callback registered in a test_step_list and records the number of calls, the cumulative
+and maximum wall and CPU time and the memory allocated by each callback, and prints a summary at the end of the run.
+It also runs a sampling profiler that records the stacks of all threads of the process and dumps them on demand in
+collapsed stack format (one "frame;frame;frame count" line per stack, the input of the usual flame graph tools).
+
+A dump is requested by creating the file PROFILE_DUMP_REQUEST_FILENAME in the profile directory (or with SIGUSR1 on
+platforms that have it) - the request file is removed once the dump has been written.
+
+@copyright LumiraDx, 2021. All rights reserved. This code is provided on an
+           "AS IS" basis. LumiraDx DISCLAIMS ALL WARRANTIES, TERMS AND
+           CONDITIONS WITH RESPECT TO THE CODE, EXPRESS, IMPLIED, STATUTORY
+           OR OTHERWISE, INCLUDING WARRANTIES, TERMS OR CONDITIONS OF
+           MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NONINFRINGEMENT
+           AND SATISFACTORY QUALITY. TO THE FULL EXTENT ALLOWED BY LAW,
+           LUMIRADX ALSO EXCLUDES ANY LIABILITY, WHETHER BASED IN CONTRACT
+           OR TORT (INCLUDING NEGLIGENCE), FOR INCIDENTAL, CONSEQUENTIAL,
+           INDIRECT, SPECIAL OR PUNITIVE DAMAGES OF ANY KIND, OR FOR LOSS
+           OF REVENUE OR PROFITS, LOSS OF BUSINESS, LOSS OF INFORMATION OR
+           DATA, OR OTHER FINANCIAL LOSS ARISING OUT OF OR IN CONNECTION
+           WITH THE USE OR PERFORMANCE OF THE CODE.
+"""
+
+import csv
+import functools
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+from twisted.python import log
+
+
+# seconds between two samples of the sampling profiler
+PROFILE_SAMPLE_INTERVAL_S = 0.01
+
+# frames kept from the innermost frame of each sampled stack
+PROFILE_MAX_STACK_DEPTH = 40
+
+# a dump of the sampling profiler is written when this file appears in the profile directory
+PROFILE_DUMP_REQUEST_FILENAME = 'dump.request'
+
+# columns of the callback summary file
+CALLBACK_PROFILE_HEADER = ['callback', 'calls', 'wall_total_s', 'wall_max_s', 'cpu_total_s', 'cpu_max_s',
+                           'alloc_total_bytes', 'alloc_max_bytes']
+
+
+def callback_name(callback: Callable) -> str:
+    """
+    This routine names a callback for the summary - the qualified name of the function or method, so a method that
+    is registered on many steps is counted once.
+
+    :param callback: Callback of a test step.
+    :return: Name of the callback.
+    """
+    while isinstance(callback, functools.partial):
+        callback = callback.func
+    return getattr(callback, '__qualname__', None) or repr(callback)
+
+
+class CallbackStats(object):
+    """
+    This class holds the statistics of one callback.
+    """
+
+    def __init__(self, name: str):
+        """
+        Class initializer.
+
+        :param name: Name of the callback.
+        """
+        self.name = name
+        self.calls = 0
+        self.wall_total = 0.0
+        self.wall_max = 0.0
+        self.cpu_total = 0.0
+        self.cpu_max = 0.0
+        self.alloc_total = 0
+        self.alloc_max = 0
+
+    def add(self, wall: float, cpu: float, allocated: int) -> None:
+        """
+        This routine adds one call of the callback.
+
+        :param wall: Wall time of the call in seconds.
+        :param cpu: CPU time of the call in seconds.
+        :param allocated: Peak memory in bytes the call allocated on top of what was allocated before it.
+        :return: None
+        """
+        self.calls += 1
+        self.wall_total += wall
+        self.wall_max = max(self.wall_max, wall)
+        self.cpu_total += cpu
+        self.cpu_max = max(self.cpu_max, cpu)
+        self.alloc_total += allocated
+        self.alloc_max = max(self.alloc_max, allocated)
+
+    def row(self) -> list:
+        """
+        This routine builds the row of the callback in the summary file.
+
+        :return: List of the values of CALLBACK_PROFILE_HEADER.
+        """
+        return [self.name, self.calls, round(self.wall_total, 6), round(self.wall_max, 6), round(self.cpu_total, 6),
+                round(self.cpu_max, 6), self.alloc_total, self.alloc_max]
+
+
+class CallbackProfiler(object):
+    """
+    This class profiles the custom callbacks of a test sequence and samples the stacks of the process.
+    """
+
+    def __init__(self, profile_dir: str, trace_allocations: bool = True,
+                 sample_interval: Optional[float] = PROFILE_SAMPLE_INTERVAL_S):
+        """
+        Class initializer.
+
+        :param profile_dir: Directory the summary and the sampling profiler dumps are written to.
+        :param trace_allocations: True to measure the allocations of the callbacks with tracemalloc - it slows down
+                                  the whole process while the run is profiled.
+        :param sample_interval: Seconds between two samples of the sampling profiler or None to not sample.
+        """
+        self.profile_dir = profile_dir
+        self.trace_allocations = trace_allocations
+        self.sample_interval = sample_interval
+        self.stats = {}  # type: Dict[str, CallbackStats]
+        self.samples = Counter()  # type: Counter
+        self.started = datetime.today()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._dump_requested = threading.Event()
+        self._sampler = None  # type: Optional[threading.Thread]
+
+    def instrument(self, test_step_list: List[dict]) -> List[dict]:
+        """
+        This routine builds a copy of a list of test steps with every custom callback profiled.
+
+        :param test_step_list: List of test steps.
+        :return: List of profiled test steps.
+        """
+        profiled_steps = []
+        for step in test_step_list:
+            profiled = dict(step)
+            for key, value in step.items():
+                if key.startswith('custom') and callable(value):
+                    profiled[key] = self.wrap(value)
+            profiled_steps.append(profiled)
+        return profiled_steps
+
+    def wrap(self, callback: Callable) -> Callable:
+        """
+        This routine wraps one callback with the profiling.
+
+        :param callback: Callback of a test step.
+        :return: Profiled callback.
+        """
+        stats = self.stats.setdefault(callback_name(callback), CallbackStats(callback_name(callback)))
+
+        @functools.wraps(callback)
+        def profiled_callback(*args, **kwargs):
+            tracing = self.trace_allocations and tracemalloc.is_tracing()
+            if tracing:
+                allocated_before = tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+            cpu_start = time.thread_time()
+            wall_start = time.perf_counter()
+            try:
+                return callback(*args, **kwargs)
+            finally:
+                wall = time.perf_counter() - wall_start
+                cpu = time.thread_time() - cpu_start
+                allocated = max(0, tracemalloc.get_traced_memory()[1] - allocated_before) if tracing else 0
+                with self._lock:
+                    stats.add(wall, cpu, allocated)
+
+        return profiled_callback
+
+    def start(self) -> None:
+        """
+        This routine starts the allocation tracing, the sampling profiler and the dump request handling.
+
+        :return: None
+        """
+        if self.trace_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if hasattr(signal, 'SIGUSR1') and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGUSR1, lambda _signum, _frame: self._dump_requested.set())
+        if self.sample_interval is not None and self._sampler is None:
+            self._sampler = threading.Thread(target=self._sample, name='callback-profiler', daemon=True)
+            self._sampler.start()
+
+    def _sample(self) -> None:
+        """
+        This routine is the body of the sampling thread - it records the stack of every other thread at each
+        interval and writes a dump when one is requested.
+
+        :return: None
+        """
+        request_filename = os.path.join(self.profile_dir, PROFILE_DUMP_REQUEST_FILENAME)
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.sample_interval):
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < PROFILE_MAX_STACK_DEPTH:
+                    code = frame.f_code
+                    stack.append('{0} ({1}:{2})'.format(code.co_name, os.path.basename(code.co_filename),
+                                                        code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(thread_names.get(thread_id, str(thread_id)))
+                with self._lock:
+                    self.samples[';'.join(reversed(stack))] += 1
+            if self._dump_requested.is_set() or os.path.exists(request_filename):
+                self._dump_requested.clear()
+                self.dump()
+                if os.path.exists(request_filename):
+                    os.remove(request_filename)
+
+    def dump(self) -> str:
+        """
+        This routine writes the stacks sampled so far in collapsed stack format.
+
+        :return: Name of the dump file.
+        """
+        os.makedirs(self.profile_dir, exist_ok=True)
+        dump_filename = os.path.join(self.profile_dir, 'samples_{0}.txt'.format(
+            datetime.today().strftime('%Y-%m-%d_%H-%M-%S')))
+        with self._lock:
+            samples = self.samples.most_common()
+        with open(dump_filename, 'w') as dump_file:
+            for stack, count in samples:
+                dump_file.write('{0} {1}\n'.format(stack, count))
+        log.msg('callback profiler: {0} samples written to {1}'.format(sum(count for _, count in samples),
+                                                                      dump_filename), logLevel=logging.INFO)
+        return dump_filename
+
+    def summary(self) -> List[CallbackStats]:
+        """
+        This routine builds the summary of the callbacks that have been called.
+
+        :return: Statistics of the callbacks, the one with the most cumulative wall time first.
+        """
+        with self._lock:
+            return sorted([stats for stats in self.stats.values() if stats.calls],
+                          key=lambda stats: stats.wall_total, reverse=True)
+
+    def format_summary(self) -> str:
+        """
+        This routine formats the summary as a table.
+
+        :return: Table text.
+        """
+        lines = ['{0:<60} {1:>7} {2:>10} {3:>9} {4:>10} {5:>9} {6:>12} {7:>11}'.format(
+            'callback', 'calls', 'wall s', 'max ms', 'cpu s', 'max ms', 'alloc kB', 'max kB')]
+        for stats in self.summary():
+            lines.append('{0:<60} {1:>7} {2:>10.3f} {3:>9.1f} {4:>10.3f} {5:>9.1f} {6:>12.1f} {7:>11.1f}'.format(
+                stats.name[:60], stats.calls, stats.wall_total, stats.wall_max * 1000, stats.cpu_total,
+                stats.cpu_max * 1000, stats.alloc_total / 1024, stats.alloc_max / 1024))
+        return '\n'.join(lines)
+
+    def close(self) -> None:
+        """
+        This routine stops the profiling at the end of the run, logs the summary and writes it and the sampling
+        profiler dump to the profile directory.
+
+        :return: None
+        """
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+            self._sampler = None
+        if self.trace_allocations and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        os.makedirs(self.profile_dir, exist_ok=True)
+        summary_filename = os.path.join(self.profile_dir, 'callbacks_{0}.csv'.format(
+            self.started.strftime('%Y-%m-%d_%H-%M-%S')))
+        with open(summary_filename, 'w', newline='') as summary_file:
+            writer = csv.writer(summary_file)
+            writer.writerow(CALLBACK_PROFILE_HEADER)
+            writer.writerows(stats.row() for stats in self.summary())
+        log.msg('callback profiler: summary written to {0}\n{1}'.format(summary_filename, self.format_summary()),
+                logLevel=logging.INFO)
+        if self.samples:
+            self.dump()
@@ -0,0 +1,227 @@
+"""
+heater_analysis.py
+
+This module contains the vectorized stabilization and settling-time analysis of heater temperature data.  It is used
+by the heater calibration script on the live run and can be used on archived heater .csv files.
+
+@copyright LumiraDx, 2021. All rights reserved. This code is provided on an
+           "AS IS" basis. LumiraDx DISCLAIMS ALL WARRANTIES, TERMS AND
+           CONDITIONS WITH RESPECT TO THE CODE, EXPRESS, IMPLIED, STATUTORY
+           OR OTHERWISE, INCLUDING WARRANTIES, TERMS OR CONDITIONS OF
+           MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NONINFRINGEMENT
+           AND SATISFACTORY QUALITY. TO THE FULL EXTENT ALLOWED BY LAW,
+           LUMIRADX ALSO EXCLUDES ANY LIABILITY, WHETHER BASED IN CONTRACT
+           OR TORT (INCLUDING NEGLIGENCE), FOR INCIDENTAL, CONSEQUENTIAL,
+           INDIRECT, SPECIAL OR PUNITIVE DAMAGES OF ANY KIND, OR FOR LOSS
+           OF REVENUE OR PROFITS, LOSS OF BUSINESS, LOSS OF INFORMATION OR
+           DATA, OR OTHER FINANCIAL LOSS ARISING OUT OF OR IN CONNECTION
+           WITH THE USE OR PERFORMANCE OF THE CODE.
+"""
+
+import csv
+from typing import NamedTuple, Optional, Tuple
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+class StabilizationResult(NamedTuple):
+    """
+    Result of the stabilization analysis of one heater run.  Indexes are sample indexes into the temperature data
+    and times are in seconds from the first sample.
+    """
+    setpoint: float
+    band_low: float
+    band_high: float
+    window: int
+    stable: bool
+    first_in_band_index: Optional[int]
+    settling_index: Optional[int]
+    settling_time: Optional[float]
+    overshoot: float
+    steady_state_error: float
+    window_std: float
+    window_peak_to_peak: float
+    rolling_std: np.ndarray
+    rolling_peak_to_peak: np.ndarray
+
+
+def first_in_band_index(temperature: np.ndarray, band_low: float, band_high: float) -> Optional[int]:
+    """
+    This routine finds the first sample that is within the band.
+
+    :param temperature: Array with temperature data in degrees C.
+    :param band_low: Lower limit of the band in degrees C.
+    :param band_high: Upper limit of the band in degrees C.
+    :return: Index of the first sample within the band or None if no sample is within the band.
+    """
+    temperature = np.asarray(temperature, dtype=np.float64)
+    in_band = (temperature >= band_low) & (temperature <= band_high)
+    if not in_band.size:
+        return None
+    index = int(np.argmax(in_band))
+    return index if in_band[index] else None
+
+
+def window_in_band(temperature: np.ndarray, band_low: float, band_high: float, window: int) -> bool:
+    """
+    This routine checks whether the most recent samples are all within the band.  Only the window is examined so the
+    check is cheap enough to run on every sample of a live run.
+
+    :param temperature: Array with temperature data in degrees C.
+    :param band_low: Lower limit of the band in degrees C.
+    :param band_high: Upper limit of the band in degrees C.
+    :param window: Number of most recent samples to check.
+    :return: True if there are at least window samples and they are all within the band, otherwise False.
+    """
+    if window <= 0 or len(temperature) < window:
+        return False
+    window_data = np.asarray(temperature[len(temperature) - window:], dtype=np.float64)
+    return bool(((window_data >= band_low) & (window_data <= band_high)).all())
+
+
+def window_settled(temperature: np.ndarray, window: int, max_peak_to_peak: float, max_slope: float) -> bool:
+    """
+    This routine checks whether the most recent samples have settled - they spread less than max_peak_to_peak and
+    their least squares trend is flatter than max_slope.  Only the window is examined so the check is cheap enough
+    to run on every sample of a live run.
+
+    :param temperature: Array with temperature data in degrees C.
+    :param window: Number of most recent samples to check.
+    :param max_peak_to_peak: Maximum peak-to-peak value of the window in degrees C.
+    :param max_slope: Maximum absolute slope of the window in degrees C per sample.
+    :return: True if there are at least window samples and they have settled, otherwise False.
+    """
+    if window < 2 or len(temperature) < window:
+        return False
+    window_data = np.asarray(temperature[len(temperature) - window:], dtype=np.float64)
+    if np.ptp(window_data) > max_peak_to_peak:
+        return False
+    return abs(np.polyfit(np.arange(window), window_data, 1)[0]) <= max_slope
+
+
+def rolling_statistics(temperature: np.ndarray, window: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    This routine computes the rolling standard deviation and peak-to-peak value of the temperature data.
+
+    :param temperature: Array with temperature data in degrees C.
+    :param window: Number of samples in each rolling window.
+    :return: (rolling standard deviation, rolling peak-to-peak) arrays with one value per complete window.
+    """
+    temperature = np.asarray(temperature, dtype=np.float64)
+    if window <= 0 or len(temperature) < window:
+        return np.empty(0), np.empty(0)
+    windows = sliding_window_view(temperature, window)
+    return windows.std(axis=1), np.ptp(windows, axis=1)
+
+
+def analyze_heater_response(temperature: np.ndarray, setpoint: float, tolerance: float, window: int,
+                            sample_period: float = 1.0, band_center: Optional[float] = None) -> StabilizationResult:
+    """
+    This routine analyzes the response of the heater to a setpoint in a single vectorized pass.
+
+    :param temperature: Array with temperature data in degrees C, one sample per sample period.
+    :param setpoint: Heater setpoint in degrees C.
+    :param tolerance: Allowed deviation in degrees C from the center of the band.
+    :param window: Number of most recent samples that all have to be within the band for the heater to be stable.
+                   A run without data or with a window of no samples is never stable.
+    :param sample_period: Time in seconds between samples.
+    :param band_center: Center of the band in degrees C.  Defaults to the setpoint.
+    :return: StabilizationResult with the analysis of the run.
+    """
+    temperature = np.asarray(temperature, dtype=np.float64)
+    if band_center is None:
+        band_center = setpoint
+    band_low = band_center - tolerance
+    band_high = band_center + tolerance
+    window = max(0, min(window, len(temperature)))
+
+    in_band = (temperature >= band_low) & (temperature <= band_high)
+    out_of_band = np.flatnonzero(~in_band)
+    first_index = first_in_band_index(temperature, band_low, band_high)
+
+    # the heater has settled after the last sample that is outside the band
+    settling_index = int(out_of_band[-1]) + 1 if out_of_band.size else 0
+    if settling_index >= len(temperature):
+        settling_index = None
+
+    window_data = temperature[len(temperature) - window:]
+    if window_data.size:
+        steady_state_error = float(window_data.mean() - setpoint)
+        window_std = float(window_data.std())
+        window_peak_to_peak = float(np.ptp(window_data))
+    else:
+        steady_state_error = window_std = window_peak_to_peak = float('nan')
+    rolling_std, rolling_peak_to_peak = rolling_statistics(temperature, window)
+
+    return StabilizationResult(
+        setpoint=setpoint,
+        band_low=band_low,
+        band_high=band_high,
+        window=window,
+        stable=window > 0 and bool(in_band[len(in_band) - window:].all()),
+        first_in_band_index=first_index,
+        settling_index=settling_index,
+        settling_time=None if settling_index is None else settling_index * sample_period,
+        overshoot=max(0.0, float(temperature.max()) - setpoint) if temperature.size else 0.0,
+        steady_state_error=steady_state_error,
+        window_std=window_std,
+        window_peak_to_peak=window_peak_to_peak,
+        rolling_std=rolling_std,
+        rolling_peak_to_peak=rolling_peak_to_peak)
+
+
+def format_stabilization_result(result: StabilizationResult) -> str:
+    """
+    This routine describes the stabilization of a heater run for the operator.
+
+    :param result: StabilizationResult of the run.
+    :return: Text with the pass/fail verdict, settling time, overshoot and steady-state error of the run.
+    """
+    settling_time = 'never' if result.settling_time is None else '{0:.0f} s'.format(result.settling_time)
+    steady_state_error = 'n/a' if np.isnan(result.steady_state_error) else '{0:+.2f} C'.format(
+        result.steady_state_error)
+    return '{0} {1} (settling time {2}, overshoot {3:.2f} C, steady-state error {4})'.format(
+        result.setpoint, 'Stabilized Correctly' if result.stable else 'FAILURE TO STABILIZE', settling_time,
+        result.overshoot, steady_state_error)
+
+
+def load_heater_csv(csv_filename: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    This routine loads the data of an archived heater run .csv file written by the heater calibration script.
+
+    :param csv_filename: Name of the heater run .csv file.
+    :return: (ADC counts, temperature, duty cycle) arrays.
+    """
+    adc_counts_data = []
+    temperature_data = []
+    duty_cycle_data = []
+    with open(csv_filename, newline='') as heater_data_file:
+        reader = csv.reader(heater_data_file)
+        next(reader, None)  # skip the fields header line
+        for row in reader:
+            try:
+                adc_counts, temperature, duty_cycle = (float(value) for value in row[:3])
+            except ValueError:
+                # trailing rows such as the 40 degree timer value are not samples
+                continue
+            adc_counts_data.append(adc_counts)
+            temperature_data.append(temperature)
+            duty_cycle_data.append(duty_cycle)
+    return np.array(adc_counts_data), np.array(temperature_data), np.array(duty_cycle_data)
+
+
+def analyze_heater_csv(csv_filename: str, setpoint: float, tolerance: float, window: int,
+                       sample_period: float = 1.0) -> StabilizationResult:
+    """
+    This routine analyzes the response of an archived heater run .csv file.
+
+    :param csv_filename: Name of the heater run .csv file.
+    :param setpoint: Heater setpoint in degrees C of the run.
+    :param tolerance: Allowed deviation in degrees C from the setpoint.
+    :param window: Number of most recent samples that all have to be within the band for the heater to be stable.
+    :param sample_period: Time in seconds between samples.
+    :return: StabilizationResult with the analysis of the run.
+    """
+    _adc_counts, temperature, _duty_cycle = load_heater_csv(csv_filename)
+    return analyze_heater_response(temperature, setpoint, tolerance, window, sample_period)
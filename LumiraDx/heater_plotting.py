@@ -0,0 +1,219 @@
+"""
+heater_plotting.py
+
+This module renders the heater data plots of the heater calibration script.  Plots are rendered by a worker thread
+(or, opt-in, a worker process) so the test sequence state machine does not wait for matplotlib.  The plots are drawn
+with matplotlib's object-oriented API instead of pyplot, so the plots of several stations can render on different
+threads at once.  This module has no side effects on import so it can be imported by the worker processes.
+
+@copyright LumiraDx, 2021. All rights reserved. This code is provided on an
+           "AS IS" basis. LumiraDx DISCLAIMS ALL WARRANTIES, TERMS AND
+           CONDITIONS WITH RESPECT TO THE CODE, EXPRESS, IMPLIED, STATUTORY
+           OR OTHERWISE, INCLUDING WARRANTIES, TERMS OR CONDITIONS OF
+           MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NONINFRINGEMENT
+           AND SATISFACTORY QUALITY. TO THE FULL EXTENT ALLOWED BY LAW,
+           LUMIRADX ALSO EXCLUDES ANY LIABILITY, WHETHER BASED IN CONTRACT
+           OR TORT (INCLUDING NEGLIGENCE), FOR INCIDENTAL, CONSEQUENTIAL,
+           INDIRECT, SPECIAL OR PUNITIVE DAMAGES OF ANY KIND, OR FOR LOSS
+           OF REVENUE OR PROFITS, LOSS OF BUSINESS, LOSS OF INFORMATION OR
+           DATA, OR OTHER FINANCIAL LOSS ARISING OUT OF OR IN CONNECTION
+           WITH THE USE OR PERFORMANCE OF THE CODE.
+"""
+
+import logging
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional, Tuple
+
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+from matplotlib.figure import Figure
+from twisted.python import log
+
+
+# plot modes - 'png' renders a .png plot of every heater run with every sample, 'decimated' renders the plot from a
+# min/max envelope of long runs and 'data' skips the plots and only keeps the .csv data
+PLOT_MODE_PNG = 'png'
+PLOT_MODE_DECIMATED = 'decimated'
+PLOT_MODE_DATA = 'data'
+
+# number of min/max buckets per series in the decimated plot mode - one per horizontal pixel of the 8 inch wide
+# figure at the default 100 dpi
+HEATER_PLOT_BUCKETS = 800
+
+# plot executors - 'thread' renders the plots on worker threads of the test tool process and 'process' in worker
+# processes, which keeps matplotlib off the GIL of the test sequence but on Windows starts each worker by re-importing
+# the __main__ module of the process hosting the script.  Only use PLOT_EXECUTOR_PROCESS if the host protects its
+# entry point with "if __name__ == '__main__':" (and calls multiprocessing.freeze_support() if it's frozen), otherwise
+# every worker re-runs the host
+PLOT_EXECUTOR_THREAD = 'thread'
+PLOT_EXECUTOR_PROCESS = 'process'
+HEATER_PLOT_EXECUTOR = PLOT_EXECUTOR_THREAD
+
+# number of worker threads or processes rendering plots
+HEATER_PLOT_WORKERS = 1
+
+# maximum number of plots queued or rendering at once - submitting another plot waits for one to finish
+HEATER_PLOT_MAX_PENDING = 3
+
+
+def decimate_min_max(x_values: np.ndarray, y_values: np.ndarray, buckets: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    This routine reduces a series to the minimum and maximum point of each bucket of consecutive samples, in sample
+    order.  The envelope drawn from the reduced series looks the same as the full series when there is about one
+    bucket per pixel, so peaks and dips are never lost.
+
+    :param x_values: Array with the x values of the series.
+    :param y_values: Array with the y values of the series.
+    :param buckets: Number of buckets to reduce the series to.
+    :return: (x values, y values) of the reduced series - the series itself if it's already short enough.
+    """
+    num_points = len(y_values)
+    if buckets <= 0 or num_points <= 2 * buckets:
+        return x_values, y_values
+    bucket_size = -(-num_points // buckets)
+    num_full_points = (num_points // bucket_size) * bucket_size
+    full_buckets = np.asarray(y_values[:num_full_points]).reshape(-1, bucket_size)
+    offsets = np.arange(0, num_full_points, bucket_size)
+    indexes = [offsets + full_buckets.argmin(axis=1), offsets + full_buckets.argmax(axis=1)]
+    if num_full_points < num_points:
+        # the last partial bucket
+        remainder = np.asarray(y_values[num_full_points:])
+        indexes.append(np.array([num_full_points + remainder.argmin(), num_full_points + remainder.argmax()]))
+    # always keep the end points so the x axis covers the whole run
+    indexes.append(np.array([0, num_points - 1]))
+    indexes = np.unique(np.concatenate(indexes))
+    return x_values[indexes], y_values[indexes]
+
+
+def render_heater_plot(plot_filename: str, setpoint: int, adc_counts_data: np.ndarray, temperature_data: np.ndarray,
+                       duty_cycle_data: np.ndarray, stabilized_data_index_value: int,
+                       buckets: Optional[int] = None) -> str:
+    """
+    This routine creates a plot with heater ADC counts and temperature data.  The temperature is plotted twice - an
+    overall plot with all the data points and a second plot of the temperature after it's reached the stabilized
+    data index.
+
+    :param plot_filename: Name of plot file to save.
+    :param setpoint: Heater setpoint in degrees C of the run.
+    :param adc_counts_data: Array with ADC data to plot.
+    :param temperature_data: Array with temperature data in degrees C to plot.
+    :param duty_cycle_data: Array with duty cycle data in percent to plot.
+    :param stabilized_data_index_value: Index of the first sample of the stabilized temperature plot.
+    :param buckets: Number of min/max buckets to reduce each series to before drawing or None to draw every sample.
+    :return: Name of the saved plot file.
+    """
+    def series(x_values, y_values):
+        return (x_values, y_values) if buckets is None else decimate_min_max(x_values, y_values, buckets)
+
+    # create a plot with the heater ADC and temperature data all on individual subplots - the figure isn't registered
+    # with pyplot, so nothing has to be closed and nothing is shared with plots rendering on other threads
+    fig1 = Figure(figsize=(8, 11))
+    ax1, ax2, ax3, ax4 = fig1.subplots(nrows=4, sharex=True)
+    x_axis_values = np.arange(1, len(adc_counts_data) + 1)
+    ax1.plot(*series(x_axis_values, adc_counts_data))
+    ax2.plot(*series(x_axis_values, temperature_data))
+    ax3.plot(*series(x_axis_values[stabilized_data_index_value:], temperature_data[stabilized_data_index_value:]))
+    ax4.plot(*series(x_axis_values, duty_cycle_data))
+    ax1.set(ylabel='ADC Counts')
+    ax2.set(ylabel='Temperature (Deg. C)')
+    ax3.set(ylabel='Temperature - Stabilized (Deg. C)')
+    ax4.set(xlabel='Sample Number', ylabel='Duty Cycle (Percent)')
+    fig1.suptitle('Heater Data (Setpoint: {0} Deg C)'.format(setpoint))
+    fig1.savefig(plot_filename)
+    return plot_filename
+
+
+class HeaterPlotRenderer(object):
+    """
+    This class hands heater plots off to a worker thread or process pool.  The number of plots queued or rendering
+    at once is bounded so a slow disk can't make the queue grow without limit.
+    """
+
+    def __init__(self, plot_mode: str = PLOT_MODE_PNG, max_workers: int = HEATER_PLOT_WORKERS,
+                 max_pending: int = HEATER_PLOT_MAX_PENDING, buckets: int = HEATER_PLOT_BUCKETS,
+                 executor: str = HEATER_PLOT_EXECUTOR):
+        """
+        Class initializer.
+
+        :param plot_mode: PLOT_MODE_PNG to render plots with every sample, PLOT_MODE_DECIMATED to render plots from
+                          a min/max envelope of long runs or PLOT_MODE_DATA to skip them.
+        :param max_workers: Number of worker threads or processes rendering plots.
+        :param max_pending: Maximum number of plots queued or rendering at once.
+        :param buckets: Number of min/max buckets per series in the PLOT_MODE_DECIMATED plot mode.
+        :param executor: PLOT_EXECUTOR_THREAD to render plots on worker threads or PLOT_EXECUTOR_PROCESS to render
+                         them in worker processes (see HEATER_PLOT_EXECUTOR for the requirement on the host).
+        """
+        if executor not in (PLOT_EXECUTOR_THREAD, PLOT_EXECUTOR_PROCESS):
+            raise ValueError('unknown plot executor {0}'.format(executor))
+        self.plot_mode = plot_mode
+        self.buckets = buckets
+        self.max_workers = max_workers
+        self.executor = executor
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self._executor = None
+
+    def submit(self, plot_filename: str, setpoint: int, adc_counts_data: np.ndarray, temperature_data: np.ndarray,
+               duty_cycle_data: np.ndarray, stabilized_data_index_value: int) -> Optional[Future]:
+        """
+        This routine queues a plot to be rendered by a worker.  The data is copied for the worker so the caller can
+        reuse its buffers as soon as this routine returns.
+
+        :param plot_filename: Name of plot file to save.
+        :param setpoint: Heater setpoint in degrees C of the run.
+        :param adc_counts_data: Array with ADC data to plot.
+        :param temperature_data: Array with temperature data in degrees C to plot.
+        :param duty_cycle_data: Array with duty cycle data in percent to plot.
+        :param stabilized_data_index_value: Index of the first sample of the stabilized temperature plot.
+        :return: Future of the rendered plot file name or None if plots are disabled.
+        """
+        if self.plot_mode == PLOT_MODE_DATA:
+            log.msg('heater plot: plot mode is {0}, skipping {1}'.format(self.plot_mode, plot_filename),
+                    logLevel=logging.INFO)
+            return None
+        if self._executor is None:
+            if self.executor == PLOT_EXECUTOR_PROCESS:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='heater-plot')
+        self._pending.acquire()
+        try:
+            # a process executor pickles the arguments on a background thread and a thread executor renders later, so
+            # copy the data now
+            future = self._executor.submit(render_heater_plot, plot_filename, setpoint, np.array(adc_counts_data),
+                                           np.array(temperature_data), np.array(duty_cycle_data),
+                                           stabilized_data_index_value,
+                                           self.buckets if self.plot_mode == PLOT_MODE_DECIMATED else None)
+        except Exception:
+            self._pending.release()
+            raise
+        future.add_done_callback(self._plot_done)
+        return future
+
+    def shutdown(self, wait: bool = True) -> None:
+        """
+        This routine stops the workers.
+
+        :param wait: True to wait for the queued plots to be rendered first.
+        :return: None.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+    def _plot_done(self, future: Future) -> None:
+        """
+        This routine is called when a worker has finished with a plot.
+
+        :param future: Future of the rendered plot.
+        :return: None.
+        """
+        self._pending.release()
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            log.msg('heater plot: rendering failed: {0}'.format(error), logLevel=logging.ERROR)
+        else:
+            log.msg('heater plot: saved {0}'.format(future.result()), logLevel=logging.INFO)
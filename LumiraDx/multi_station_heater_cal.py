@@ -0,0 +1,231 @@
+"""
+multi_station_heater_cal.py
+
+This module runs the heater calibration of several instruments at the same time in one process.  Each station (dock)
+of the fixture has its own instrument serial port, reference thermometer serial port and output directory.  Every
+station gets its own HeaterRunContext, TestHandler and list of test steps so no state is shared between stations, and
+each station's test sequence runs on its own thread.
+
+The station configuration file is a JSON list with one entry per station, for example:
+
+    [
+        {"name": "dock1", "instrument_port": "COM3", "thermometer_port": "COM4", "output_dir": "heaterdata/dock1"},
+        {"name": "dock2", "instrument_port": "COM5", "thermometer_port": "COM6", "output_dir": "heaterdata/dock2"}
+    ]
+
+The test sequence of a station is executed by a sequence runner - a callable that takes the instrument serial port and
+the list of test steps, executes the steps against the instrument and returns True if the sequence passed.  The
+sequence runner of the test tool is given on the command line as module:function.
+
+@copyright LumiraDx, 2021. All rights reserved. This code is provided on an
+           "AS IS" basis. LumiraDx DISCLAIMS ALL WARRANTIES, TERMS AND
+           CONDITIONS WITH RESPECT TO THE CODE, EXPRESS, IMPLIED, STATUTORY
+           OR OTHERWISE, INCLUDING WARRANTIES, TERMS OR CONDITIONS OF
+           MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NONINFRINGEMENT
+           AND SATISFACTORY QUALITY. TO THE FULL EXTENT ALLOWED BY LAW,
+           LUMIRADX ALSO EXCLUDES ANY LIABILITY, WHETHER BASED IN CONTRACT
+           OR TORT (INCLUDING NEGLIGENCE), FOR INCIDENTAL, CONSEQUENTIAL,
+           INDIRECT, SPECIAL OR PUNITIVE DAMAGES OF ANY KIND, OR FOR LOSS
+           OF REVENUE OR PROFITS, LOSS OF BUSINESS, LOSS OF INFORMATION OR
+           DATA, OR OTHER FINANCIAL LOSS ARISING OUT OF OR IN CONNECTION
+           WITH THE USE OR PERFORMANCE OF THE CODE.
+"""
+
+import argparse
+import importlib
+import importlib.util
+import json
+import logging
+import sys
+import threading
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+from twisted.python import log
+
+
+# module name of the heater calibration script
+HEATER_CAL_MODULE = 'shortheatercalFruit4_windows'
+
+
+def load_heater_cal_library():
+    """
+    This routine imports the heater calibration script as a library.  HEATER_LIBRARY_IMPORT is set on the module
+    before the script runs, so the script doesn't create the default station of the test tool (its reference
+    thermometer port, calibration results file and atexit handler).
+
+    :return: Module of the heater calibration script.
+    """
+    module = sys.modules.get(HEATER_CAL_MODULE)
+    if module is not None:
+        return module
+    spec = importlib.util.find_spec(HEATER_CAL_MODULE)
+    module = importlib.util.module_from_spec(spec)
+    module.HEATER_LIBRARY_IMPORT = True
+    sys.modules[HEATER_CAL_MODULE] = module
+    try:
+        spec.loader.exec_module(module)
+    except BaseException:
+        del sys.modules[HEATER_CAL_MODULE]
+        raise
+    return module
+
+
+heater_cal = load_heater_cal_library()
+
+# signature of a sequence runner - (instrument serial port, list of test steps) -> True if the sequence passed
+SequenceRunner = Callable[[str, List[dict]], bool]
+
+
+class StationConfig(NamedTuple):
+    """
+    Configuration of one station of the fixture.
+    """
+    name: str
+    instrument_port: str
+    thermometer_port: str
+    output_dir: str
+
+
+def load_station_configs(config_filename: str) -> List[StationConfig]:
+    """
+    This routine loads the station configuration file.
+
+    :param config_filename: Name of the JSON station configuration file.
+    :return: List with the configuration of each station.
+    """
+    with open(config_filename) as config_file:
+        entries = json.load(config_file)
+    stations = [StationConfig(name=entry['name'], instrument_port=entry['instrument_port'],
+                              thermometer_port=entry['thermometer_port'],
+                              output_dir=entry.get('output_dir', '{0}/{1}'.format(heater_cal.HEATER_OUTPUT_DIR,
+                                                                                   entry['name'])))
+                for entry in entries]
+
+    # two stations sharing a port or an output directory would corrupt each other's runs
+    for field in ('name', 'instrument_port', 'thermometer_port', 'output_dir'):
+        values = [getattr(station, field) for station in stations]
+        if len(set(values)) != len(values):
+            raise ValueError('station configuration {0}: duplicate {1}'.format(config_filename, field))
+    return stations
+
+
+def load_sequence_runner(runner_spec: str) -> SequenceRunner:
+    """
+    This routine imports a sequence runner given as module:function.
+
+    :param runner_spec: Sequence runner in the format module:function.
+    :return: Sequence runner callable.
+    """
+    module_name, _, function_name = runner_spec.partition(':')
+    if not module_name or not function_name:
+        raise ValueError('sequence runner {0}: expected module:function'.format(runner_spec))
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+class StationRun(object):
+    """
+    This class holds the state of the calibration run of one station.
+    """
+
+    def __init__(self, station: StationConfig):
+        """
+        Class initializer - creates the run context, test handler and list of test steps of the station.
+
+        :param station: Configuration of the station.
+        """
+        self.station = station
+        self.run_context = heater_cal.HeaterRunContext(station.name, station.thermometer_port, station.output_dir)
+        self.test_handler = heater_cal.TestHandler(self.run_context)
+        self.test_step_list = heater_cal.build_test_step_list(self.test_handler)
+        self.passed = False
+        self.error = None  # type: Optional[BaseException]
+        self.thread = None  # type: Optional[threading.Thread]
+
+    def run(self, sequence_runner: SequenceRunner) -> None:
+        """
+        This routine runs the test sequence of the station - it's the body of the station thread.
+
+        :param sequence_runner: Callable that executes the list of test steps against the instrument.
+        :return: None
+        """
+        try:
+            heater_cal.prepare_calibration_csv(self.run_context.output_dir)
+            self.passed = bool(sequence_runner(self.station.instrument_port, self.test_step_list))
+        except BaseException as error:
+            self.error = error
+            log.msg('station {0}: test sequence failed: {1}'.format(self.station.name, error), logLevel=logging.ERROR)
+        finally:
+            self.test_handler.close()
+
+
+class MultiStationCalibrationRunner(object):
+    """
+    This class runs the heater calibration of several stations at the same time, one thread per station.
+    """
+
+    def __init__(self, stations: List[StationConfig], sequence_runner: SequenceRunner):
+        """
+        Class initializer.
+
+        :param stations: Configuration of each station.
+        :param sequence_runner: Callable that executes a list of test steps against an instrument.
+        """
+        self.sequence_runner = sequence_runner
+        self.station_runs = [StationRun(station) for station in stations]
+
+    def start(self) -> None:
+        """
+        This routine starts the test sequence of every station on its own thread.
+
+        :return: None
+        """
+        for station_run in self.station_runs:
+            station_run.thread = threading.Thread(target=station_run.run, args=(self.sequence_runner,),
+                                                  name='station-{0}'.format(station_run.station.name), daemon=True)
+            station_run.thread.start()
+
+    def wait(self) -> Dict[str, bool]:
+        """
+        This routine waits for the test sequence of every station to finish.
+
+        :return: Dictionary of station name to True if the station passed.
+        """
+        for station_run in self.station_runs:
+            if station_run.thread is not None:
+                station_run.thread.join()
+        return {station_run.station.name: station_run.passed and station_run.error is None
+                for station_run in self.station_runs}
+
+    def run(self) -> Dict[str, bool]:
+        """
+        This routine runs the test sequences of all stations to completion.
+
+        :return: Dictionary of station name to True if the station passed.
+        """
+        self.start()
+        return self.wait()
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """
+    This routine runs the heater calibration of the stations in the station configuration file.
+
+    :param argv: Command line arguments - defaults to sys.argv.
+    :return: Process exit code - 0 if every station passed.
+    """
+    parser = argparse.ArgumentParser(description='Run the heater calibration of several stations in parallel.')
+    parser.add_argument('config', help='JSON station configuration file')
+    parser.add_argument('--sequence-runner', required=True,
+                        help='test tool sequence runner as module:function(instrument_port, test_step_list)')
+    args = parser.parse_args(argv)
+
+    log.startLogging(sys.stdout)
+    runner = MultiStationCalibrationRunner(load_station_configs(args.config), load_sequence_runner(args.sequence_runner))
+    results = runner.run()
+    for station_name, passed in results.items():
+        print('{0}: {1}'.format(station_name, 'PASS' if passed else 'FAIL'))
+    return 0 if all(results.values()) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,621 @@
+"""
+result_store.py
+
+This module stores the result rows of the test scripts in partitions instead of one file that grows forever.  Every
+station writes to its own directory with one sub-directory per day, and a day's partition rolls over to a new file
+when it reaches a size limit:
+
+    <root>/<station>/<YYYY-MM-DD>/part-0001.csv
+    <root>/<station>/<YYYY-MM-DD>/part-0002.csv
+    <root>/<station>/archive/<YYYY-MM-DD>.csv.gz
+
+Old days are compacted into one archive file per day - gzip compressed CSV, or Parquet when pyarrow is installed.
+The reader queries the archives and the partitions of every station transparently.
+
+Every partition has a sidecar TestId index (<partition>.idx) with the next TestId and the size of the partition when
+the index was written.  A new partition starts with the index of the partition it rolled over from so TestIds keep
+increasing across partitions.  Each station also has a station TestId index (<root>/<station>/next_test_id.json)
+that survives the compaction of its partitions.  A station without one is seeded from the newest archive of the
+station and the legacy single results file it replaces.
+
+@copyright LumiraDx, 2021. All rights reserved. This code is provided on an
+           "AS IS" basis. LumiraDx DISCLAIMS ALL WARRANTIES, TERMS AND
+           CONDITIONS WITH RESPECT TO THE CODE, EXPRESS, IMPLIED, STATUTORY
+           OR OTHERWISE, INCLUDING WARRANTIES, TERMS OR CONDITIONS OF
+           MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NONINFRINGEMENT
+           AND SATISFACTORY QUALITY. TO THE FULL EXTENT ALLOWED BY LAW,
+           LUMIRADX ALSO EXCLUDES ANY LIABILITY, WHETHER BASED IN CONTRACT
+           OR TORT (INCLUDING NEGLIGENCE), FOR INCIDENTAL, CONSEQUENTIAL,
+           INDIRECT, SPECIAL OR PUNITIVE DAMAGES OF ANY KIND, OR FOR LOSS
+           OF REVENUE OR PROFITS, LOSS OF BUSINESS, LOSS OF INFORMATION OR
+           DATA, OR OTHER FINANCIAL LOSS ARISING OUT OF OR IN CONNECTION
+           WITH THE USE OR PERFORMANCE OF THE CODE.
+"""
+
+import argparse
+import csv
+import datetime
+import gzip
+import json
+import logging
+import os
+import re
+import sys
+import threading
+from typing import Collection, Dict, Iterable, Iterator, List, Optional
+
+from twisted.python import log
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+# suffix of the sidecar TestId index of a results file
+TEST_ID_INDEX_SUFFIX = '.idx'
+
+# number of bytes read from the end of a results file when looking for the last TestId - doubled until one is found
+TEST_ID_TAIL_BYTES = 64 * 1024
+
+# size in bytes at which a partition rolls over to a new file
+PARTITION_MAX_BYTES = 16 * 1024 * 1024
+
+# archive formats of compacted partitions
+ARCHIVE_FORMAT_CSV_GZ = 'csv.gz'
+ARCHIVE_FORMAT_PARQUET = 'parquet'
+
+# station TestId index - the next TestId of the station, kept across compactions
+STATION_TEST_ID_INDEX_FILENAME = 'next_test_id.json'
+
+ARCHIVE_DIR = 'archive'
+DATE_FORMAT = '%Y-%m-%d'
+PARTITION_FILENAME_PATTERN = re.compile(r'^part-(\d{4,})\.csv$')
+
+
+def write_test_id_index(results_filename: str, next_test_id: int) -> None:
+    """
+    This routine writes the TestId index of a results file.  The index is replaced atomically so a crash never
+    leaves a partial index behind.
+
+    :param results_filename: Name of the results file.
+    :param next_test_id: TestId of the next row of the results file.
+    :return: None
+    """
+    index_filename = results_filename + TEST_ID_INDEX_SUFFIX
+    with open(index_filename + '.tmp', 'w') as index_file:
+        json.dump({'nextTestId': next_test_id, 'resultsSize': os.path.getsize(results_filename)}, index_file)
+    os.replace(index_filename + '.tmp', index_filename)
+
+
+def read_test_id_index(results_filename: str) -> Optional[int]:
+    """
+    This routine reads the TestId index of a results file.
+
+    :param results_filename: Name of the results file.
+    :return: TestId of the next row of the results file or None if there is no index or it's stale.
+    """
+    try:
+        with open(results_filename + TEST_ID_INDEX_SUFFIX) as index_file:
+            index = json.load(index_file)
+        if index['resultsSize'] == os.path.getsize(results_filename):
+            return int(index['nextTestId'])
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    # the results file has been changed since the index was written (or there is no index)
+    return None
+
+
+def find_last_test_id(results_filename: str, tail_bytes: int = TEST_ID_TAIL_BYTES) -> Optional[int]:
+    """
+    This routine finds the TestId of the last row of a results file that has one by reading the file backwards
+    from the end.  TestIds only ever increase through the file so this is the largest TestId.
+
+    :param results_filename: Name of the results file.
+    :param tail_bytes: Number of bytes read from the end of the file first - doubled until a TestId is found.
+    :return: Last TestId of the results file or None if there is none.
+    """
+    with open(results_filename, 'rb') as results_file:
+        file_size = results_file.seek(0, os.SEEK_END)
+        while True:
+            offset = max(0, file_size - tail_bytes)
+            results_file.seek(offset)
+            lines = results_file.read(file_size - offset).decode('utf-8', errors='replace').splitlines()
+            if offset > 0:
+                lines = lines[1:]  # the first line is most likely partial
+            for row in csv.reader(reversed(lines)):
+                if row and row[0].strip().isdigit():
+                    return int(row[0])
+            if offset == 0:
+                return None
+            tail_bytes *= 2
+
+
+def find_next_test_id(results_filename: str) -> int:
+    """
+    This routine finds the TestId of the next row of a results file in constant time - from the TestId index if
+    it's up to date, otherwise from the tail of the results file.
+
+    :param results_filename: Name of the results file.
+    :return: TestId of the next row - one more than the largest TestId in the file.
+    """
+    next_test_id = read_test_id_index(results_filename)
+    if next_test_id is None:
+        if not os.path.exists(results_filename):
+            return 1
+        last_test_id = find_last_test_id(results_filename)
+        next_test_id = 1 if last_test_id is None else last_test_id + 1
+        log.msg('TestId index of {0} is missing or stale - next TestId {1} found from the tail of the file'.format(
+            results_filename, next_test_id), logLevel=logging.INFO)
+    return next_test_id
+
+
+def max_test_id(rows: Iterable[dict]) -> Optional[int]:
+    """
+    This routine finds the largest TestId of a set of result rows.
+
+    :param rows: Result rows.
+    :return: Largest TestId or None if no row has one.
+    """
+    test_ids = [int(str(row.get('TestId')).strip()) for row in rows
+                if str(row.get('TestId') or '').strip().isdigit()]
+    return max(test_ids) if test_ids else None
+
+
+def is_result_row(row: dict) -> bool:
+    """
+    This routine checks whether a row read from a results file is a result - the blank rows that separate test
+    groups have no TestId.
+
+    :param row: Dictionary of the row.
+    :return: True if the row is a result row.
+    """
+    return bool((row.get('TestId') or '').strip())
+
+
+class PartitionedResultStore(object):
+    """
+    This class manages the partitions of the results of the test scripts - one directory per station and day, with
+    a size limit per partition file.
+    """
+
+    def __init__(self, root_dir: str, station: str, header: List[str], max_bytes: int = PARTITION_MAX_BYTES,
+                 legacy_filename: Optional[str] = None):
+        """
+        Class initializer.
+
+        :param root_dir: Root directory of the store.
+        :param station: Name of the station this instance writes to.
+        :param header: Columns of the result rows.
+        :param max_bytes: Size in bytes at which a partition rolls over to a new file.
+        :param legacy_filename: Single results file the store replaces - the TestIds of the station continue after
+                                its last TestId - or None.
+        """
+        self.root_dir = root_dir
+        self.station = station
+        self.header = header
+        self.max_bytes = max_bytes
+        self.legacy_filename = legacy_filename
+
+    def station_dir(self, station: Optional[str] = None) -> str:
+        """
+        This routine builds the directory of a station.
+
+        :param station: Name of the station - defaults to the station of this instance.
+        :return: Directory of the station.
+        """
+        return os.path.join(self.root_dir, station or self.station)
+
+    def partition_dates(self, station: Optional[str] = None) -> List[str]:
+        """
+        This routine lists the days that have partitions that have not been compacted yet.
+
+        :param station: Name of the station - defaults to the station of this instance.
+        :return: Sorted list of the days (YYYY-MM-DD).
+        """
+        station_dir = self.station_dir(station)
+        if not os.path.isdir(station_dir):
+            return []
+        return sorted(name for name in os.listdir(station_dir)
+                      if name != ARCHIVE_DIR and os.path.isdir(os.path.join(station_dir, name)))
+
+    def partition_files(self, date: str, station: Optional[str] = None) -> List[str]:
+        """
+        This routine lists the partition files of a day in the order they were written.
+
+        :param date: Day of the partitions (YYYY-MM-DD).
+        :param station: Name of the station - defaults to the station of this instance.
+        :return: List of the partition file names.
+        """
+        date_dir = os.path.join(self.station_dir(station), date)
+        if not os.path.isdir(date_dir):
+            return []
+        matches = [PARTITION_FILENAME_PATTERN.match(name) for name in os.listdir(date_dir)]
+        return [os.path.join(date_dir, match.group(0))
+                for match in sorted((match for match in matches if match), key=lambda match: int(match.group(1)))]
+
+    def read_station_test_id(self, station: Optional[str] = None) -> Optional[int]:
+        """
+        This routine reads the station TestId index.
+
+        :param station: Name of the station - defaults to the station of this instance.
+        :return: Next TestId of the station or None if the station has no index yet.
+        """
+        try:
+            with open(os.path.join(self.station_dir(station), STATION_TEST_ID_INDEX_FILENAME)) as index_file:
+                return int(json.load(index_file)['nextTestId'])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def write_station_test_id(self, next_test_id: int, station: Optional[str] = None) -> None:
+        """
+        This routine raises the station TestId index to the given TestId - it never goes down.  The index is replaced
+        atomically so a crash never leaves a partial index behind.
+
+        :param next_test_id: Next TestId of the station.
+        :param station: Name of the station - defaults to the station of this instance.
+        :return: None
+        """
+        next_test_id = max(next_test_id, self.read_station_test_id(station) or 1)
+        station_dir = self.station_dir(station)
+        os.makedirs(station_dir, exist_ok=True)
+        index_filename = os.path.join(station_dir, STATION_TEST_ID_INDEX_FILENAME)
+        with open(index_filename + '.tmp', 'w') as index_file:
+            json.dump({'nextTestId': next_test_id}, index_file)
+        os.replace(index_filename + '.tmp', index_filename)
+
+    def seed_next_test_id(self) -> int:
+        """
+        This routine finds the next TestId of a station that has no station TestId index - after the TestIds of the
+        legacy results file and of the newest archive of the station.
+
+        :return: Next TestId of the station.
+        """
+        next_test_id = 1
+        if self.legacy_filename is not None and os.path.exists(self.legacy_filename):
+            next_test_id = find_next_test_id(self.legacy_filename)
+        archives = self.archive_files()
+        if archives:
+            newest_date = max(archives)
+            last_test_id = max([test_id for test_id in (max_test_id(self._read_archive(archive))
+                                                        for archive in archives[newest_date])
+                                if test_id is not None], default=None)
+            if last_test_id is not None:
+                next_test_id = max(next_test_id, last_test_id + 1)
+        return next_test_id
+
+    def archive_files(self, station: Optional[str] = None) -> Dict[str, List[str]]:
+        """
+        This routine lists the archive files of a station by day.  A day can have several archives (i.e. a .csv.gz
+        and a .parquet archive written by compactions with different formats).
+
+        :param station: Name of the station - defaults to the station of this instance.
+        :return: Dictionary of day (YYYY-MM-DD) to the sorted list of its archive file names.
+        """
+        archive_dir = os.path.join(self.station_dir(station), ARCHIVE_DIR)
+        archives = {}  # type: Dict[str, List[str]]
+        if os.path.isdir(archive_dir):
+            for name in sorted(os.listdir(archive_dir)):
+                for archive_format in (ARCHIVE_FORMAT_CSV_GZ, ARCHIVE_FORMAT_PARQUET):
+                    if name.endswith('.' + archive_format):
+                        archives.setdefault(name[:-len(archive_format) - 1], []).append(
+                            os.path.join(archive_dir, name))
+        return archives
+
+    def latest_partition(self) -> Optional[str]:
+        """
+        This routine finds the most recently written partition file of the station of this instance.
+
+        :return: Name of the partition file or None if the station has no partitions.
+        """
+        for date in reversed(self.partition_dates()):
+            partition_files = self.partition_files(date)
+            if partition_files:
+                return partition_files[-1]
+        return None
+
+    def active_partition(self, now: Optional[datetime.datetime] = None, exclude: Collection[str] = ()) -> str:
+        """
+        This routine returns the partition file new results are written to.  A new partition is started on a new day,
+        when the latest partition has reached the size limit or when it's excluded (i.e. because another test of the
+        station is writing to it).  It's created with the fields header line and its TestId index continues from the
+        previous partition and the station TestId index, so TestIds keep increasing across compactions.  A station
+        without a station TestId index is seeded from its archives and the legacy results file (see
+        seed_next_test_id()).
+
+        :param now: Current time - defaults to now.
+        :param exclude: Partition files that must not be returned.
+        :return: Name of the partition file.
+        """
+        today = (now or datetime.datetime.now()).strftime(DATE_FORMAT)
+        latest = self.latest_partition()
+        if latest is not None and os.path.basename(os.path.dirname(latest)) == today and \
+                os.path.getsize(latest) < self.max_bytes and latest not in exclude:
+            return latest
+
+        if latest is not None and os.path.basename(os.path.dirname(latest)) == today:
+            sequence = int(PARTITION_FILENAME_PATTERN.match(os.path.basename(latest)).group(1)) + 1
+        else:
+            sequence = 1
+        station_test_id = self.read_station_test_id()
+        next_test_id = max(find_next_test_id(latest) if latest is not None else 1,
+                           station_test_id if station_test_id is not None else self.seed_next_test_id())
+
+        date_dir = os.path.join(self.station_dir(), today)
+        os.makedirs(date_dir, exist_ok=True)
+        partition = os.path.join(date_dir, 'part-{0:04d}.csv'.format(sequence))
+        with open(partition, 'w', newline='') as partition_file:
+            csv.DictWriter(partition_file, fieldnames=self.header).writeheader()
+        write_test_id_index(partition, next_test_id)
+        self.write_station_test_id(next_test_id)
+        log.msg('result store: started partition {0} at TestId {1}'.format(partition, next_test_id),
+                logLevel=logging.INFO)
+        return partition
+
+    def compact(self, older_than_days: int, archive_format: str = ARCHIVE_FORMAT_CSV_GZ,
+                station: Optional[str] = None, now: Optional[datetime.datetime] = None) -> List[str]:
+        """
+        This routine merges the partitions of each day older than the given number of days into one archive file per
+        day and removes the partitions.  The blank separator rows are dropped.
+
+        :param older_than_days: Days with partitions at least this many days old are compacted.
+        :param archive_format: ARCHIVE_FORMAT_CSV_GZ or ARCHIVE_FORMAT_PARQUET (needs pyarrow).
+        :param station: Name of the station - defaults to the station of this instance.
+        :param now: Current time - defaults to now.
+        :return: List of the written archive file names.
+        """
+        if archive_format == ARCHIVE_FORMAT_PARQUET and pyarrow is None:
+            raise RuntimeError('the {0} archive format needs pyarrow'.format(ARCHIVE_FORMAT_PARQUET))
+        cutoff = ((now or datetime.datetime.now()) - datetime.timedelta(days=older_than_days)).strftime(DATE_FORMAT)
+        archive_dir = os.path.join(self.station_dir(station), ARCHIVE_DIR)
+        archives = []
+        for date in self.partition_dates(station):
+            if date >= cutoff:
+                continue
+            partition_files = self.partition_files(date, station)
+            rows = [row for partition in partition_files for row in self._read_csv(partition)]
+            # the station TestId index has to be past the archived TestIds before the partitions are removed
+            next_test_id = max([find_next_test_id(partition) for partition in partition_files] +
+                               [(max_test_id(rows) or 0) + 1])
+            self.write_station_test_id(next_test_id, station)
+            os.makedirs(archive_dir, exist_ok=True)
+            archive = os.path.join(archive_dir, '{0}.{1}'.format(date, archive_format))
+            # merge with an archive written by an earlier compaction of the same day
+            if os.path.exists(archive):
+                rows = list(self._read_archive(archive)) + rows
+            self._write_archive(archive, rows, archive_format)
+
+            # the partitions are only removed once their archive is safely in place
+            date_dir = os.path.join(self.station_dir(station), date)
+            for name in os.listdir(date_dir):
+                os.remove(os.path.join(date_dir, name))
+            os.rmdir(date_dir)
+            log.msg('result store: compacted {0} partitions of {1} into {2}'.format(
+                len(partition_files), date, archive), logLevel=logging.INFO)
+            archives.append(archive)
+        return archives
+
+    def stations(self) -> List[str]:
+        """
+        This routine lists the stations in the store.
+
+        :return: Sorted list of the station names.
+        """
+        if not os.path.isdir(self.root_dir):
+            return []
+        return sorted(name for name in os.listdir(self.root_dir) if os.path.isdir(os.path.join(self.root_dir, name)))
+
+    def iter_rows(self, stations: Optional[List[str]] = None, start_date: Optional[str] = None,
+                  end_date: Optional[str] = None) -> Iterator[dict]:
+        """
+        This routine reads the result rows of the archives and partitions, day by day, without the blank separator
+        rows.
+
+        :param stations: Names of the stations to read - defaults to all stations.
+        :param start_date: First day to read (YYYY-MM-DD) - defaults to the first day in the store.
+        :param end_date: Last day to read (YYYY-MM-DD) - defaults to the last day in the store.
+        :return: Iterator of the rows as dictionaries of strings.
+        """
+        for station in stations or self.stations():
+            archives = self.archive_files(station)
+            for date in sorted(set(archives) | set(self.partition_dates(station))):
+                if (start_date and date < start_date) or (end_date and date > end_date):
+                    continue
+                for archive in archives.get(date, []):
+                    yield from self._read_archive(archive)
+                for partition in self.partition_files(date, station):
+                    yield from self._read_csv(partition)
+
+    @staticmethod
+    def _read_csv(filename: str) -> Iterator[dict]:
+        """
+        This routine reads the result rows of a partition file or gzip compressed archive.
+
+        :param filename: Name of the file.
+        :return: Iterator of the rows as dictionaries of strings.
+        """
+        opener = gzip.open if filename.endswith('.gz') else open
+        with opener(filename, 'rt', newline='') as csv_file:
+            for row in csv.DictReader(csv_file):
+                if is_result_row(row):
+                    yield row
+
+    def _read_archive(self, archive: str) -> Iterator[dict]:
+        """
+        This routine reads the result rows of an archive file.
+
+        :param archive: Name of the archive file.
+        :return: Iterator of the rows as dictionaries of strings.
+        """
+        if archive.endswith('.' + ARCHIVE_FORMAT_PARQUET):
+            if pyarrow is None:
+                raise RuntimeError('reading {0} needs pyarrow'.format(archive))
+            yield from pyarrow.parquet.read_table(archive).to_pylist()
+        else:
+            yield from self._read_csv(archive)
+
+    def _write_archive(self, archive: str, rows: List[dict], archive_format: str) -> None:
+        """
+        This routine writes an archive file.  It's written to a temporary file first and then renamed so a crash
+        never leaves a partial archive behind.
+
+        :param archive: Name of the archive file.
+        :param rows: Result rows to write.
+        :param archive_format: ARCHIVE_FORMAT_CSV_GZ or ARCHIVE_FORMAT_PARQUET.
+        :return: None
+        """
+        temporary = archive + '.tmp'
+        if archive_format == ARCHIVE_FORMAT_PARQUET:
+            columns = {name: [row.get(name) for row in rows] for name in self.header}
+            pyarrow.parquet.write_table(pyarrow.table(columns), temporary)
+        else:
+            with gzip.open(temporary, 'wt', newline='') as archive_file:
+                writer = csv.DictWriter(archive_file, fieldnames=self.header, extrasaction='ignore')
+                writer.writeheader()
+                writer.writerows(rows)
+        os.replace(temporary, archive)
+
+
+class TestIdAllocator(object):
+    """
+    This class hands out the TestIds of one station to every test of the process that writes results for it, so tests
+    running at the same time never write the same TestId.  It also hands out the partitions the tests write to - a
+    partition is only written by one test at a time, so the result groups of concurrent tests never interleave.  Use
+    station_test_id_allocator() to get the shared instance of a station.
+    """
+
+    def __init__(self, store: PartitionedResultStore):
+        """
+        Class initializer.
+
+        :param store: Result store of the station.
+        """
+        self.store = store
+        self._lock = threading.Lock()
+        self._next_test_id = None  # type: Optional[int]
+        self._open_partitions = set()
+
+    @property
+    def next_test_id(self) -> Optional[int]:
+        """
+        This routine returns the TestId the next allocate() call returns.
+
+        :return: Next TestId or None if no partition has been opened yet.
+        """
+        with self._lock:
+            return self._next_test_id
+
+    def open_partition(self, now: Optional[datetime.datetime] = None) -> str:
+        """
+        This routine hands out the partition a test writes its results to - the active partition of the station unless
+        another test is writing to it.
+
+        :param now: Current time - defaults to now.
+        :return: Name of the partition file.
+        """
+        with self._lock:
+            partition = self.store.active_partition(now, exclude=self._open_partitions)
+            self._open_partitions.add(partition)
+            # the index of the partition is at least the station TestId index (see active_partition())
+            self._next_test_id = max(self._next_test_id or 1, find_next_test_id(partition))
+            return partition
+
+    def allocate(self) -> int:
+        """
+        This routine hands out the next TestId of the station.
+
+        :return: TestId.
+        """
+        with self._lock:
+            if self._next_test_id is None:
+                raise RuntimeError('TestId allocated before a partition of {0} was opened'.format(self.store.station))
+            test_id = self._next_test_id
+            self._next_test_id += 1
+            return test_id
+
+    def close_partition(self, partition: str) -> None:
+        """
+        This routine hands back a partition once its test has written and closed it, and updates the TestId index of
+        the partition and the station.
+
+        :param partition: Name of the partition file.
+        :return: None
+        """
+        with self._lock:
+            self._open_partitions.discard(partition)
+            write_test_id_index(partition, self._next_test_id)
+            self.store.write_station_test_id(self._next_test_id)
+
+
+# shared TestIdAllocator of each station directory of the process
+_station_test_id_allocators = {}  # type: Dict[str, TestIdAllocator]
+_station_test_id_allocators_lock = threading.Lock()
+
+
+def station_test_id_allocator(store: PartitionedResultStore) -> TestIdAllocator:
+    """
+    This routine returns the TestIdAllocator shared by every test of the process that writes to the station of a
+    result store.
+
+    :param store: Result store of the station.
+    :return: TestIdAllocator of the station.
+    """
+    with _station_test_id_allocators_lock:
+        return _station_test_id_allocators.setdefault(os.path.abspath(store.station_dir()), TestIdAllocator(store))
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """
+    This routine is the command line entry point - compacts old partitions or exports rows across partitions.
+
+    :param argv: Command line arguments - defaults to sys.argv.
+    :return: Process exit code.
+    """
+    parser = argparse.ArgumentParser(description='Compact or query a partitioned result store.')
+    parser.add_argument('root_dir', help='root directory of the result store')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    compact_parser = subparsers.add_parser('compact', help='merge old partitions into archives')
+    compact_parser.add_argument('--older-than-days', type=int, default=30)
+    compact_parser.add_argument('--format', choices=(ARCHIVE_FORMAT_CSV_GZ, ARCHIVE_FORMAT_PARQUET),
+                                default=ARCHIVE_FORMAT_CSV_GZ)
+    export_parser = subparsers.add_parser('export', help='write the rows of all partitions as one CSV to stdout')
+    export_parser.add_argument('--station', action='append', help='station to export (repeatable)')
+    export_parser.add_argument('--start-date', help='first day to export (YYYY-MM-DD)')
+    export_parser.add_argument('--end-date', help='last day to export (YYYY-MM-DD)')
+    args = parser.parse_args(argv)
+
+    if args.command == 'compact':
+        log.startLogging(sys.stderr)
+        for station in PartitionedResultStore(args.root_dir, '', []).stations():
+            store = PartitionedResultStore(args.root_dir, station, _archive_header(args.root_dir, station))
+            store.compact(args.older_than_days, args.format)
+    else:
+        writer = None
+        for row in PartitionedResultStore(args.root_dir, '', []).iter_rows(args.station, args.start_date,
+                                                                           args.end_date):
+            if writer is None:
+                writer = csv.DictWriter(sys.stdout, fieldnames=list(row), extrasaction='ignore')
+                writer.writeheader()
+            writer.writerow(row)
+    return 0
+
+
+def _archive_header(root_dir: str, station: str) -> List[str]:
+    """
+    This routine reads the columns of a station's results from the header line of its first partition.
+
+    :param root_dir: Root directory of the result store.
+    :param station: Name of the station.
+    :return: List of the columns.
+    """
+    store = PartitionedResultStore(root_dir, station, [])
+    for date in store.partition_dates():
+        for partition in store.partition_files(date):
+            with open(partition, newline='') as partition_file:
+                return next(csv.reader(partition_file), [])
+    return []
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,395 @@
+"""
+results_db.py
+
+This module is the optional SQLite result database of the test scripts.  It stores the smoke test results, the heater
+calibration results and the time series of every heater run in one database file so results can be queried by UUT,
+firmware version, time and test description instead of searching through CSV files.  The CSV files are still
+written - the database is an additional output that is enabled by setting the database file name in the scripts.
+
+The database runs in WAL mode so several stations (or a reporting tool) can read while a station writes, and rows
+are written in batches with one transaction per batch.
+
+@copyright LumiraDx, 2021. All rights reserved. This code is provided on an
+           "AS IS" basis. LumiraDx DISCLAIMS ALL WARRANTIES, TERMS AND
+           CONDITIONS WITH RESPECT TO THE CODE, EXPRESS, IMPLIED, STATUTORY
+           OR OTHERWISE, INCLUDING WARRANTIES, TERMS OR CONDITIONS OF
+           MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NONINFRINGEMENT
+           AND SATISFACTORY QUALITY. TO THE FULL EXTENT ALLOWED BY LAW,
+           LUMIRADX ALSO EXCLUDES ANY LIABILITY, WHETHER BASED IN CONTRACT
+           OR TORT (INCLUDING NEGLIGENCE), FOR INCIDENTAL, CONSEQUENTIAL,
+           INDIRECT, SPECIAL OR PUNITIVE DAMAGES OF ANY KIND, OR FOR LOSS
+           OF REVENUE OR PROFITS, LOSS OF BUSINESS, LOSS OF INFORMATION OR
+           DATA, OR OTHER FINANCIAL LOSS ARISING OUT OF OR IN CONNECTION
+           WITH THE USE OR PERFORMANCE OF THE CODE.
+"""
+
+import argparse
+import csv
+import datetime
+import os
+import re
+import sqlite3
+import sys
+import threading
+from typing import Iterable, List, Optional, Sequence
+
+# seconds a writer waits for another station's transaction to finish before giving up
+RESULTS_DB_BUSY_TIMEOUT_S = 30.0
+
+# the columns of the smoke test results file and the database columns they are stored in
+SMOKE_COLUMNS = [('TestId', 'test_id'), ('UUT', 'uut'), ('FirmVersion', 'firm_version'),
+                 ('DateTimeStamp', 'date_time_stamp'), ('Description', 'description'), ('Units', 'units'),
+                 ('MeasuredValue', 'measured_value'), ('LowerRangeValue', 'lower_range_value'),
+                 ('HigherRangeValue', 'higher_range_value'), ('Result', 'result')]
+
+# the columns of the heater calibration results file and the database columns they are stored in
+CALHEATER_COLUMNS = [('UUT', 'uut'), ('FirmVersion', 'firm_version'), ('DateTimeStamp', 'date_time_stamp'),
+                     ('t-high', 't_high'), ('c-high', 'c_high'), ('t-low', 't_low'), ('c-low', 'c_low'),
+                     ('timer-value', 'timer_value'), ('stabilized', 'stabilized')]
+
+# stabilization columns added to the heater_runs table of databases created before they existed
+HEATER_RUN_STABILIZATION_COLUMNS = [('stable', 'INTEGER'), ('settling_time', 'REAL'), ('overshoot', 'REAL'),
+                                    ('steady_state_error', 'REAL')]
+
+# name of a heater run data file written by the heater calibration script - "<UUT>  <YYYY-mm-dd_HH-MM-SS>.csv"
+HEATER_RUN_FILENAME_PATTERN = re.compile(r'^(?P<uut>.*?)\s+(?P<started>\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2})\.csv$')
+HEATER_RUN_STARTED_FORMAT = '%Y-%m-%d_%H-%M-%S'
+
+# the 40 degree heater run is the only one whose data file ends with the timer value row
+HEATER_TIMER_ROW_LABEL = 'Timer Value'
+HEATER_TIMER_SETPOINT = 40
+
+# columns without a declared type keep the type of the stored value - measured values are numbers or strings
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS smoke_results (
+    id INTEGER PRIMARY KEY,
+    station TEXT,
+    test_id INTEGER,
+    uut TEXT,
+    firm_version TEXT,
+    date_time_stamp TEXT,
+    description TEXT,
+    units TEXT,
+    measured_value,
+    lower_range_value,
+    higher_range_value,
+    result TEXT
+);
+CREATE INDEX IF NOT EXISTS smoke_results_uut ON smoke_results (uut);
+CREATE INDEX IF NOT EXISTS smoke_results_firm_version ON smoke_results (firm_version);
+CREATE INDEX IF NOT EXISTS smoke_results_date_time_stamp ON smoke_results (date_time_stamp);
+CREATE INDEX IF NOT EXISTS smoke_results_description ON smoke_results (description, firm_version);
+
+CREATE TABLE IF NOT EXISTS heater_calibrations (
+    id INTEGER PRIMARY KEY,
+    station TEXT,
+    uut TEXT,
+    firm_version TEXT,
+    date_time_stamp TEXT,
+    t_high REAL,
+    c_high,
+    t_low REAL,
+    c_low,
+    timer_value REAL,
+    stabilized REAL
+);
+CREATE INDEX IF NOT EXISTS heater_calibrations_uut ON heater_calibrations (uut);
+CREATE INDEX IF NOT EXISTS heater_calibrations_firm_version ON heater_calibrations (firm_version);
+CREATE INDEX IF NOT EXISTS heater_calibrations_date_time_stamp ON heater_calibrations (date_time_stamp);
+
+CREATE TABLE IF NOT EXISTS heater_runs (
+    id INTEGER PRIMARY KEY,
+    station TEXT,
+    uut TEXT,
+    firm_version TEXT,
+    date_time_stamp TEXT,
+    setpoint REAL,
+    csv_filename TEXT,
+    stable INTEGER,
+    settling_time REAL,
+    overshoot REAL,
+    steady_state_error REAL
+);
+CREATE INDEX IF NOT EXISTS heater_runs_uut ON heater_runs (uut);
+CREATE INDEX IF NOT EXISTS heater_runs_firm_version ON heater_runs (firm_version);
+CREATE INDEX IF NOT EXISTS heater_runs_date_time_stamp ON heater_runs (date_time_stamp);
+
+CREATE TABLE IF NOT EXISTS heater_samples (
+    run_id INTEGER NOT NULL REFERENCES heater_runs (id),
+    sample_index INTEGER NOT NULL,
+    adc_counts INTEGER,
+    temperature REAL,
+    duty_cycle REAL,
+    PRIMARY KEY (run_id, sample_index)
+) WITHOUT ROWID;
+"""
+
+
+def _db_value(value):
+    """
+    This routine converts a value of a result row to a value SQLite can store.
+
+    :param value: Value of the result row.
+    :return: The value, as a string if it's not a number or string (i.e. datetime or error code enums).
+    """
+    if value is None or isinstance(value, (int, float, str)):
+        return value
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(sep=' ')
+    if hasattr(value, 'item'):
+        # numpy scalars
+        return value.item()
+    return str(value)
+
+
+class ResultDatabase(object):
+    """
+    This class writes results to the SQLite result database.  The connection can be used from any thread - the calls
+    are serialized by a lock.
+    """
+
+    def __init__(self, db_filename: str):
+        """
+        Class initializer - opens the database, switches it to WAL mode and creates the tables and indexes.
+
+        :param db_filename: Name of the database file.
+        """
+        self.db_filename = db_filename
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(db_filename, timeout=RESULTS_DB_BUSY_TIMEOUT_S, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        # in WAL mode NORMAL only risks the last transactions on a power loss, never the database itself
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        with self._connection:
+            self._connection.executescript(SCHEMA)
+            heater_run_columns = [row[1] for row in self._connection.execute('PRAGMA table_info(heater_runs)')]
+            for column, column_type in HEATER_RUN_STABILIZATION_COLUMNS:
+                if column not in heater_run_columns:
+                    self._connection.execute('ALTER TABLE heater_runs ADD COLUMN {0} {1}'.format(column, column_type))
+
+    def add_smoke_results(self, station: str, rows: Iterable[dict]) -> None:
+        """
+        This routine stores a batch of smoke test result rows in one transaction.
+
+        :param station: Name of the station the results are from.
+        :param rows: Result rows as dictionaries with the smoke test results file columns.
+        :return: None
+        """
+        values = [[station] + [_db_value(row.get(column)) for column, _ in SMOKE_COLUMNS]
+                  for row in rows if row.get('TestId') not in (None, '')]
+        if not values:
+            return
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'INSERT INTO smoke_results (station, {0}) VALUES ({1})'.format(
+                    ', '.join(db_column for _, db_column in SMOKE_COLUMNS), ', '.join('?' * (len(SMOKE_COLUMNS) + 1))),
+                values)
+
+    def add_heater_calibrations(self, station: str, rows: Iterable[dict]) -> None:
+        """
+        This routine stores a batch of heater calibration result rows in one transaction.
+
+        :param station: Name of the station the results are from.
+        :param rows: Result rows as dictionaries with the heater calibration results file columns.
+        :return: None
+        """
+        values = [[station] + [_db_value(row.get(column)) for column, _ in CALHEATER_COLUMNS] for row in rows]
+        if not values:
+            return
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'INSERT INTO heater_calibrations (station, {0}) VALUES ({1})'.format(
+                    ', '.join(db_column for _, db_column in CALHEATER_COLUMNS),
+                    ', '.join('?' * (len(CALHEATER_COLUMNS) + 1))),
+                values)
+
+    def add_heater_run(self, station: str, uut: str, firm_version: str, date_time_stamp: datetime.datetime,
+                       setpoint: float, csv_filename: str, adc_counts_data: Sequence[int],
+                       temperature_data: Sequence[float], duty_cycle_data: Sequence[float],
+                       stabilization=None) -> int:
+        """
+        This routine stores a heater run and its time series in one transaction.
+
+        :param station: Name of the station the run is from.
+        :param uut: Device ID of the unit.
+        :param firm_version: Firmware version of the unit.
+        :param date_time_stamp: Time the run started.
+        :param setpoint: Heater setpoint in degrees C of the run.
+        :param csv_filename: Name of the CSV file of the run.
+        :param adc_counts_data: ADC counts of the samples.
+        :param temperature_data: Temperatures in degrees C of the samples.
+        :param duty_cycle_data: Duty cycles in percent of the samples.
+        :param stabilization: heater_analysis.StabilizationResult of the run or None if it hasn't been analyzed.
+        :return: ID of the stored run.
+        """
+        if stabilization is None:
+            stabilization_values = (None, None, None, None)
+        else:
+            stabilization_values = (int(stabilization.stable), _db_value(stabilization.settling_time),
+                                     _db_value(stabilization.overshoot), _db_value(stabilization.steady_state_error))
+        with self._lock, self._connection:
+            cursor = self._connection.execute(
+                'INSERT INTO heater_runs (station, uut, firm_version, date_time_stamp, setpoint, csv_filename, '
+                'stable, settling_time, overshoot, steady_state_error) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (station, _db_value(uut), _db_value(firm_version), _db_value(date_time_stamp), _db_value(setpoint),
+                 csv_filename) + stabilization_values)
+            run_id = cursor.lastrowid
+            self._connection.executemany(
+                'INSERT INTO heater_samples (run_id, sample_index, adc_counts, temperature, duty_cycle) '
+                'VALUES (?, ?, ?, ?, ?)',
+                ((run_id, index, int(adc_counts), float(temperature), float(duty_cycle))
+                 for index, (adc_counts, temperature, duty_cycle)
+                 in enumerate(zip(adc_counts_data, temperature_data, duty_cycle_data))))
+        return run_id
+
+    def query_smoke_results(self, description: Optional[str] = None, uut: Optional[str] = None,
+                            firm_version_prefix: Optional[str] = None, start: Optional[str] = None,
+                            end: Optional[str] = None) -> List[sqlite3.Row]:
+        """
+        This routine queries the smoke test results - i.e. all "Main PD Optics Measurement" results of firmware
+        versions starting with "0.16.".
+
+        :param description: Test description to match exactly.
+        :param uut: Device ID to match exactly.
+        :param firm_version_prefix: Start of the firmware version.
+        :param start: Earliest DateTimeStamp (i.e. '2022-05-01').
+        :param end: DateTimeStamp before which results are returned (i.e. '2022-06-01').
+        :return: List of the matching rows.
+        """
+        conditions = []
+        parameters = []
+        for condition, value in (('description = ?', description), ('uut = ?', uut),
+                                 ("firm_version LIKE ? ESCAPE '\\'", None if firm_version_prefix is None else
+                                  firm_version_prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+                                  + '%'),
+                                 ('date_time_stamp >= ?', start), ('date_time_stamp < ?', end)):
+            if value is not None:
+                conditions.append(condition)
+                parameters.append(value)
+        sql = 'SELECT * FROM smoke_results'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        with self._lock:
+            cursor = self._connection.execute(sql + ' ORDER BY date_time_stamp, id', parameters)
+            cursor.row_factory = sqlite3.Row
+            return cursor.fetchall()
+
+    def close(self) -> None:
+        """
+        This routine closes the database.
+
+        :return: None
+        """
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+def import_csv(database: ResultDatabase, kind: str, station: str, csv_filename: str) -> int:
+    """
+    This routine imports an existing smoke test or heater calibration results file into the database.
+
+    :param database: Result database.
+    :param kind: 'smoke' or 'calheater'.
+    :param station: Name of the station the results file is from.
+    :param csv_filename: Name of the results file.
+    :return: Number of imported rows.
+    """
+    with open(csv_filename, newline='') as csv_file:
+        rows = [row for row in csv.DictReader(csv_file) if any((value or '').strip() for value in row.values())]
+    if kind == 'smoke':
+        rows = [row for row in rows if (row.get('TestId') or '').strip()]
+        database.add_smoke_results(station, rows)
+    else:
+        database.add_heater_calibrations(station, rows)
+    return len(rows)
+
+
+def import_heater_run_csv(database: ResultDatabase, station: str, csv_filename: str,
+                          setpoint: Optional[float] = None) -> int:
+    """
+    This routine imports an existing heater run data file of the heater calibration script into the database.  The
+    UUT and start time of the run are taken from the file name.  The data files don't record the setpoint or the
+    firmware version - the setpoint is 40 degrees for the run that ends with the timer value row, otherwise it has to
+    be given, and the firmware version is left empty.
+
+    :param database: Result database.
+    :param station: Name of the station the data file is from.
+    :param csv_filename: Name of the heater run data file.
+    :param setpoint: Heater setpoint in degrees C of the run or None if unknown.
+    :return: Number of imported samples.
+    """
+    match = HEATER_RUN_FILENAME_PATTERN.match(os.path.basename(csv_filename))
+    uut = match.group('uut') if match else None
+    started = datetime.datetime.strptime(match.group('started'), HEATER_RUN_STARTED_FORMAT) if match else None
+    adc_counts_data = []
+    temperature_data = []
+    duty_cycle_data = []
+    with open(csv_filename, newline='') as csv_file:
+        reader = csv.reader(csv_file)
+        next(reader, None)  # skip the fields header line
+        for row in reader:
+            if row and row[0] == HEATER_TIMER_ROW_LABEL and setpoint is None:
+                setpoint = HEATER_TIMER_SETPOINT
+            try:
+                adc_counts, temperature, duty_cycle = (float(value) for value in row[:3])
+            except ValueError:
+                # trailing rows such as the 40 degree timer value are not samples
+                continue
+            adc_counts_data.append(adc_counts)
+            temperature_data.append(temperature)
+            duty_cycle_data.append(duty_cycle)
+    database.add_heater_run(station, uut, None, started, setpoint, csv_filename, adc_counts_data, temperature_data,
+                            duty_cycle_data)
+    return len(temperature_data)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """
+    This routine is the command line entry point - imports results files or queries the smoke test results.
+
+    :param argv: Command line arguments - defaults to sys.argv.
+    :return: Process exit code.
+    """
+    parser = argparse.ArgumentParser(description='Import into or query the SQLite result database.')
+    parser.add_argument('db_filename', help='result database file')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    import_parser = subparsers.add_parser('import', help='import results files')
+    import_parser.add_argument('kind', choices=('smoke', 'calheater', 'heaterrun'),
+                               help='smoke test results, heater calibration results or heater run data files')
+    import_parser.add_argument('csv_filenames', nargs='+')
+    import_parser.add_argument('--station', default='')
+    import_parser.add_argument('--setpoint', type=float, help='setpoint of the imported heater run data files')
+    query_parser = subparsers.add_parser('query', help='write matching smoke test results as CSV to stdout')
+    query_parser.add_argument('--description')
+    query_parser.add_argument('--uut')
+    query_parser.add_argument('--firm-version-prefix')
+    query_parser.add_argument('--start')
+    query_parser.add_argument('--end')
+    args = parser.parse_args(argv)
+
+    database = ResultDatabase(args.db_filename)
+    try:
+        if args.command == 'import':
+            for csv_filename in args.csv_filenames:
+                if args.kind == 'heaterrun':
+                    print('{0}: {1} samples'.format(csv_filename, import_heater_run_csv(
+                        database, args.station, csv_filename, args.setpoint)))
+                else:
+                    print('{0}: {1} rows'.format(csv_filename, import_csv(database, args.kind, args.station,
+                                                                          csv_filename)))
+        else:
+            rows = database.query_smoke_results(args.description, args.uut, args.firm_version_prefix, args.start,
+                                                args.end)
+            writer = csv.writer(sys.stdout)
+            if rows:
+                writer.writerow(rows[0].keys())
+            writer.writerows(tuple(row) for row in rows)
+    finally:
+        database.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -26,21 +26,29 @@ ZOO       28-03-2022    Initial code.
 ZOO       20-04-2022   DCR-29217
 """
 
+import collections
 import csv
+import heater_analysis
+import heater_plotting
+import results_db
+import callback_profiling
+import step_pipelining
+import step_timing
 import logging
 from amira_parser import AmiraErrorCodes, AmiraEventCodes
 from amira_test_state_machine import AmiraTestEventParserReturnValues, AmiraTestOperations
-from datetime import datetime
-from typing import List
+from datetime import datetime, timedelta
+from typing import Callable, Iterator, List, Optional, Tuple
 from twisted.python import log
 
 
+import atexit
+import os
 import serial
 import sys
+import threading
 import time
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
+import numpy as np
 
 
 # ***************************************************
@@ -50,7 +58,546 @@ import matplotlib.pyplot as plt
 # default temperature setpoint in degrees C - this value will be used unless the user enters a valid setpoint
 # when prompted
 
+# serial port settings of the reference thermometer - change the port to match the COM port per computer
+REFERENCE_THERMOMETER_PORT = 'COM4'
+REFERENCE_THERMOMETER_BAUDRATE = 115200
 
+# number of timestamped reference thermometer samples kept in memory (roughly 10 minutes at 1 Hz)
+REFERENCE_THERMOMETER_BUFFER_SIZE = 600
+
+# resolution of the instrument RTC tick counter in seconds
+RTC_TICK_PERIOD_S = 30.5e-6
+
+# number of recent heater debug events used to estimate the offset between the instrument RTC and the host clock
+RTC_OFFSET_WINDOW = 64
+
+# number of heater samples preallocated per column - the store doubles its capacity when it fills up
+HEATER_SAMPLE_STORE_CAPACITY = 1024
+
+# number of rows converted to Python values at a time when exporting the sample store
+HEATER_SAMPLE_STORE_EXPORT_CHUNK = 4096
+
+# stabilization criteria of the 30 and 50 degree setpoints - the temperature can't change more than 2 degrees over the
+# last 20 samples
+STABILIZATION_WINDOW_SAMPLES = 20
+STABILIZATION_DELTA_C = 2.0
+
+# the last reading of the 30 and 50 degree runs is the calibration point written to the unit, so those runs only end
+# before the runHeater delay once the temperature has settled far more tightly than the criteria above - over the
+# last STABILIZATION_WINDOW_SAMPLES samples it can't change more than this peak to peak...
+DWELL_CONVERGED_PEAK_TO_PEAK_C = 0.2
+# ...and its trend can't be steeper than this (degrees per sample) - otherwise the full runHeater delay is kept
+DWELL_CONVERGED_SLOPE_C_PER_SAMPLE = 0.005
+
+# stabilization criteria of the 40 degree setpoint - the temperature has to stay within 1 degree of the setpoint for
+# the rest of the 60 seconds after the timer has stopped
+STABLE_SETPOINT_TOLERANCE_C = 1.0
+STABLE_SETPOINT_WINDOW_S = 60
+
+# columns of the heater run .csv file
+HEATER_CSV_HEADER = ['ADC Counts', 'Temperature (Deg.C)', 'Duty Cycle (Percent)']
+
+# heater run .csv rows are buffered and appended to the file once this many rows are buffered or once this many seconds
+# have passed since the last write, whichever comes first
+HEATER_CSV_FLUSH_ROWS = 30
+HEATER_CSV_FLUSH_INTERVAL_S = 10.0
+
+# the heater runs end as soon as the early end criteria above are met - the runHeater step delay is the upper bound -
+# and the cool-down step ends once the reference temperature has dropped to within this many degrees of the ambient
+# temperature recorded when the strip is inserted, before the first heater run.  The timed 40 degree run starts from that temperature, so
+# the margin must stay small or the timer check gets easier to pass; the coolDown step delay is the upper bound
+COOL_DOWN_AMBIENT_MARGIN_C = 2.0
+
+# directory that the heater run .csv and .png files and the heater calibration results file are written to
+HEATER_OUTPUT_DIR = 'heaterdata'
+
+# name and columns of the heater calibration results file
+CALHEATER_CSV_FILENAME = 'calheater.csv'
+CALHEATER_CSV_HEADER = ["UUT","FirmVersion","DateTimeStamp","t-high","c-high","t-low","c-low","timer-value","stabilized"]
+
+# SQLite result database the calibration results and heater run data are also written to (i.e. 'heaterdata/results.db')
+# or None to only write the .csv files
+HEATER_RESULTS_DB_FILENAME = None
+
+# the stabilized temperature plot starts at the first sample within 3 percent of the setpoint
+PLOT_STABILIZED_BAND_FRACTION = 0.03
+
+# heater_plotting.PLOT_MODE_PNG renders a .png plot of every heater run on a worker thread (see
+# heater_plotting.HEATER_PLOT_EXECUTOR),
+# heater_plotting.PLOT_MODE_DECIMATED does the same but draws long runs from a min/max envelope (short runs are drawn
+# with every sample) and heater_plotting.PLOT_MODE_DATA skips the plots and only keeps the .csv data
+HEATER_PLOT_MODE = heater_plotting.PLOT_MODE_DECIMATED
+
+# True to write runs of independent commands (the power rail pairs and heater debug enable and heater init) back to
+# back and match their responses out of order - only for firmware that queues CLI commands, otherwise each command
+# waits for its own response
+HEATER_COMMAND_PIPELINING = False
+
+# directory the per-run step timing traces are written to (see step_timing.py) or None to not time the steps
+HEATER_STEP_TRACE_DIR = None
+
+# directory the callback profile of the run is written to (see callback_profiling.py) or None to not profile the
+# callbacks
+HEATER_CALLBACK_PROFILE_DIR = None
+
+
+class ReferenceThermometerReader(object):
+    """
+    This class owns the serial port of the reference thermometer for the whole run.  A background thread streams
+    timestamped temperature samples into a ring buffer so the heater debug event parser only has to look up the
+    nearest sample instead of opening the port and waiting for a new line on every event.
+    """
+
+    def __init__(self, port: Optional[str] = REFERENCE_THERMOMETER_PORT,
+                 baudrate: int = REFERENCE_THERMOMETER_BAUDRATE, buffer_size: int = REFERENCE_THERMOMETER_BUFFER_SIZE):
+        """
+        Class initializer.
+
+        :param port: Serial port the reference thermometer is connected to (i.e. 'COM4') or None if the samples are
+                     added with add_sample() instead (i.e. by the fake thermometer of amira_emulator.py).
+        :param baudrate: Baud rate of the reference thermometer serial port.
+        :param buffer_size: Maximum number of (timestamp, temperature) samples kept in the ring buffer.
+        """
+        self.port = port
+        self.baudrate = baudrate
+        self.samples = collections.deque(maxlen=buffer_size)
+        self._lock = threading.Lock()
+        self._running = threading.Event()
+        self._serial = None
+        self._thread = None
+
+    def start(self) -> None:
+        """
+        This routine opens the serial port and starts the background reader thread.  Calling it again while the
+        reader is already running or there is no serial port has no effect.
+
+        :return: None.
+        """
+        if self._thread is not None or self.port is None:
+            return
+        # a one second read timeout lets the reader thread block in readline() instead of spinning on inWaiting()
+        self._serial = serial.Serial(port=self.port, baudrate=self.baudrate, timeout=1)
+        self._running.set()
+        self._thread = threading.Thread(target=self._read_loop, name='reference-thermometer', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        This routine stops the background reader thread and closes the serial port.
+
+        :return: None.
+        """
+        self._running.clear()
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+            self._thread = None
+        if self._serial is not None:
+            self._serial.close()
+            self._serial = None
+
+    def add_sample(self, timestamp: float, temperature: float) -> None:
+        """
+        This routine stores a temperature sample in the ring buffer.  The oldest sample is dropped once the buffer
+        is full.
+
+        :param timestamp: time.perf_counter() value at which the sample was received.
+        :param temperature: Reference temperature in degrees C.
+        :return: None.
+        """
+        with self._lock:
+            self.samples.append((timestamp, temperature))
+
+    def nearest_sample(self, timestamp: float) -> Optional[Tuple[float, float]]:
+        """
+        This routine looks up the buffered sample closest in time to the given timestamp.
+
+        :param timestamp: time.perf_counter() value to look up.
+        :return: (timestamp, temperature) tuple of the nearest sample or None if no sample has been received yet.
+        """
+        nearest = None
+        with self._lock:
+            # lookups are always close to the newest sample so walk backwards from the end of the buffer and stop
+            # at the first sample older than the requested timestamp
+            for sample in reversed(self.samples):
+                if nearest is None or abs(sample[0] - timestamp) < abs(nearest[0] - timestamp):
+                    nearest = sample
+                if sample[0] <= timestamp:
+                    break
+        return nearest
+
+    def interpolate(self, timestamp: float) -> Optional[float]:
+        """
+        This routine linearly interpolates the reference temperature onto the given timestamp.
+
+        :param timestamp: time.perf_counter() value to interpolate the temperature at.
+        :return: Interpolated temperature in degrees C, the oldest buffered temperature if the timestamp is older than
+                 the buffer, or None if no sample at or after the timestamp has been received yet.
+        """
+        with self._lock:
+            if not self.samples or self.samples[-1][0] < timestamp:
+                return None
+            newer = self.samples[-1]
+            for sample in reversed(self.samples):
+                if sample[0] <= timestamp:
+                    if sample[0] == newer[0]:
+                        return sample[1]
+                    fraction = (timestamp - sample[0]) / (newer[0] - sample[0])
+                    return sample[1] + fraction * (newer[1] - sample[1])
+                newer = sample
+            return newer[1]
+
+    def _read_loop(self) -> None:
+        """
+        Body of the background reader thread - reads lines from the thermometer until stop() is called.
+
+        :return: None.
+        """
+        encoding = sys.getdefaultencoding()
+        while self._running.is_set():
+            try:
+                line = self._serial.readline()
+            except serial.SerialException as error:
+                log.msg('reference thermometer: serial read failed: {0}'.format(error), logLevel=logging.ERROR)
+                break
+            if not line:
+                # readline() timed out without any data
+                continue
+            try:
+                temperature = float(line.decode(encoding).strip("b'\r\n'"))
+            except ValueError:
+                # partial line (i.e. the first line received after opening the port)
+                continue
+            self.add_sample(time.perf_counter(), temperature)
+
+
+class HeaterSampleAligner(object):
+    """
+    This class pairs heater debug events with reference thermometer samples.  Both streams are keyed on the host
+    time.perf_counter() clock - each event is placed on it using its RTC tick count - and the reference temperature is
+    interpolated onto the event timestamp once the thermometer has delivered a sample at or after it.
+    """
+
+    def __init__(self, offset_window: int = RTC_OFFSET_WINDOW):
+        """
+        Class initializer.
+
+        :param offset_window: Number of recent events used to estimate the RTC to host clock offset.
+        """
+        self.pending = collections.deque()
+        self._offsets = collections.deque(maxlen=offset_window)
+        self._last_rtc_ticks = None
+
+    def event_time(self, host_time: float, rtc_ticks: int) -> float:
+        """
+        This routine converts the RTC tick count of an event into a host clock timestamp.
+
+        :param host_time: time.perf_counter() value at which the event was received.
+        :param rtc_ticks: Running RTC tick count of the instrument with a 30.5 uS resolution.
+        :return: Host clock timestamp at which the event was generated by the instrument.
+        """
+        rtc_time = rtc_ticks * RTC_TICK_PERIOD_S
+        if self._last_rtc_ticks is not None and rtc_ticks < self._last_rtc_ticks:
+            # the RTC has restarted (i.e. the instrument was reset) so the previous offsets no longer apply
+            self._offsets.clear()
+        self._last_rtc_ticks = rtc_ticks
+        # the smallest recent offset belongs to the event that was delayed the least by the serial link and parsing
+        self._offsets.append(host_time - rtc_time)
+        return rtc_time + min(self._offsets)
+
+    def add_event(self, host_time: float, rtc_ticks: int, adc_counts: int, duty_cycle: int) -> None:
+        """
+        This routine queues a heater debug event until its reference temperature can be interpolated.
+
+        :param host_time: time.perf_counter() value at which the event was received.
+        :param rtc_ticks: Running RTC tick count of the instrument with a 30.5 uS resolution.
+        :param adc_counts: Heater ADC counts reported in the event.
+        :param duty_cycle: Heater duty cycle in percent reported in the event.
+        :return: None.
+        """
+        self.pending.append((self.event_time(host_time, rtc_ticks), adc_counts, duty_cycle))
+
+    def resolve(self, reference_thermometer: ReferenceThermometerReader) -> List[Tuple[float, int, int, float]]:
+        """
+        This routine returns the queued events whose reference temperature can now be interpolated.
+
+        :param reference_thermometer: Reader with the buffered reference thermometer samples.
+        :return: List of (event time, ADC counts, duty cycle, temperature) tuples in event order.
+        """
+        aligned = []
+        while self.pending:
+            temperature = reference_thermometer.interpolate(self.pending[0][0])
+            if temperature is None:
+                break
+            event_time, adc_counts, duty_cycle = self.pending.popleft()
+            aligned.append((event_time, adc_counts, duty_cycle, temperature))
+        return aligned
+
+    def flush(self, reference_thermometer: ReferenceThermometerReader) -> List[Tuple[float, int, int, float]]:
+        """
+        This routine returns all queued events, using the nearest reference sample for events that could not be
+        interpolated (i.e. the last events of a heater run).
+
+        :param reference_thermometer: Reader with the buffered reference thermometer samples.
+        :return: List of (event time, ADC counts, duty cycle, temperature) tuples in event order.
+        """
+        aligned = self.resolve(reference_thermometer)
+        while self.pending:
+            event_time, adc_counts, duty_cycle = self.pending.popleft()
+            sample = reference_thermometer.nearest_sample(event_time)
+            if sample is None:
+                log.msg('heater debug capture: no reference thermometer reading for event, dropping it',
+                        logLevel=logging.WARNING)
+                continue
+            aligned.append((event_time, adc_counts, duty_cycle, sample[1]))
+        return aligned
+
+
+class HeaterSampleStore(object):
+    """
+    This class stores the heater debug samples of a heater run in preallocated NumPy columns instead of growing
+    Python lists of boxed values.  The column properties return views of the stored data so consumers (CSV export,
+    stabilization checks and plotting) read it without copying.
+    """
+
+    def __init__(self, capacity: int = HEATER_SAMPLE_STORE_CAPACITY):
+        """
+        Class initializer.
+
+        :param capacity: Number of samples to preallocate per column.
+        """
+        self._adc_counts = np.empty(capacity, dtype=np.int64)
+        self._temperature = np.empty(capacity, dtype=np.float64)
+        self._duty_cycle = np.empty(capacity, dtype=np.float64)
+        self._duty_cycle_integral = True
+        self._length = 0
+
+    def __len__(self) -> int:
+        return self._length
+
+    @property
+    def adc_counts(self) -> np.ndarray:
+        """
+        View of the stored heater ADC counts.
+        """
+        return self._adc_counts[:self._length]
+
+    @property
+    def temperature(self) -> np.ndarray:
+        """
+        View of the stored reference temperatures in degrees C.
+        """
+        return self._temperature[:self._length]
+
+    @property
+    def duty_cycle(self) -> np.ndarray:
+        """
+        View of the stored heater duty cycles in percent.
+        """
+        return self._duty_cycle[:self._length]
+
+    def append(self, adc_counts: int, temperature: float, duty_cycle: float) -> None:
+        """
+        This routine appends one sample to the store, growing the columns if they are full.
+
+        :param adc_counts: Heater ADC counts.
+        :param temperature: Reference temperature in degrees C.
+        :param duty_cycle: Heater duty cycle in percent.
+        :return: None.
+        """
+        if self._length == len(self._temperature):
+            self._grow()
+        index = self._length
+        self._adc_counts[index] = adc_counts
+        self._temperature[index] = temperature
+        self._duty_cycle[index] = duty_cycle
+        # remember whether the firmware reports whole duty cycle percentages so the CSV keeps its original format
+        if self._duty_cycle_integral and not float(duty_cycle).is_integer():
+            self._duty_cycle_integral = False
+        self._length += 1
+
+    def window(self, start: int, stop: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        This routine returns views of a range of samples.  Negative indexes count from the newest sample.
+
+        :param start: Index of the first sample in the window.
+        :param stop: Index one past the last sample in the window or None for the newest sample.
+        :return: (ADC counts, temperature, duty cycle) views of the window.
+        """
+        window = slice(start, stop)
+        return self.adc_counts[window], self.temperature[window], self.duty_cycle[window]
+
+    def rows(self) -> Iterator[list]:
+        """
+        This routine iterates over the stored samples as CSV rows, converting them to Python values one chunk at
+        a time.
+
+        :return: Iterator of [ADC counts, temperature, duty cycle] rows.
+        """
+        for start in range(0, self._length, HEATER_SAMPLE_STORE_EXPORT_CHUNK):
+            adc_counts, temperature, duty_cycle = self.window(start, min(start + HEATER_SAMPLE_STORE_EXPORT_CHUNK,
+                                                                         self._length))
+            if self._duty_cycle_integral:
+                duty_cycle = duty_cycle.astype(np.int64)
+            yield from zip(adc_counts.tolist(), temperature.tolist(), duty_cycle.tolist())
+
+    def clear(self) -> None:
+        """
+        This routine empties the store while keeping the preallocated columns for the next heater run.
+
+        :return: None.
+        """
+        self._length = 0
+        self._duty_cycle_integral = True
+
+    def _grow(self) -> None:
+        """
+        This routine doubles the capacity of every column.  Views handed out earlier keep referring to the old
+        columns and remain valid.
+
+        :return: None.
+        """
+        capacity = max(1, 2 * len(self._temperature))
+        for name in ('_adc_counts', '_temperature', '_duty_cycle'):
+            column = getattr(self, name)
+            grown = np.empty(capacity, dtype=column.dtype)
+            grown[:self._length] = column[:self._length]
+            setattr(self, name, grown)
+
+
+class HeaterCsvStreamWriter(object):
+    """
+    This class streams the rows of a heater run .csv file to disk in buffered batches while the heater is running.
+    The rows are written to a temporary '.part' file which is renamed to the final file name once the run has been
+    finalized, so a crash leaves the rows written so far in the '.part' file and never a truncated .csv file.
+    """
+
+    def __init__(self, csv_filename: str, flush_rows: int = HEATER_CSV_FLUSH_ROWS,
+                 flush_interval: float = HEATER_CSV_FLUSH_INTERVAL_S):
+        """
+        Class initializer - creates the temporary file and writes the fields header line.
+
+        :param csv_filename: Name of the final heater run .csv file.
+        :param flush_rows: Number of buffered rows that triggers a write to the file.
+        :param flush_interval: Time in seconds since the last write that triggers a write to the file.
+        """
+        self.csv_filename = csv_filename
+        self.partial_filename = csv_filename + '.part'
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self._rows = []
+        self._file = open(self.partial_filename, mode='w')
+        self._writer = csv.writer(self._file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        self._writer.writerow(HEATER_CSV_HEADER)
+        self._last_flush = time.perf_counter()
+
+    def write_row(self, row: list) -> None:
+        """
+        This routine buffers a row and writes the buffered rows to the file when the flush limits are reached.
+
+        :param row: Row of data to write.
+        :return: None.
+        """
+        self._rows.append(row)
+        if len(self._rows) >= self.flush_rows or time.perf_counter() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        This routine writes the buffered rows to the file.
+
+        :return: None.
+        """
+        self._writer.writerows(self._rows)
+        self._rows = []
+        self._file.flush()
+        self._last_flush = time.perf_counter()
+
+    def finalize(self, trailer_rows: List[list] = ()) -> None:
+        """
+        This routine writes the remaining rows followed by the trailer rows, syncs the file to disk and renames it to
+        the final file name.
+
+        :param trailer_rows: Rows to write after the data rows (i.e. the 40 degree timer value).
+        :return: None.
+        """
+        self._rows.extend(trailer_rows)
+        self.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.replace(self.partial_filename, self.csv_filename)
+
+    def discard(self) -> None:
+        """
+        This routine closes and deletes the temporary file without creating the final file.
+
+        :return: None.
+        """
+        self._rows = []
+        self._file.close()
+        os.remove(self.partial_filename)
+
+
+class HeaterRunContext(object):
+    """
+    This class holds the state of one heater calibration run.  Each instrument/station gets its own context so
+    several calibrations can run in one process without sharing any state.
+    """
+
+    def __init__(self, station_name: str = '', thermometer_port: Optional[str] = REFERENCE_THERMOMETER_PORT,
+                 output_dir: str = HEATER_OUTPUT_DIR, clock: Callable[[], float] = time.perf_counter):
+        """
+        Class initializer.
+
+        :param station_name: Name of the station/dock the instrument is in.  Used to prefix console output.
+        :param thermometer_port: Serial port of the reference thermometer of the station (i.e. 'COM4') or None if the
+                                 samples are fed by the emulator.
+        :param output_dir: Directory the output files of the station are written to.
+        :param clock: Time source in seconds of the heater timer and the heater debug event timestamps - the virtual
+                      clock of amira_emulator.py in emulated runs.
+        """
+        self.station_name = station_name
+        self.thermometer_port = thermometer_port
+        self.output_dir = output_dir
+        self.t_high=50#50 degree setpoint cal value
+        self.version=0#Holds the current firmware version of the device
+        self.uut=0#Holds the device ID
+        self.t_low=30#30 degree setpoint cal calue
+        self.t_stable=0#Record the value that our setpoint of 40 stabilizes at
+        self.timer_start=0#Value of timer when it starts
+        self.timer_done=True#When false the program begins to track a timer
+        self.timer_value=80#Value of how long it takes to heat to 35 when calibrated to 40
+        self.ambient_temperature=None#Reference temperature after the strip has been inserted, before the first heater run
+        self.error_string=""#This will contain all information generated and will be printed at the end of calibration
+        self.use_clock(clock)
+
+    def use_clock(self, clock: Callable[[], float]) -> None:
+        """
+        This routine sets the time source of the run.  The timestamps of the run's output files follow the same clock
+        so the runs of a virtual-time sequence get distinct file names.
+
+        :param clock: Time source in seconds (i.e. time.perf_counter).
+        :return: None
+        """
+        self.clock = clock
+        self._clock_origin = (datetime.today(), clock())
+
+    def today(self) -> datetime:
+        """
+        This routine returns the current date and time on the clock of the run.
+
+        :return: Current date and time.
+        """
+        origin_date, origin_time = self._clock_origin
+        return origin_date + timedelta(seconds=self.clock() - origin_time)
+
+    def output_path(self, filename: str) -> str:
+        """
+        This routine builds the path of an output file of the station.
+
+        :param filename: Name of the output file.
+        :return: Path of the output file in the output directory of the station.
+        """
+        return os.path.join(self.output_dir, filename)
 
 
 class TestHandler(object):
@@ -58,23 +605,32 @@ class TestHandler(object):
     This class is used in combination with a test sequence list to test the heater in the Amira instrument.
     """
     # class attribute type hints
-    adc_counts_data: List[int]
-    temperature_data: List[float]
+    samples: HeaterSampleStore
     temperature_setpoint: int
 
-    def __init__(self):
+    def __init__(self, run_context: HeaterRunContext):
         """
         Class initializer.
+
+        :param run_context: State of the heater calibration run handled by this instance.
         """
+        self.run_context = run_context
         self.allow_heater_data_collection = True
-        self.adc_counts_data = []
-        self.duty_cycle_data = []
-        self.temperature_data = []
+        self.samples = HeaterSampleStore()
+        self.stabilization_results = []  # type: List[heater_analysis.StabilizationResult]
+        self.heater_run_filename = None
+        self.heater_run_started = None
+        self.heater_csv = None
+        self.results_db = results_db.ResultDatabase(HEATER_RESULTS_DB_FILENAME) if HEATER_RESULTS_DB_FILENAME else None
+        self.timer_done_sample_index = None
+        self.plot_renderer = heater_plotting.HeaterPlotRenderer(HEATER_PLOT_MODE)
         self.temperature_setpoint = [30,50,40]#the three test values
         self.temperature_setpoint_index=0#keeps track of which value we are on
+        self.reference_thermometer = ReferenceThermometerReader(run_context.thermometer_port)
+        self.sample_aligner = HeaterSampleAligner()
 
     def heater_debug_capture_event_parser(self, _test_step_index: int, event_code: AmiraEventCodes,
-                                          _time_of_day: int, _time_str: str, _rtc_ticks: int,
+                                          _time_of_day: int, _time_str: str, rtc_ticks: int,
                                           event_payload: dict) -> AmiraTestEventParserReturnValues:
         """
         This function is used to customize the parsing of heater debug data events.
@@ -83,63 +639,147 @@ class TestHandler(object):
         :param event_code: Code of the event that has been received (i.e. AmiraEventCodes.app_fsm_door_open)
         :param _time_of_day: Unix timestamp of the event (i.e. 205296989).  Not used by this routine.
         :param _time_str: Time of day string (i.e. '07/04/76 02:56:29 AM').  Not used by this routine.
-        :param _rtc_ticks: Running RTC tick count of the instrument with a 30.5 uS resolution (i.e. 347004915).
-                           Not used by this routine,
+        :param rtc_ticks: Running RTC tick count of the instrument with a 30.5 uS resolution (i.e. 347004915).
+                          Used to align the event with the reference thermometer samples.
         :param event_payload: JSON formatted payload (if any) of the event that has been received.  For the heater
                               debug event, there is additional data available to be used by this rouine.
 
-        :return: Always AmiraTestEventParserReturnValues.ignore to instruct the scripting engine to continue to run.
+        :return: AmiraTestEventParserReturnValues.success once the heater has stabilized to end the heater run early,
+                 otherwise AmiraTestEventParserReturnValues.ignore to instruct the scripting engine to continue to run.
         """
-        global timer_done
-        global timer_value
-        global timer_start
-        global t_high
-        global t_low
-        global t_stable
-        temperature_reading=0
-        
-        ser=serial.Serial()
-        ser.timeout = 0
-        ser.port = "COM4" #Change to match the COM per computer
-        ser.baudrate = '115200'
-        ser.open()
-
-        encoding = sys.getdefaultencoding()
-
-        while True:
-            if ser.inWaiting() >7:
-                temp=ser.readline()
-                temp = temp.decode(encoding)
-                temp = temp.strip("b'\r\n'")
-                temp=float(temp)
-                temperature_reading=temp
-                print(temperature_reading)
-                if self.temperature_setpoint_index==0:#If the setpoint is 30
-                    t_low=temperature_reading
-                if self.temperature_setpoint_index==1:#If the setpoint is 50
-                    t_high=temperature_reading
-                if self.temperature_setpoint_index==2:#If the setpoint is 40
-                    t_stable=temperature_reading    
-                if timer_done == False and temperature_reading>39:#Time is only false when setpoint is 40 
-                    timer_value=time.perf_counter()-timer_start#Record timer value when temperature hits 39 degrees
-                    timer_done=True
-                break
-
         if event_code == AmiraEventCodes.heater_debug_log and self.allow_heater_data_collection:
-            
-            # append the data sent in this event message
+
+            # queue the data sent in this event message until the reference temperature can be interpolated onto it
             if all([key in event_payload.keys() for key in ['adc-counts', 'duty-cycle-percent', 'temperature-c']]):
-                self.adc_counts_data.append(event_payload['adc-counts'])
-                self.duty_cycle_data.append(event_payload['duty-cycle-percent'])
-                self.temperature_data.append(temperature_reading)
+                self.sample_aligner.add_event(self.run_context.clock(), rtc_ticks, event_payload['adc-counts'],
+                                              event_payload['duty-cycle-percent'])
+
+            for aligned_sample in self.sample_aligner.resolve(self.reference_thermometer):
+                self.record_heater_sample(*aligned_sample)
 
-                log.msg('heater debug capture: ADC count: {0}, duty cycle: {1}, temperature: {2}'.format(
-                        event_payload['adc-counts'], event_payload['duty-cycle-percent'],
-                        temperature_reading), logLevel=logging.INFO)
+            if self.heater_dwell_converged():
+                # the heater has already stabilized so there's no need to wait out the rest of the heater run
+                log.msg('heater debug capture: setpoint {0} stabilized after {1} samples, ending heater run'.format(
+                        self.temperature_setpoint[self.temperature_setpoint_index], len(self.samples)),
+                        logLevel=logging.INFO)
+                return AmiraTestEventParserReturnValues.success
 
         # return .ignore to instruct the test sequence state machine to proceed with the sequence
         return AmiraTestEventParserReturnValues.ignore
 
+    def heater_dwell_converged(self) -> bool:
+        """
+        This routine checks the live heater data against the criteria for ending the heater run of the current
+        setpoint early - the stabilization criteria for the 40 degree run and the much tighter settling criteria
+        (see DWELL_CONVERGED_PEAK_TO_PEAK_C) for the 30 and 50 degree calibration runs, so a slow ramp never ends a
+        calibration run.
+
+        :return: True if enough data has been collected and the criteria are met, otherwise False.
+        """
+        temperature_data = self.samples.temperature
+        setpoint = self.temperature_setpoint[self.temperature_setpoint_index]
+        if self.temperature_setpoint_index==2:
+            # the whole window after the timer has stopped has to be collected before the run can end
+            if not self.run_context.timer_done or self.timer_done_sample_index is None:
+                return False
+            window = STABLE_SETPOINT_WINDOW_S-int(self.run_context.timer_value)
+            if window <= 0 or len(temperature_data) - self.timer_done_sample_index < window:
+                return False
+            return heater_analysis.window_in_band(temperature_data, setpoint - STABLE_SETPOINT_TOLERANCE_C,
+                                                  setpoint + STABLE_SETPOINT_TOLERANCE_C, window)
+        elif self.temperature_setpoint_index==0 or self.temperature_setpoint_index==1:
+            return heater_analysis.window_settled(temperature_data, STABILIZATION_WINDOW_SAMPLES,
+                                                  DWELL_CONVERGED_PEAK_TO_PEAK_C, DWELL_CONVERGED_SLOPE_C_PER_SAMPLE)
+        return False
+
+    def cool_down_event_parser(self, _test_step_index: int, _event_code: AmiraEventCodes,
+                               _time_of_day: int, _time_str: str, _rtc_ticks: int,
+                               _event_payload: dict) -> AmiraTestEventParserReturnValues:
+        """
+        This function is used to end the cool-down step early once the heater has cooled down.  It relies on the
+        heater debug events that keep arriving while heater debug output is enabled.
+
+        :param _test_step_index: Index of the currently executing test step.  Not used by this routine.
+        :param _event_code: Code of the event that has been received.  Not used by this routine.
+        :param _time_of_day: Unix timestamp of the event (i.e. 205296989).  Not used by this routine.
+        :param _time_str: Time of day string (i.e. '07/04/76 02:56:29 AM').  Not used by this routine.
+        :param _rtc_ticks: Running RTC tick count of the instrument with a 30.5 uS resolution (i.e. 347004915).
+                           Not used by this routine.
+        :param _event_payload: JSON formatted payload (if any) of the event that has been received.
+                               Not used by this routine.
+        :return: AmiraTestEventParserReturnValues.success once the reference temperature is within
+                 COOL_DOWN_AMBIENT_MARGIN_C of the ambient temperature, otherwise
+                 AmiraTestEventParserReturnValues.ignore (the whole delay is waited out if the ambient temperature is
+                 unknown).
+        """
+        if self.run_context.ambient_temperature is None:
+            return AmiraTestEventParserReturnValues.ignore
+        threshold = self.run_context.ambient_temperature + COOL_DOWN_AMBIENT_MARGIN_C
+        sample = self.reference_thermometer.nearest_sample(self.run_context.clock())
+        if sample is not None and sample[1] <= threshold:
+            log.msg('cool down: reference temperature {0} is within {1} of the ambient {2}, ending cool down'.format(
+                    sample[1], COOL_DOWN_AMBIENT_MARGIN_C, self.run_context.ambient_temperature),
+                    logLevel=logging.INFO)
+            return AmiraTestEventParserReturnValues.success
+        return AmiraTestEventParserReturnValues.ignore
+
+    def start_reference_thermometer_on_entry(self, _test_step_index: int) -> bool:
+        """
+        This routine is called on entry into the test step that waits for the strip to be inserted.  It starts the
+        reference thermometer so it has samples of the ambient temperature once the strip is in.
+
+        :param _test_step_index: Current test step index of the test sequence.  Not used by this routine.
+        :return: True if this routine has executed properly or False if there was an error.
+        """
+        self.reference_thermometer.start()
+        return True
+
+    def record_ambient_temperature_on_exit(self, _test_step_index: int) -> bool:
+        """
+        This routine is called on exit from the test step that waits for the strip to be inserted.  It records the
+        reference temperature before the first heater run as the ambient temperature the cool-down steps return to.
+        The cool-down steps wait out their whole delay if no sample has been received yet.
+
+        :param _test_step_index: Current test step index of the test sequence.  Not used by this routine.
+        :return: True if this routine has executed properly or False if there was an error.
+        """
+        sample = self.reference_thermometer.nearest_sample(self.run_context.clock())
+        if sample is not None:
+            self.run_context.ambient_temperature = sample[1]
+        log.msg('cool down: ambient temperature {0}'.format(self.run_context.ambient_temperature),
+                logLevel=logging.INFO)
+        return True
+
+    def record_heater_sample(self, event_time: float, adc_counts: int, duty_cycle: int,
+                             temperature_reading: float) -> None:
+        """
+        This routine stores a heater debug sample once the reference temperature has been aligned with it.
+
+        :param event_time: time.perf_counter() timestamp at which the instrument generated the event.
+        :param adc_counts: Heater ADC counts reported in the event.
+        :param duty_cycle: Heater duty cycle in percent reported in the event.
+        :param temperature_reading: Reference temperature in degrees C interpolated onto the event time.
+        :return: None.
+        """
+        self.print_station_output(str(temperature_reading))
+        if self.temperature_setpoint_index==0:#If the setpoint is 30
+            self.run_context.t_low=temperature_reading
+        if self.temperature_setpoint_index==1:#If the setpoint is 50
+            self.run_context.t_high=temperature_reading
+        if self.temperature_setpoint_index==2:#If the setpoint is 40
+            self.run_context.t_stable=temperature_reading
+        if self.run_context.timer_done == False and temperature_reading>39:#Time is only false when setpoint is 40
+            self.run_context.timer_value=event_time-self.run_context.timer_start#Record timer value when temperature hits 39 degrees
+            self.run_context.timer_done=True
+            self.timer_done_sample_index=len(self.samples)
+
+        self.samples.append(adc_counts, temperature_reading, duty_cycle)
+        if self.heater_csv is not None:
+            self.heater_csv.write_row([adc_counts, temperature_reading, duty_cycle])
+
+        log.msg('heater debug capture: ADC count: {0}, duty cycle: {1}, temperature: {2}'.format(
+                adc_counts, duty_cycle, temperature_reading), logLevel=logging.INFO)
+
     def motor_movement_complete_event_parser(
             self, _test_step_index: int,
             event_code: AmiraEventCodes,
@@ -179,67 +819,69 @@ class TestHandler(object):
                  event code.
         """
         self.allow_heater_data_collection = False
-        global timer_value
-        global error_string
-
-        if self.temperature_setpoint_index==2 and self.temperature_data[len(self.temperature_data)-1]<30:#If no temperature is detected above 30 strip isnt inserted when setpoint is 40
-            error_string=error_string+" CRITICAL ERROR STRIP NEVER INSERTED"
-            print(error_string)
-
-        if len(self.adc_counts_data):
-            if self.temperature_setpoint_index==2:
-                    passed=True
-                    for i in range(len(self.temperature_data)-60+int(timer_value),len(self.temperature_data)-1):
-                        if self.temperature_data[i]>41 or self.temperature_data[i]<39:#Confirms that the temperature stays withing 1 degrees of 40 degrees
-                            error_string=error_string+'{0} FAILURE TO STABILIZE, '.format(self.temperature_setpoint[self.temperature_setpoint_index])
-                            passed=False#Marked that it failed to stabilize
-                            break
-                    if passed:
-                        error_string=error_string+'{0} Stabilized Correctly, '.format(self.temperature_setpoint[self.temperature_setpoint_index])
-            elif self.temperature_setpoint_index==0 or self.temperature_setpoint_index==1: 
-                    passed=True
-                    for i in range(len(self.temperature_data)-20,len(self.temperature_data)-1):#Confirms temperature hasn't changed more than 2 degrees in 30 seconds
-                        if abs(self.temperature_data[len(self.temperature_data)-1]-self.temperature_data[i])>2:
-                            error_string=error_string+'{0} FAILURE TO STABILIZE, '.format(self.temperature_setpoint[self.temperature_setpoint_index])
-                            passed=False#Marked that it failed to stabilize
-                            break
-                    if passed:
-                        error_string=error_string+'{0} Stabilized Correctly, '.format(self.temperature_setpoint[self.temperature_setpoint_index])
-      
-            else:
-                error_string=error_string+'{0} FAILURE TO STABILIZE, '.format(self.temperature_setpoint[self.temperature_setpoint_index])
-            heater_csv_filename = '{0}  {1}.csv'.format(UUT,datetime.today().strftime('%Y-%m-%d_%H-%M-%S'))
-            heater_plot_filename = '{0}  {1}.png'.format(UUT,datetime.today().strftime('%Y-%m-%d_%H-%M-%S'))
 
-            # write all the data to a CSV file
+        # pick up the events still waiting for a reference thermometer sample
+        for aligned_sample in self.sample_aligner.flush(self.reference_thermometer):
+            self.record_heater_sample(*aligned_sample)
+        temperature_data = self.samples.temperature
+
+        if self.temperature_setpoint_index==2 and temperature_data[len(temperature_data)-1]<30:#If no temperature is detected above 30 strip isnt inserted when setpoint is 40
+            self.run_context.error_string=self.run_context.error_string+" CRITICAL ERROR STRIP NEVER INSERTED"
+            self.print_station_output(self.run_context.error_string)
+
+        if len(self.samples):
+            # the stabilization results of the runs are reported at the end of the calibration
+            stabilization = self.analyze_stabilization()
+            if stabilization is not None:
+                self.stabilization_results.append(stabilization)
+            heater_plot_filename = '{0}.png'.format(self.heater_run_filename)
+
+            # the data rows have been streamed to the CSV file while the heater was running - finish the file
             self.print_to_stdout('Saving data to .csv file ...')
+            trailer_rows = []
+            if self.temperature_setpoint_index == 2 and self.run_context.timer_done:
+                trailer_rows.append(["Timer Value","Seconds",str(self.run_context.timer_value)])
+            self.heater_csv.finalize(trailer_rows)
+            if self.results_db is not None:
+                self.results_db.add_heater_run(self.run_context.station_name, self.run_context.uut,
+                                               self.run_context.version, self.heater_run_started,
+                                               self.temperature_setpoint[self.temperature_setpoint_index],
+                                               self.heater_csv.csv_filename, self.samples.adc_counts,
+                                               self.samples.temperature, self.samples.duty_cycle, stabilization)
+            self.heater_csv = None
 
-            with open("heaterdata/"+heater_csv_filename, mode='w') as heater_data_file:
-                heater_data_writer = csv.writer(heater_data_file, delimiter=',', quotechar='"',
-                                                quoting=csv.QUOTE_MINIMAL)
-
-                # write the fields header line
-                heater_data_writer.writerow(['ADC Counts', 'Temperature (Deg.C)', 'Duty Cycle (Percent)'])
-
-                num_data_points = len(self.adc_counts_data)
-                index = 0
-                while index < num_data_points:
-                    # write the row of data
-                    heater_data_writer.writerow([self.adc_counts_data[index], self.temperature_data[index],
-                                                 self.duty_cycle_data[index]])
-                    # increment the index
-                    index += 1
-                if self.temperature_setpoint_index == 2 and timer_done:
-                    heater_data_writer.writerow(["Timer Value","Seconds",str(timer_value)])
             # create and save a plot of the data
             self.print_to_stdout('Plotting data ...')
-            self.plot_heater_data("heaterdata/"+heater_plot_filename, self.adc_counts_data, self.temperature_data,
-                                  self.duty_cycle_data)
-            
+            self.plot_heater_data(self.run_context.output_path(heater_plot_filename), self.samples.adc_counts,
+                                  self.samples.temperature, self.samples.duty_cycle)
+        elif self.heater_csv is not None:
+            # no data was collected so there is no CSV file to keep
+            self.heater_csv.discard()
+            self.heater_csv = None
+
 
         # return True to indicate that the routine executed properly with no errors
         return True
 
+    def analyze_stabilization(self) -> Optional[heater_analysis.StabilizationResult]:
+        """
+        This routine applies the stabilization criteria of the current setpoint to the collected temperature data.
+
+        :return: StabilizationResult of the current heater run or None if there are no criteria for the setpoint.
+        """
+        temperature_data = self.samples.temperature
+        setpoint = self.temperature_setpoint[self.temperature_setpoint_index]
+        if self.temperature_setpoint_index==2:
+            # the temperature has to stay within 1 degree of 40 degrees after the timer has stopped
+            return heater_analysis.analyze_heater_response(temperature_data, setpoint, STABLE_SETPOINT_TOLERANCE_C,
+                                                           STABLE_SETPOINT_WINDOW_S-int(self.run_context.timer_value))
+        elif self.temperature_setpoint_index==0 or self.temperature_setpoint_index==1:
+            # the temperature can't have changed more than 2 degrees from the last sample over the last 20 samples
+            return heater_analysis.analyze_heater_response(temperature_data, setpoint, STABILIZATION_DELTA_C,
+                                                           STABILIZATION_WINDOW_SAMPLES,
+                                                           band_center=temperature_data[-1])
+        return None
+
     def error_test_step_on_exit(self, _test_step_index: int) -> bool:
         """
         This routine is called on the exit of a test step in which the heater has been running and debug data has
@@ -250,15 +892,15 @@ class TestHandler(object):
                  the entire script will fail with an AmiraTestInternalErrors.test_step_custom_on_exit_failure
                  event code.
         """
-        global timer_value
-        global error_string
-        print("\n" * 50)#Clears the screen
-        if timer_value>20:#If it took longer than 20 seconds
-            error_string=error_string+"{0} TIMER VALUE FAILED".format(timer_value)
+        self.print_station_output("\n" * 50)#Clears the screen
+        self.run_context.error_string=''.join(heater_analysis.format_stabilization_result(result)+', '
+                                              for result in self.stabilization_results)+self.run_context.error_string
+        if self.run_context.timer_value>20:#If it took longer than 20 seconds
+            self.run_context.error_string=self.run_context.error_string+"{0} TIMER VALUE FAILED".format(self.run_context.timer_value)
         else:
-            error_string=error_string+"{0} Timer Value Correct".format(timer_value)
-        print(error_string)
-        print("\n" * 5)
+            self.run_context.error_string=self.run_context.error_string+"{0} Timer Value Correct".format(self.run_context.timer_value)
+        self.print_station_output(self.run_context.error_string)
+        self.print_station_output("\n" * 5)
         # return True to indicate that the routine executed properly with no errors
         return True
 
@@ -297,48 +939,31 @@ class TestHandler(object):
             # test script
             return False
 
-    def plot_heater_data(self, plot_filename: str, adc_counts_data: List[int], temperature_data:List[float],
-                         duty_cycle_data:List[int]) -> None:
+    def plot_heater_data(self, plot_filename: str, adc_counts_data: np.ndarray, temperature_data: np.ndarray,
+                         duty_cycle_data: np.ndarray) -> None:
         """
-        This routine creates a plot with heater ADC counts and temperature data.  The temperature is plotted
-        twice - an overall plot with all the data points and a second plot of the temperature after it's reached
-        one percent of the setpoint.
+        This routine queues a plot with heater ADC counts and temperature data to be rendered by a worker process.
+        The temperature is plotted twice - an overall plot with all the data points and a second plot of the
+        temperature after it's reached three percent of the setpoint.
 
         :param plot_filename: Name of plot file to save.
-        :param adc_counts_data:  List with ADC data to plot.
-        :param temperature_data: List with temperature data in degrees C to plot.
-        :param duty_cycle_data: List with duty cycle data in percent plot.
+        :param adc_counts_data:  Array with ADC data to plot.
+        :param temperature_data: Array with temperature data in degrees C to plot.
+        :param duty_cycle_data: Array with duty cycle data in percent plot.
         :return: None.
         """
-        # determine the temperature data index value if any at which the temperature has stabilized
-        stabilized_data_index_value = 0
-        index = 0
-        while index < len(temperature_data):
-            # find the first data point that's within 3 percent of the setpoint
-            if abs(temperature_data[index] - self.temperature_setpoint[self.temperature_setpoint_index]) <= self.temperature_setpoint[self.temperature_setpoint_index] * 0.03:
-                stabilized_data_index_value = index
-                break
-            else:
-                index += 1
-
-        # create a plot with the heater ADC and temperature data all on individual subplots
-        fig1, (ax1, ax2, ax3, ax4) = plt.subplots(figsize=(8, 11), nrows=4, sharex=True)
-        x_axis_values = list(range(1, len(adc_counts_data) + 1))
-        ax1.plot(x_axis_values, adc_counts_data)
-        ax2.plot(x_axis_values, temperature_data)
-        ax3.plot(x_axis_values[stabilized_data_index_value:], temperature_data[stabilized_data_index_value:])
-        ax4.plot(x_axis_values, duty_cycle_data)
-        ax1.set(ylabel='ADC Counts')
-        ax2.set(ylabel='Temperature (Deg. C)')
-        ax3.set(ylabel='Temperature - Stabilized (Deg. C)')
-        ax4.set(xlabel='Sample Number', ylabel='Duty Cycle (Percent)')
-        plot_title = 'Heater Data (Setpoint: {0} Deg C)'.format(self.temperature_setpoint[self.temperature_setpoint_index])
-        fig1.suptitle(plot_title)
-        fig1.savefig(plot_filename)
-
-        self.adc_counts_data = []
-        self.duty_cycle_data = []
-        self.temperature_data = []
+        # determine the temperature data index value if any at which the temperature has stabilized - the first data
+        # point that's within 3 percent of the setpoint
+        setpoint = self.temperature_setpoint[self.temperature_setpoint_index]
+        stabilized_data_index_value = heater_analysis.first_in_band_index(
+            temperature_data, setpoint * (1 - PLOT_STABILIZED_BAND_FRACTION),
+            setpoint * (1 + PLOT_STABILIZED_BAND_FRACTION)) or 0
+
+        # hand the plot off to the worker process so the state machine can move on to the next setpoint
+        self.plot_renderer.submit(plot_filename, setpoint, adc_counts_data, temperature_data, duty_cycle_data,
+                                  stabilized_data_index_value)
+
+        self.samples.clear()
         self.temperature_setpoint_index+=1
 
     def print_to_stdout(self, output_message: str) -> None:
@@ -349,9 +974,37 @@ class TestHandler(object):
         :param output_message: Message to output.
         :return: None
         """
-        # output the message in the format "AmiraTest: <time> <message>
+        # output the message in the format "AmiraTest: <time> <message> - prefixed with the station name if there is one
+        if self.run_context.station_name:
+            output_message = '[{0}] {1}'.format(self.run_context.station_name, output_message)
         print('AmiraTest: {0} {1}'.format(datetime.today().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3], output_message))
 
+    def print_station_output(self, output_message: str) -> None:
+        """
+        This routine outputs a message for the operator.  A single station run prints it to the console.  When several
+        stations share the console (the run context has a station name) it's logged with the station name instead,
+        and blank output such as the screen clearing is dropped.
+
+        :param output_message: Message to output.
+        :return: None
+        """
+        if not self.run_context.station_name:
+            print(output_message)
+        elif output_message.strip():
+            log.msg('[{0}] {1}'.format(self.run_context.station_name, output_message), logLevel=logging.INFO)
+
+    def close(self) -> None:
+        """
+        This routine releases the resources of the handler - the reference thermometer serial port and the plot
+        worker processes (after the queued plots have been rendered).
+
+        :return: None
+        """
+        self.reference_thermometer.stop()
+        self.plot_renderer.shutdown()
+        if self.results_db is not None:
+            self.results_db.close()
+
 
 
     
@@ -363,12 +1016,18 @@ class TestHandler(object):
         :param _test_step_index: Current test step index.  Not used by this routine.
         :return: String with command to send during the test step.
         """
-        global timer_start
-        global timer_done
         if self.temperature_setpoint_index == 2:#if the setpoint is 40 start the timer when the heater starts
-            timer_start=time.perf_counter()
-            timer_done=False
-        
+            self.run_context.timer_start=self.run_context.clock()
+            self.run_context.timer_done=False
+
+        # start streaming the data of this heater run to its CSV file
+        self.heater_run_started = self.run_context.today()
+        self.heater_run_filename = '{0}  {1}'.format(self.run_context.uut,self.heater_run_started.strftime('%Y-%m-%d_%H-%M-%S'))
+        self.heater_csv = HeaterCsvStreamWriter(self.run_context.output_path('{0}.csv'.format(self.heater_run_filename)))
+
+        # the reference thermometer streams in the background from the first heater run until the handler is closed
+        self.reference_thermometer.start()
+
         return 'ins heater start {0}'.format(self.temperature_setpoint[self.temperature_setpoint_index])
 
     def set_heater_command_generator(self, _test_step_index: int) -> str:
@@ -378,20 +1037,16 @@ class TestHandler(object):
         :param _test_step_index: Current test step index.  Not used by this routine.
         :return: String with command to send during the test step.
         """
-        global timer_start
-        global timer_done
-        global t_low
-        global t_high
         
         if self.temperature_setpoint_index==2:#This only entered if each of the two temperature values are alread recorded
-            print('CALIBRATING HEATER')
-            print('t_low')#Print out the values of the two recorded values
-            print(t_low)
-            print('t_high')
-            print(t_high)
-            #t_low+=0.5#Rounds each temperature to the nearest degree
-            #t_high+=0.5
-            return 'mfg htr-cal set {0} 1800 {1} 2800'.format(t_high,t_low)
+            self.print_station_output('CALIBRATING HEATER')
+            self.print_station_output('t_low')#Print out the values of the two recorded values
+            self.print_station_output(str(self.run_context.t_low))
+            self.print_station_output('t_high')
+            self.print_station_output(str(self.run_context.t_high))
+            #self.run_context.t_low+=0.5#Rounds each temperature to the nearest degree
+            #self.run_context.t_high+=0.5
+            return 'mfg htr-cal set {0} 1800 {1} 2800'.format(self.run_context.t_high,self.run_context.t_low)
         else:
             return 'mfg getwid'
 
@@ -437,8 +1092,7 @@ class TestHandler(object):
                 error_code == AmiraErrorCodes.NRFX_ERROR_ALREADY_INITIALIZED or \
                 error_code == AmiraErrorCodes.NRF_ERROR_MODULE_ALREADY_INITIALIZED:
             # return True to indicate that the response was parsed properly with no errors
-            global UUT
-            UUT=_response_payload['wirelessIdFull'] #capture the id of the amira
+            self.run_context.uut=_response_payload['wirelessIdFull'] #capture the id of the amira
             return True
         else:
             # return False indicating that there was a problem - note: this will end the execution of the entire
@@ -474,8 +1128,7 @@ class TestHandler(object):
                 error_code == AmiraErrorCodes.NRFX_ERROR_ALREADY_INITIALIZED or \
                 error_code == AmiraErrorCodes.NRF_ERROR_MODULE_ALREADY_INITIALIZED:
             # return True to indicate that the response was parsed properly with no errors
-            global version
-            version=_response_payload['versionString']#capture the version of the amira
+            self.run_context.version=_response_payload['versionString']#capture the version of the amira
             return True
         else:
             # return False indicating that there was a problem - note: this will end the execution of the entire
@@ -513,20 +1166,22 @@ class TestHandler(object):
                 error_code == AmiraErrorCodes.NRF_ERROR_MODULE_ALREADY_INITIALIZED:
             # return True to indicate that the response was parsed properly with no errors
             
-            if round(t_high,2)==round(_response_payload['highTemp'],2) and round(t_low,2)==round(_response_payload['lowTemp'],2):#Compare our recorded values to the values the calibration returns
-                print("Heater Calibration Values Set Correctly")
+            if round(self.run_context.t_high,2)==round(_response_payload['highTemp'],2) and round(self.run_context.t_low,2)==round(_response_payload['lowTemp'],2):#Compare our recorded values to the values the calibration returns
+                self.print_station_output("Heater Calibration Values Set Correctly")
             else:
-                print("high and low")#print out the values to help debug if set incorrectly
-                print(float(t_high))
-                print(float(t_low))
-                print("Heater Calibration Values Set Incorrectly")
-            print(_response_payload)
-            f = open("heaterdata/calheater.csv", 'a', newline='')
-            writer = csv.DictWriter(f, fieldnames = header)
-            time = datetime.now()
-            myDict = {'UUT':UUT, 'FirmVersion':version, 'DateTimeStamp':time,"t-high":_response_payload['highTemp'],"c-high":_response_payload['adcHigh'],"t-low":_response_payload['lowTemp'],"c-low":_response_payload['adcLow'],"timer-value":timer_value,"stabilized":t_stable}
+                self.print_station_output("high and low")#print out the values to help debug if set incorrectly
+                self.print_station_output(str(float(self.run_context.t_high)))
+                self.print_station_output(str(float(self.run_context.t_low)))
+                self.print_station_output("Heater Calibration Values Set Incorrectly")
+            self.print_station_output(str(_response_payload))
+            f = open(self.run_context.output_path(CALHEATER_CSV_FILENAME), 'a', newline='')
+            writer = csv.DictWriter(f, fieldnames = CALHEATER_CSV_HEADER)
+            time = self.run_context.today()
+            myDict = {'UUT':self.run_context.uut, 'FirmVersion':self.run_context.version, 'DateTimeStamp':time,"t-high":_response_payload['highTemp'],"c-high":_response_payload['adcHigh'],"t-low":_response_payload['lowTemp'],"c-low":_response_payload['adcLow'],"timer-value":self.run_context.timer_value,"stabilized":self.run_context.t_stable}
             #"Test Id", "UUT","DateTimeStamp","Description","Units","MeasuredValue","LowerRangeValue","HigherRangeValue","Result"
             writer.writerow(myDict)
+            if self.results_db is not None:
+                self.results_db.add_heater_calibrations(self.run_context.station_name, [myDict])
             return True
         else:
             # return False indicating that there was a problem - note: this will end the execution of the entire
@@ -534,31 +1189,22 @@ class TestHandler(object):
             return False
 
 
-# create an instance of the test handler
-test_handler = TestHandler()
-t_high=50#50 degree setpoint cal value
-version=0#Holds the current firmware version of the device
-UUT=0#Holds the device ID
-t_low=30#30 degree setpoint cal calue
-t_stable=0#Record the value that our setpoint of 40 stabilizes at
-timer_start=0#Value of timer when it starts
-timer_done=True#When false the program begins to track a timer
-timer_value=80#Value of how long it takes to heat to 35 when calibrated to 40
-error_string=""#This will contain all information generated and will be printed at the end of calibration
-
-# create the csv writer
-f = open("heaterdata/calheater.csv", 'a', newline='')
-rowcount = 0
-header=["UUT","FirmVersion","DateTimeStamp","t-high","c-high","t-low","c-low","timer-value","stabilized"]#csv header columns
-#iterating through the whole file
-for row in open("heaterdata/calheater.csv"):
-    rowcount+= 1
-if rowcount==0:#checks to see if this is the first test
-    writer = csv.DictWriter(f, fieldnames = header)
-    writer.writeheader()#if is first test write the header
-writer = csv.DictWriter(f, fieldnames = header)
-#writer.writerow({'UUT':' '})# This creates a space between the last test group and this test group
-f.close()
+def prepare_calibration_csv(output_dir: str) -> None:
+    """
+    This routine creates the output directory if needed and writes the fields header line of the heater calibration
+    results file if it's a new file.
+
+    :param output_dir: Directory the heater calibration results file is written to.
+    :return: None
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    # create the csv writer
+    f = open(os.path.join(output_dir, CALHEATER_CSV_FILENAME), 'a', newline='')
+    if f.tell()==0:#checks to see if this is the first test
+        writer = csv.DictWriter(f, fieldnames = CALHEATER_CSV_HEADER)
+        writer.writeheader()#if is first test write the header
+    #writer.writerow({'UUT':' '})# This creates a space between the last test group and this test group
+    f.close()
 
 
 """
@@ -641,190 +1287,232 @@ Potential dictionary keys for test steps in this list include:
            AmiraTestOperations.delay, a timeout will result in the failure of the entire test sequence with
            a AmiraTestInternalErrors.timeout error code.  
 """
-test_step_list = \
-    [
-        # ***************************************************************************
-        # do some initial setup to allow the scripting tool to work more efficiently
-        # ***************************************************************************
-
-        # send the "cli echo off" command to disable the instrument from echoing back each command - this
-        # command does not generate a JSON formatted response so use the .send_raw_command action instead
-        # of .send_command - NOTE: if the instrument has been idle for a long time, it's possible that
-        # it's gone into low power mode and disabled the serial interface so to be safe, send this message
-        # twice - if the instrument has disabled the interface, the first message will be partially lost but
-        # it will wake up the interface - sending the message twice is harmless and won't cause any problems
-        {'action': AmiraTestOperations.send_raw_command, 'command': 'cli echo off', 'commandDelay': 1},
-        {'action': AmiraTestOperations.send_raw_command, 'command': 'cli echo off', 'commandDelay': 1},
-
-        # erase the current heater calibration to prepare the test
-        {'action': AmiraTestOperations.send_command, 'command': 'mfg props-erase 3', 'timeout': 2},
-
-
-         # wait 1 second
-        {'action': AmiraTestOperations.delay, 'timeout': 1},
-
-        # send the "mfg reset" command to reset the device - this command does not generate a JSON formatted response
-        {'action': AmiraTestOperations.send_raw_command, 'command': 'mfg reset', 'commandDelay': 1,
- 'customStepDisplayMessage': 'Resetting the device ...'},
-
-        # wait up to 15 seconds for the instrument to reset and complete booting up
-        {'action': AmiraTestOperations.wait_for_event, 'event': AmiraEventCodes.app_general_startup_complete,
-         'timeout': 15, 'customStepDisplayMessage': 'Waiting for the device to restart ...'},
-         
-         # wait 5 seconds
-        {'action': AmiraTestOperations.delay, 'timeout': 5},
-
-        # disable the application FSM to avoid any conflicts
-        {'action': AmiraTestOperations.send_command, 'command': 'ins state event set-bypass-fsm', 'timeout': 50},
-
-        #Get the serial number of the device
-        {'action': AmiraTestOperations.send_command, 'command': 'mfg getwid', 'timeout': 20,
-         'customResponseParser': test_handler.serial_response_parser},
-
-         #Get the version of firmware on the device
-        {'action': AmiraTestOperations.send_command, 'command': 'mfg app-info', 'timeout': 20,
-         'customResponseParser': test_handler.version_response_parser},
+def build_test_step_list(test_handler: TestHandler) -> List[dict]:
+    """
+    This routine builds the list of test steps for one instrument.  Every instrument gets its own test handler and
+    its own list of test steps.
 
+    :param test_handler: Test handler of the instrument.
+    :return: List of test steps.
+    """
+    return \
+        [
+            # ***************************************************************************
+            # do some initial setup to allow the scripting tool to work more efficiently
+            # ***************************************************************************
+
+            # send the "cli echo off" command to disable the instrument from echoing back each command - this
+            # command does not generate a JSON formatted response so use the .send_raw_command action instead
+            # of .send_command - NOTE: if the instrument has been idle for a long time, it's possible that
+            # it's gone into low power mode and disabled the serial interface so to be safe, send this message
+            # twice - if the instrument has disabled the interface, the first message will be partially lost but
+            # it will wake up the interface - sending the message twice is harmless and won't cause any problems
+            {'action': AmiraTestOperations.send_raw_command, 'command': 'cli echo off', 'commandDelay': 1},
+            {'action': AmiraTestOperations.send_raw_command, 'command': 'cli echo off', 'commandDelay': 1},
+
+            # erase the current heater calibration to prepare the test
+            {'action': AmiraTestOperations.send_command, 'command': 'mfg props-erase 3', 'timeout': 2},
+
+
+             # wait 1 second
+            {'action': AmiraTestOperations.delay, 'timeout': 1},
+
+            # send the "mfg reset" command to reset the device - this command does not generate a JSON formatted response
+            {'action': AmiraTestOperations.send_raw_command, 'command': 'mfg reset', 'commandDelay': 1,
+     'customStepDisplayMessage': 'Resetting the device ...'},
+
+            # wait up to 15 seconds for the instrument to reset and complete booting up
+            {'action': AmiraTestOperations.wait_for_event, 'event': AmiraEventCodes.app_general_startup_complete,
+             'timeout': 15, 'customStepDisplayMessage': 'Waiting for the device to restart ...'},
          
+             # wait 5 seconds
+            {'action': AmiraTestOperations.delay, 'timeout': 5},
 
-        # **************************************
-        # turn on the internal instrument power
-        # **************************************
-
-        # turn on the power to both rails
-        {'action': AmiraTestOperations.send_command, 'command': 'ins pwr 0 1', 'timeout': 2},
-        {'action': AmiraTestOperations.send_command, 'command': 'ins pwr 1 1', 'timeout': 2},
-
-        {'action': AmiraTestOperations.send_command, 'command': 'ins motor move home', 'timeout': 2},#Make sure motor is in compressed position
-
-        {'action': AmiraTestOperations.wait_for_event, 'event': AmiraEventCodes.motor_fsm_move_complete,
-         'customEventParser': test_handler.motor_movement_complete_event_parser,
-         'customStepDisplayMessage': 'Waiting for motor home movement to complete ...', 'timeout': 30},
-
-        # wait for user input
-        {'action': AmiraTestOperations.wait_for_user_input,
-         'customStepDisplayMessage': 'Insert the strip and hit enter ...'},
-
-        {'action': AmiraTestOperations.start_loop, 'numLoops': 2}, #Loops to calculate t_low and t_high
-
-        # enable heater debug output
-        {'action': AmiraTestOperations.send_command, 'command': 'ins heater debug enable', 'timeout': 2},
-
-        # initialize the heater - ignore any already initialized errors
-        {'action': AmiraTestOperations.send_command, 'command': 'ins heater init', 'timeout': 2,
-         'customResponseParser': test_handler.ignore_already_initialized_response_parser},
-
-        # start the heater - the default setpoint value will be used unless the user entered a valid setpoint
-        # value in the previous step
-        {'action': AmiraTestOperations.send_command, 'timeout': 2,
-         'customCommandGenerator': test_handler.start_heater_command_generator,
-         'customMessageGenerator': test_handler.start_heater_message_generator,
-         'testStepName': 'startHeater'},
+            # disable the application FSM to avoid any conflicts
+            {'action': AmiraTestOperations.send_command, 'command': 'ins state event set-bypass-fsm', 'timeout': 50},
 
-        # run the heater for the time returned by calling test_handler.run_heater_timeout_generator,
-        # collecting debug data
-        {'action': AmiraTestOperations.delay,
-         'customOnExitHandler': test_handler.heater_run_test_step_on_exit,
-         'customEventParser': test_handler.heater_debug_capture_event_parser,
-         'timeout': 60,
-         'testStepName': 'runHeater'},
+            #Get the serial number of the device
+            {'action': AmiraTestOperations.send_command, 'command': 'mfg getwid', 'timeout': 20,
+             'customResponseParser': test_handler.serial_response_parser},
 
-        # ***********************************
-        # clean-up and shut everything down
-        # ***********************************
+             #Get the version of firmware on the device
+            {'action': AmiraTestOperations.send_command, 'command': 'mfg app-info', 'timeout': 20,
+             'customResponseParser': test_handler.version_response_parser},
 
-        # stop data collection
-        {'action': AmiraTestOperations.send_command, 'command': 'ins heater debug disable', 'timeout': 2},
-
-        # turn off the heater
-        {'action': AmiraTestOperations.send_command, 'command': 'ins heater stop', 'timeout': 2,
-         'customStepDisplayMessage': 'Test complete - turning heater off ...'},
-
-         # wait 2 seconds
-        {'action': AmiraTestOperations.delay, 'timeout': 2},
-
-         {'action': AmiraTestOperations.send_command, 'timeout': 2,
-         'customCommandGenerator': test_handler.set_heater_command_generator},
-
-         #Wait 30 seconds to cool heater
-        {'action': AmiraTestOperations.delay, 'timeout': 30,
-         'customStepDisplayMessage': 'Letting heater cool for 30 seconds...'},
-
-        {'action': AmiraTestOperations.end_loop},
-
-        # send the "mfg reset" command to reset the device - this command does not generate a JSON formatted response
-        {'action': AmiraTestOperations.send_raw_command, 'command': 'mfg reset', 'commandDelay': 1,
- 'customStepDisplayMessage': 'Resetting the device ...'},
-
-        # wait up to 15 seconds for the instrument to reset and complete booting up
-        {'action': AmiraTestOperations.wait_for_event, 'event': AmiraEventCodes.app_general_startup_complete,
-         'timeout': 15, 'customStepDisplayMessage': 'Waiting for the device to restart ...'},
          
-         # wait 5 seconds
-        {'action': AmiraTestOperations.delay, 'timeout': 5},
-
 
-        # disable the application FSM to avoid any conflicts
-        {'action': AmiraTestOperations.send_command, 'command': 'ins state event set-bypass-fsm', 'timeout': 5},
-
-        # **************************************
-        # turn on the internal instrument power
-        # **************************************
-
-        # turn on the power to both rails
-        {'action': AmiraTestOperations.send_command, 'command': 'ins pwr 0 1', 'timeout': 2},
-        {'action': AmiraTestOperations.send_command, 'command': 'ins pwr 1 1', 'timeout': 2},
-
-
-        # enable heater debug output
-        {'action': AmiraTestOperations.send_command, 'command': 'ins heater debug enable', 'timeout': 2},
-
-        # initialize the heater - ignore any already initialized errors
-        {'action': AmiraTestOperations.send_command, 'command': 'ins heater init', 'timeout': 2,
-         'customResponseParser': test_handler.ignore_already_initialized_response_parser},
-
-        # start the heater - the default setpoint value will be used unless the user entered a valid setpoint
-        # value in the previous step
-        {'action': AmiraTestOperations.send_command, 'timeout': 2,
-         'customCommandGenerator': test_handler.start_heater_command_generator,
-         'customMessageGenerator': test_handler.start_heater_message_generator,
-         'testStepName': 'startHeater'},
-
-        # run the heater for the time returned by calling test_handler.run_heater_timeout_generator,
-        # collecting debug data
-        {'action': AmiraTestOperations.delay,
-         'customOnExitHandler': test_handler.heater_run_test_step_on_exit,
-         'customEventParser': test_handler.heater_debug_capture_event_parser,
-         'timeout': 80,
-         'testStepName': 'runHeater'},
-
-        # ***********************************
-        # clean-up and shut everything down
-        # ***********************************
-
-        # stop data collection
-        {'action': AmiraTestOperations.send_command, 'command': 'ins heater debug disable', 'timeout': 2},
-
-        # turn off the heater
-        {'action': AmiraTestOperations.send_command, 'command': 'ins heater stop', 'timeout': 2,
-         'customStepDisplayMessage': 'Test complete - turning heater off ...'},
-
-         # wait 2 seconds
-        {'action': AmiraTestOperations.delay, 'customOnExitHandler': test_handler.error_test_step_on_exit, 'timeout': 1},
-
-        # wait 2 seconds
-        {'action': AmiraTestOperations.delay, 'timeout': 2},
-
-        {'action': AmiraTestOperations.send_command, 'command': 'mfg htr-cal get', 'timeout': 2,
-         'customResponseParser': test_handler.htrcal_response_parser},
-
-        # turn off the power to both rails
-        {'action': AmiraTestOperations.send_command, 'command': 'ins pwr 1 0', 'timeout': 2},
-        {'action': AmiraTestOperations.send_command, 'command': 'ins pwr 0 0', 'timeout': 2},
-
-        # re-enable the application FSM so it will work normally again
-        {'action': AmiraTestOperations.send_command, 'command': 'ins state event clear-bypass-fsm', 'timeout': 2},
-
-        # send the "cli echo on" command - this command does not generate a JSON formatted response
-        {'action': AmiraTestOperations.send_raw_command, 'command': 'cli echo on'}
-    ]
\ No newline at end of file
+            # **************************************
+            # turn on the internal instrument power
+            # **************************************
+
+            # turn on the power to both rails
+            *step_pipelining.pipeline_steps([
+                {'action': AmiraTestOperations.send_command, 'command': 'ins pwr 0 1', 'timeout': 2},
+                {'action': AmiraTestOperations.send_command, 'command': 'ins pwr 1 1', 'timeout': 2},
+            ], HEATER_COMMAND_PIPELINING),
+
+            {'action': AmiraTestOperations.send_command, 'command': 'ins motor move home', 'timeout': 2},#Make sure motor is in compressed position
+
+            {'action': AmiraTestOperations.wait_for_event, 'event': AmiraEventCodes.motor_fsm_move_complete,
+             'customEventParser': test_handler.motor_movement_complete_event_parser,
+             'customStepDisplayMessage': 'Waiting for motor home movement to complete ...', 'timeout': 30},
+
+            # wait for user input - the reference thermometer reading once the strip is in is the ambient temperature
+            # the cool-down steps return to
+            {'action': AmiraTestOperations.wait_for_user_input,
+             'customOnEntryHandler': test_handler.start_reference_thermometer_on_entry,
+             'customOnExitHandler': test_handler.record_ambient_temperature_on_exit,
+             'customStepDisplayMessage': 'Insert the strip and hit enter ...'},
+
+            {'action': AmiraTestOperations.start_loop, 'numLoops': 2}, #Loops to calculate t_low and t_high
+
+            # enable heater debug output and initialize the heater - ignore any already initialized errors
+            *step_pipelining.pipeline_steps([
+                {'action': AmiraTestOperations.send_command, 'command': 'ins heater debug enable', 'timeout': 2},
+                {'action': AmiraTestOperations.send_command, 'command': 'ins heater init', 'timeout': 2,
+                 'customResponseParser': test_handler.ignore_already_initialized_response_parser},
+            ], HEATER_COMMAND_PIPELINING),
+
+            # start the heater - the default setpoint value will be used unless the user entered a valid setpoint
+            # value in the previous step
+            {'action': AmiraTestOperations.send_command, 'timeout': 2,
+             'customCommandGenerator': test_handler.start_heater_command_generator,
+             'customMessageGenerator': test_handler.start_heater_message_generator,
+             'testStepName': 'startHeater'},
+
+            # run the heater for up to 60 seconds collecting debug data - the heater debug event parser ends the step
+            # early once the temperature has stabilized
+            {'action': AmiraTestOperations.delay,
+             'customOnExitHandler': test_handler.heater_run_test_step_on_exit,
+             'customEventParser': test_handler.heater_debug_capture_event_parser,
+             'timeout': 60,
+             'testStepName': 'runHeater'},
+
+            # ***********************************
+            # clean-up and shut everything down
+            # ***********************************
+
+            # turn off the heater
+            {'action': AmiraTestOperations.send_command, 'command': 'ins heater stop', 'timeout': 2,
+             'customStepDisplayMessage': 'Test complete - turning heater off ...'},
+
+             # wait 2 seconds
+            {'action': AmiraTestOperations.delay, 'timeout': 2},
+
+             {'action': AmiraTestOperations.send_command, 'timeout': 2,
+             'customCommandGenerator': test_handler.set_heater_command_generator},
+
+             #Wait up to 30 seconds to cool heater - heater debug output is still enabled so the cool down event parser
+             #can end the step as soon as the reference temperature is back near ambient (see COOL_DOWN_AMBIENT_MARGIN_C)
+            {'action': AmiraTestOperations.delay, 'timeout': 30,
+             'customEventParser': test_handler.cool_down_event_parser,
+             'customStepDisplayMessage': 'Letting heater cool for up to 30 seconds...',
+             'testStepName': 'coolDown'},
+
+            # stop data collection
+            {'action': AmiraTestOperations.send_command, 'command': 'ins heater debug disable', 'timeout': 2},
+
+            {'action': AmiraTestOperations.end_loop},
+
+            # send the "mfg reset" command to reset the device - this command does not generate a JSON formatted response
+            {'action': AmiraTestOperations.send_raw_command, 'command': 'mfg reset', 'commandDelay': 1,
+     'customStepDisplayMessage': 'Resetting the device ...'},
+
+            # wait up to 15 seconds for the instrument to reset and complete booting up
+            {'action': AmiraTestOperations.wait_for_event, 'event': AmiraEventCodes.app_general_startup_complete,
+             'timeout': 15, 'customStepDisplayMessage': 'Waiting for the device to restart ...'},
+         
+             # wait 5 seconds
+            {'action': AmiraTestOperations.delay, 'timeout': 5},
+
+
+            # disable the application FSM to avoid any conflicts
+            {'action': AmiraTestOperations.send_command, 'command': 'ins state event set-bypass-fsm', 'timeout': 5},
+
+            # **************************************
+            # turn on the internal instrument power
+            # **************************************
+
+            # turn on the power to both rails
+            *step_pipelining.pipeline_steps([
+                {'action': AmiraTestOperations.send_command, 'command': 'ins pwr 0 1', 'timeout': 2},
+                {'action': AmiraTestOperations.send_command, 'command': 'ins pwr 1 1', 'timeout': 2},
+            ], HEATER_COMMAND_PIPELINING),
+
+
+            # enable heater debug output and initialize the heater - ignore any already initialized errors
+            *step_pipelining.pipeline_steps([
+                {'action': AmiraTestOperations.send_command, 'command': 'ins heater debug enable', 'timeout': 2},
+                {'action': AmiraTestOperations.send_command, 'command': 'ins heater init', 'timeout': 2,
+                 'customResponseParser': test_handler.ignore_already_initialized_response_parser},
+            ], HEATER_COMMAND_PIPELINING),
+
+            # start the heater - the default setpoint value will be used unless the user entered a valid setpoint
+            # value in the previous step
+            {'action': AmiraTestOperations.send_command, 'timeout': 2,
+             'customCommandGenerator': test_handler.start_heater_command_generator,
+             'customMessageGenerator': test_handler.start_heater_message_generator,
+             'testStepName': 'startHeater'},
+
+            # run the heater for up to 80 seconds collecting debug data - the heater debug event parser ends the step
+            # early once the temperature has stabilized
+            {'action': AmiraTestOperations.delay,
+             'customOnExitHandler': test_handler.heater_run_test_step_on_exit,
+             'customEventParser': test_handler.heater_debug_capture_event_parser,
+             'timeout': 80,
+             'testStepName': 'runHeater'},
+
+            # ***********************************
+            # clean-up and shut everything down
+            # ***********************************
+
+            # stop data collection
+            {'action': AmiraTestOperations.send_command, 'command': 'ins heater debug disable', 'timeout': 2},
+
+            # turn off the heater
+            {'action': AmiraTestOperations.send_command, 'command': 'ins heater stop', 'timeout': 2,
+             'customStepDisplayMessage': 'Test complete - turning heater off ...'},
+
+             # wait 2 seconds
+            {'action': AmiraTestOperations.delay, 'customOnExitHandler': test_handler.error_test_step_on_exit, 'timeout': 1},
+
+            # wait 2 seconds
+            {'action': AmiraTestOperations.delay, 'timeout': 2},
+
+            {'action': AmiraTestOperations.send_command, 'command': 'mfg htr-cal get', 'timeout': 2,
+             'customResponseParser': test_handler.htrcal_response_parser},
+
+            # turn off the power to both rails
+            *step_pipelining.pipeline_steps([
+                {'action': AmiraTestOperations.send_command, 'command': 'ins pwr 1 0', 'timeout': 2},
+                {'action': AmiraTestOperations.send_command, 'command': 'ins pwr 0 0', 'timeout': 2},
+            ], HEATER_COMMAND_PIPELINING),
+
+            # re-enable the application FSM so it will work normally again
+            {'action': AmiraTestOperations.send_command, 'command': 'ins state event clear-bypass-fsm', 'timeout': 2},
+
+            # send the "cli echo on" command - this command does not generate a JSON formatted response
+            {'action': AmiraTestOperations.send_raw_command, 'command': 'cli echo on'}
+        ]
+
+
+# create an instance of the test handler for the instrument connected to this computer - unless the script is loaded
+# as a library by the multi-station runner (multi_station_heater_cal.py), which sets HEATER_LIBRARY_IMPORT before the
+# script runs and creates a context, test handler and list of test steps per station itself
+if not globals().get('HEATER_LIBRARY_IMPORT', False):
+    run_context = HeaterRunContext()
+    test_handler = TestHandler(run_context)
+    atexit.register(test_handler.close)
+    prepare_calibration_csv(run_context.output_dir)
+
+    test_step_list = build_test_step_list(test_handler)
+    if HEATER_CALLBACK_PROFILE_DIR is not None:
+        callback_profiler = callback_profiling.CallbackProfiler(HEATER_CALLBACK_PROFILE_DIR)
+        test_step_list = callback_profiler.instrument(test_step_list)
+        callback_profiler.start()
+        atexit.register(callback_profiler.close)
+    if HEATER_STEP_TRACE_DIR is not None:
+        step_trace = step_timing.StepTimingTrace(lambda: 'heater_{0}'.format(run_context.uut),
+                                                 clock=lambda: run_context.clock())
+        test_step_list = step_trace.instrument(test_step_list)
+        atexit.register(step_trace.save, HEATER_STEP_TRACE_DIR)
@@ -31,19 +31,242 @@ import logging
 from amira_parser import AmiraErrorCodes, AmiraEventCodes
 from amira_test_state_machine import AmiraTestEventParserReturnValues, AmiraTestOperations
 from twisted.python import log
-from typing import List
-import asyncio
-from bleak import BleakScanner
+from typing import List, Optional, Sequence, Tuple
+import ble_discovery
 
 
+import atexit
+import callback_profiling
 import datetime
 import csv
+import functools
+import os
+import platform
+import result_store
+import results_db
+import sqlite3
+import step_pipelining
+import step_timing
+
+
+# root directory of the result store - results are partitioned by station and day under this directory
+SMOKE_RESULTS_DIR = 'test_scripts/results'
+
+# single results file written before the result store - the TestIds of a new station continue after its last TestId
+SMOKE_LEGACY_RESULTS_FILENAME = 'test_scripts/test.csv'
+
+# name of this station in the result store
+SMOKE_STATION_NAME = platform.node() or 'station'
+
+# csv header columns of the results file
+SMOKE_CSV_HEADER = ["TestId", "UUT","FirmVersion","DateTimeStamp","Description","Units","MeasuredValue","LowerRangeValue","HigherRangeValue","Result"]
+
+# number of buffered result rows that forces a write to the results file between step boundaries
+SMOKE_RESULT_FLUSH_ROWS = 20
+
+# SQLite result database the results are also written to (i.e. 'test_scripts/results.db') or None to only write the
+# results file
+SMOKE_RESULTS_DB_FILENAME = None
+
+# maximum time in seconds the Bluetooth check waits for the background BLE scan - the scan is started when the radio
+# is turned on and normally finishes long before the check
+SMOKE_BLE_RESULT_TIMEOUT_S = 10.0
+
+# UI LED pattern of the LED test - each phase sets the state (1=on, 0=off) of the listed LEDs and then holds the pattern
+# for the given number of seconds: (LED indexes, state, hold seconds)
+SMOKE_LED_WHITE = (0, 2, 4, 6, 8, 10, 12)
+SMOKE_LED_PINK = (1, 3, 5, 7, 9, 11, 13)
+SMOKE_LED_SWEEP = [
+    (SMOKE_LED_WHITE, 1, 3),  # white
+    (SMOKE_LED_PINK, 1, 3),  # pink
+    (SMOKE_LED_WHITE, 0, 3),  # red by turning off the white light
+    (SMOKE_LED_PINK, 0, 0),  # off
+]
+
+# True to write the LED commands of each phase back to back without waiting for each response and verify all the
+# responses at the end of the phase - only for firmware that queues CLI commands, otherwise each LED command waits for
+# its own response
+SMOKE_LED_PIPELINED = False
+
+# timeout in seconds of an LED command (or of the last command of a pipelined phase)
+SMOKE_LED_COMMAND_TIMEOUT_S = 2
+
+# True to write runs of independent commands (the power rail pairs, heater debug enable and heater init and the optics
+# and fluidics teardown) back to back and match their responses out of order - only for firmware that queues CLI
+# commands, otherwise each command waits for its own response
+SMOKE_COMMAND_PIPELINING = False
+
+# True to send the fluidics and door inits together and wait for both responses instead of one after another once
+# the heater init has succeeded - they are mechanically independent so their movements overlap, and a failed heater
+# init still ends the script before either is sent
+SMOKE_CONCURRENT_INIT = False
+
+# (host, port) of the shared BLE scan service of the lab, asked before scanning locally, or None to always scan locally
+SMOKE_BLE_SCAN_SERVICE = ('127.0.0.1', 47800)
+
+# directory the per-run step timing traces are written to (see step_timing.py) or None to not time the steps
+SMOKE_STEP_TRACE_DIR = None
+
+# directory the callback profile of the run is written to (see callback_profiling.py) or None to not profile the
+# callbacks
+SMOKE_CALLBACK_PROFILE_DIR = None
+
+
+class SmokeRunContext(object):
+    """
+    This class holds the state of the smoke test of one unit.  A new context is created for every unit so several
+    units can be tested back to back (or at the same time) in one interpreter without re-importing this script.
+    """
+
+    def __init__(self, serial_val: str, results_filename: str, station: str = SMOKE_STATION_NAME):
+        """
+        Class initializer.
+
+        :param serial_val: Serial number scanned from the bottom of the device.
+        :param results_filename: Name of the results file (result store partition) the test rows are appended to.
+        :param station: Name of the station the unit is tested on.
+        """
+        self.serial_val = serial_val
+        self.results_filename = results_filename
+        self.station = station
+        self.bluetooth_id = 'IDs'
+        self.uut = 0 #Placeholder for the ID of the unit
+        self.version = 0 #Placeholder for the unit version
+        self.away_test = 0 #Place holder for the motor's location in the away movement
+        self.home_test = 0 #Place holder for the motor's location in the home movement
+        self.test_result = 'Pass'
+        self.test_failed = False
+        self.ref_optics_test = 0 #Placeholeder for the value recorded by the optics ref PD reading
+        self.main_optics_test = 0 #Placeholeder for the value recorded by the optics main PD reading
+
+
+class SmokeResultSink(object):
+    """
+    This class owns the single open handle of the results file for the smoke test of one unit.  Rows are buffered and
+    written at step boundaries, failing rows are written and synced to disk immediately so they survive a crash of the
+    test tool.  The sink assigns the TestId of every row it writes.
+    """
+
+    def __init__(self, results_filename: str, flush_rows: int = SMOKE_RESULT_FLUSH_ROWS,
+                 database: Optional[results_db.ResultDatabase] = None, station: str = SMOKE_STATION_NAME,
+                 test_ids: Optional[result_store.TestIdAllocator] = None):
+        """
+        Class initializer - opens the results file, writes the fields header line if it's a new file and separates
+        this test group from the last one with a blank row.
+
+        :param results_filename: Name of the results file the test rows are appended to.
+        :param flush_rows: Number of buffered rows that forces a write to the results file.
+        :param database: Result database the rows are also written to or None.
+        :param station: Name of the station stored with the rows in the result database.
+        :param test_ids: TestIdAllocator of the station that handed out the results file, shared with the other tests
+                         of the station, or None if this sink is the only writer of the results file.
+        """
+        self.results_filename = results_filename
+        self.flush_rows = flush_rows
+        self.database = database
+        self.station = station
+        self.test_ids = test_ids
+        self._rows = []
+        # the TestId has to be found before this test group's separator row changes the size of the results file
+        self.next_test_id = result_store.find_next_test_id(results_filename) if test_ids is None else None
+        self._file = open(results_filename, 'a', newline='')
+        self._writer = csv.DictWriter(self._file, fieldnames = SMOKE_CSV_HEADER)
+        if self._file.tell()==0:#checks to see if this is the first test
+            self._writer.writeheader()#if is first test write the header
+        self._writer.writerow({'Units':' '})# This creates a space between the last test group and this test group
+        self._file.flush()
+
+    def write_row(self, row: dict) -> None:
+        """
+        This routine assigns the TestId of a result row and buffers it.  A failing row is written and synced to disk
+        right away.
+
+        :param row: Dictionary with the SMOKE_CSV_HEADER columns of the row except the TestId.
+        :return: None
+        """
+        if self.test_ids is not None:
+            row['TestId'] = self.test_ids.allocate()
+        else:
+            row['TestId'] = self.next_test_id
+            self.next_test_id += 1
+        self._rows.append(row)
+        if row.get('Result') == 'Fail':
+            self.flush(sync=True)
+        elif len(self._rows) >= self.flush_rows:
+            self.flush()
+
+    def flush(self, sync: bool = False) -> None:
+        """
+        This routine writes the buffered rows to the results file.
+
+        :param sync: True to also sync the results file to disk.
+        :return: None
+        """
+        if self._file is None:
+            return
+        if self._rows:
+            self._writer.writerows(self._rows)
+            # the rows are in the results file - clear the buffer before the database so they're never written twice
+            rows = self._rows
+            self._rows = []
+            if self.database is not None:
+                try:
+                    # the batch is stored in one transaction
+                    self.database.add_smoke_results(self.station, rows)
+                except sqlite3.Error as error:
+                    log.msg('result database: storing {0} rows failed: {1}'.format(len(rows), error),
+                            logLevel=logging.ERROR)
+        self._file.flush()
+        if sync:
+            os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        """
+        This routine writes the buffered rows, syncs the results file to disk, closes it and updates the TestId
+        index (or hands the results file back to the TestIdAllocator, which updates it).
+
+        :return: None
+        """
+        if self._file is None:
+            return
+        self.flush(sync=True)
+        self._file.close()
+        self._file = None
+        if self.test_ids is not None:
+            self.test_ids.close_partition(self.results_filename)
+        else:
+            result_store.write_test_id_index(self.results_filename, self.next_test_id)
 
 
 class InitDebugCapture(object):
     """
     This class is used in combination with a test sequence list to test the commands of fluidics init and door init
     """
+
+    def __init__(self, run_context: SmokeRunContext, test_ids: Optional[result_store.TestIdAllocator] = None):
+        """
+        Class initializer.
+
+        :param run_context: State of the smoke test of the unit handled by this instance.
+        :param test_ids: TestIdAllocator of the station that handed out the results file or None if this is the only
+                         test writing to it.
+        """
+        self.run_context = run_context
+        self.results_db = results_db.ResultDatabase(SMOKE_RESULTS_DB_FILENAME) if SMOKE_RESULTS_DB_FILENAME else None
+        self.results = SmokeResultSink(run_context.results_filename, database=self.results_db,
+                                       station=run_context.station, test_ids=test_ids)
+        self.ble_discovery = None
+        self.led_sweep_responses = 0 #Number of successful LED command responses of the current pipelined LED phase
+
+    def close(self) -> None:
+        """
+        This routine writes the remaining result rows and closes the results file and result database.
+
+        :return: None
+        """
+        self.results.close()
+        if self.results_db is not None:
+            self.results_db.close()
     
     def motor_movement_complete_event_parser(
             self, _test_step_index: int,
@@ -93,40 +316,29 @@ class InitDebugCapture(object):
                  test sequence should proceed to the next test step, AmiraTestEventParserReturnValues.failure if the
                  test sequence should be aborted, otherwise AmiraTestEventParserReturnValues.ignore.
         """
-        global away_test
-        global rowcount
-        global test_result
         if event_code == AmiraEventCodes.motor_fsm_move_complete:
             result = AmiraTestEventParserReturnValues.success
-            test_result='Fail'
-            if away_test>1700 and away_test<2000: #Check to make sure motor is in right position This catches errors where motor doesn't move
-                test_result='Pass'
+            self.run_context.test_result='Fail'
+            if self.run_context.away_test>1700 and self.run_context.away_test<2000: #Check to make sure motor is in right position This catches errors where motor doesn't move
+                self.run_context.test_result='Pass'
             else:
                 print('FAILURE: MOTOR POSITION ERROR')
-            f = open("test_scripts/test.csv", 'a', newline='')
-            # create the csv writer
-            writer = csv.DictWriter(f, fieldnames = header)
             time = datetime.datetime.now()
-            myDict = {'TestId':rowcount, 'UUT':UUT, 'FirmVersion':version, 'DateTimeStamp':time,'Description':'Motor Away Movement', 'Units':'Position', 'LowerRangeValue':1700,'HigherRangeValue':2000,'MeasuredValue':away_test,'Result':test_result}
+            myDict = {'UUT':self.run_context.uut, 'FirmVersion':self.run_context.version, 'DateTimeStamp':time,'Description':'Motor Away Movement', 'Units':'Position', 'LowerRangeValue':1700,'HigherRangeValue':2000,'MeasuredValue':self.run_context.away_test,'Result':self.run_context.test_result}
             #"Test Id", "UUT","DateTimeStamp","Description","Units","MeasuredValue","LowerRangeValue","HigherRangeValue","Result"
-            writer.writerow(myDict)  
-            rowcount+=1
+            self.results.write_row(myDict)  
         elif event_code == AmiraEventCodes.motor_fsm_error:
-            test_result='Fail'
+            self.run_context.test_result='Fail'
             result = AmiraTestEventParserReturnValues.failure
-            away_test=99999
+            self.run_context.away_test=99999
             print('FAILURE: MOTOR POSITION ERROR')
-            f = open("test_scripts/test.csv", 'a', newline='')
-            # create the csv writer
-            writer = csv.DictWriter(f, fieldnames = header)
             time = datetime.datetime.now()
-            myDict = {'TestId':rowcount, 'UUT':UUT, 'FirmVersion':version, 'DateTimeStamp':time,'Description':'Motor Away Movement', 'Units':'Position', 'LowerRangeValue':1700,'HigherRangeValue':2000,'MeasuredValue':'Error','Result':'Fail'}
+            myDict = {'UUT':self.run_context.uut, 'FirmVersion':self.run_context.version, 'DateTimeStamp':time,'Description':'Motor Away Movement', 'Units':'Position', 'LowerRangeValue':1700,'HigherRangeValue':2000,'MeasuredValue':'Error','Result':'Fail'}
             #"Test Id", "UUT","DateTimeStamp","Description","Units","MeasuredValue","LowerRangeValue","HigherRangeValue","Result"
-            writer.writerow(myDict)  
-            rowcount+=1
+            self.results.write_row(myDict)  
         else:
             result = AmiraTestEventParserReturnValues.ignore
-            away_test=_event_payload['position']
+            self.run_context.away_test=_event_payload['position']
                 
         return result
 
@@ -150,41 +362,30 @@ class InitDebugCapture(object):
                  test sequence should proceed to the next test step, AmiraTestEventParserReturnValues.failure if the
                  test sequence should be aborted, otherwise AmiraTestEventParserReturnValues.ignore.
         """
-        global home_test
-        global rowcount
-        global test_result
         if event_code == AmiraEventCodes.motor_fsm_move_complete:
             result = AmiraTestEventParserReturnValues.success
-            test_result='Fail'
-            if home_test>-500 and home_test<600: #Check to make sure motor is in right position This catches errors where motor doesn't move
-                test_result='Pass'
+            self.run_context.test_result='Fail'
+            if self.run_context.home_test>-500 and self.run_context.home_test<600: #Check to make sure motor is in right position This catches errors where motor doesn't move
+                self.run_context.test_result='Pass'
             else:
                 print('FAILURE: MOTOR POSITION ERROR')
-            f = open("test_scripts/test.csv", 'a', newline='')
-            # create the csv writer
-            writer = csv.DictWriter(f, fieldnames = header)
             time = datetime.datetime.now()
-            myDict = {'TestId':rowcount, 'UUT':UUT, 'FirmVersion':version, 'DateTimeStamp':time,'Description':'Motor Home Movement', 'Units':'Position', 'LowerRangeValue':-500,'HigherRangeValue':600,'MeasuredValue':home_test,'Result':test_result}
+            myDict = {'UUT':self.run_context.uut, 'FirmVersion':self.run_context.version, 'DateTimeStamp':time,'Description':'Motor Home Movement', 'Units':'Position', 'LowerRangeValue':-500,'HigherRangeValue':600,'MeasuredValue':self.run_context.home_test,'Result':self.run_context.test_result}
             #"Test Id", "UUT","DateTimeStamp","Description","Units","MeasuredValue","LowerRangeValue","HigherRangeValue","Result"
-            writer.writerow(myDict)
-            rowcount+=1
+            self.results.write_row(myDict)
             
         elif event_code == AmiraEventCodes.motor_fsm_error:
-            f = open("test_scripts/test.csv", 'a', newline='')
-            # create the csv writer
-            test_result='Fail'
-            home_test=99999
+            self.run_context.test_result='Fail'
+            self.run_context.home_test=99999
             print('FAILURE: MOTOR POSITION ERROR')
-            writer = csv.DictWriter(f, fieldnames = header)
             time = datetime.datetime.now()
-            myDict = {'TestId':rowcount, 'UUT':UUT, 'FirmVersion':version, 'DateTimeStamp':time,'Description':'Motor Home Movement', 'Units':'Position', 'LowerRangeValue':-500,'HigherRangeValue':6000,'MeasuredValue':'Error','Result':'Fail'}
+            myDict = {'UUT':self.run_context.uut, 'FirmVersion':self.run_context.version, 'DateTimeStamp':time,'Description':'Motor Home Movement', 'Units':'Position', 'LowerRangeValue':-500,'HigherRangeValue':6000,'MeasuredValue':'Error','Result':'Fail'}
             #"Test Id", "UUT","DateTimeStamp","Description","Units","MeasuredValue","LowerRangeValue","HigherRangeValue","Result"
-            writer.writerow(myDict)
-            rowcount+=1
+            self.results.write_row(myDict)
             result = AmiraTestEventParserReturnValues.failure
         else:            
             result = AmiraTestEventParserReturnValues.ignore
-            home_test=_event_payload['position']
+            self.run_context.home_test=_event_payload['position']
                 
         return result
 
@@ -247,34 +448,24 @@ class InitDebugCapture(object):
                  AmiraTestInternalErrors.test_step_custom_response_parser_failure event code.
         """
         # allow the NRFX_ERROR_ALREADY_INITIALIZED error to occur which just means that the optics has
-        global rowcount
-        global test_result
         if error_code == AmiraErrorCodes.NRF_SUCCESS or error_code == AmiraErrorCodes.NRFX_SUCCESS or \
                 error_code == AmiraErrorCodes.NRFX_ERROR_ALREADY_INITIALIZED or \
                 error_code == AmiraErrorCodes.NRF_ERROR_MODULE_ALREADY_INITIALIZED:
             # return True to indicate that the response was parsed properly with no errors
-            f = open("test_scripts/test.csv", 'a', newline='')
-            # create the csv writer
-            writer = csv.DictWriter(f, fieldnames = header)
             time = datetime.datetime.now()
-            myDict = {'TestId':rowcount, 'UUT':UUT, 'FirmVersion':version, 'DateTimeStamp':time,'Description':'Initializing the Heater', 'Units':'Pass/Fail', 'MeasuredValue':'NRF_SUCCESS','Result':'Pass'}
+            myDict = {'UUT':self.run_context.uut, 'FirmVersion':self.run_context.version, 'DateTimeStamp':time,'Description':'Initializing the Heater', 'Units':'Pass/Fail', 'MeasuredValue':'NRF_SUCCESS','Result':'Pass'}
             #"Test Id", "UUT","DateTimeStamp","Description","Units","MeasuredValue","LowerRangeValue","HigherRangeValue","Result"
-            writer.writerow(myDict)
-            rowcount+=1
+            self.results.write_row(myDict)
             return True
         else:
-            test_result='Fail'
+            self.run_context.test_result='Fail'
             # return False indicating that there was a problem - note: this will end the execution of the entire
             # test script
             print('FAILURE: HEATER DID NOT INITIALIZE')
-            f = open("test_scripts/test.csv", 'a', newline='')
-            # create the csv writer
-            writer = csv.DictWriter(f, fieldnames = header)
             time = datetime.datetime.now()
-            myDict = {'TestId':rowcount, 'UUT':UUT, 'FirmVersion':version, 'DateTimeStamp':time,'Description':'Initializing the Heater', 'Units':'Pass/Fail', 'MeasuredValue':'NRF_FAILURE','Result':'Fail'}
+            myDict = {'UUT':self.run_context.uut, 'FirmVersion':self.run_context.version, 'DateTimeStamp':time,'Description':'Initializing the Heater', 'Units':'Pass/Fail', 'MeasuredValue':'NRF_FAILURE','Result':'Fail'}
             #"Test Id", "UUT","DateTimeStamp","Description","Units","MeasuredValue","LowerRangeValue","HigherRangeValue","Result"
-            writer.writerow(myDict)
-            rowcount+=1
+            self.results.write_row(myDict)
             return False
 
     def fluidics_init_response_parser(self, _test_step_index: int, _response_success: bool, error_code: AmiraErrorCodes,
@@ -301,87 +492,136 @@ class InitDebugCapture(object):
         # allow the NRFX_ERROR_ALREADY_INITIALIZED error to occur which just means that the optics has already been initialized
         
         # open the file in the write mode
-        global rowcount
-        global test_result
         if error_code == AmiraErrorCodes.NRF_SUCCESS or error_code == AmiraErrorCodes.NRFX_SUCCESS or \
                 error_code == AmiraErrorCodes.NRFX_ERROR_ALREADY_INITIALIZED or \
                 error_code == AmiraErrorCodes.NRF_ERROR_MODULE_ALREADY_INITIALIZED:
             # return True to indicate that the response was parsed properly with no errors
-            f = open("test_scripts/test.csv", 'a', newline='')
-            # create the csv writer
-            writer = csv.DictWriter(f, fieldnames = header)
             time = datetime.datetime.now()
-            myDict = {'TestId':rowcount, 'UUT':UUT, 'FirmVersion':version, 'DateTimeStamp':time,'Description':'Initializing the Fluidics', 'Units':'Pass/Fail', 'MeasuredValue':'NRF_SUCCESS','Result':'Pass'}
+            myDict = {'UUT':self.run_context.uut, 'FirmVersion':self.run_context.version, 'DateTimeStamp':time,'Description':'Initializing the Fluidics', 'Units':'Pass/Fail', 'MeasuredValue':'NRF_SUCCESS','Result':'Pass'}
             #"Test Id", "UUT","DateTimeStamp","Description","Units","MeasuredValue","LowerRangeValue","HigherRangeValue","Result"
-            writer.writerow(myDict)
-            rowcount+=1
+            self.results.write_row(myDict)
             return True
         else:
-            test_result='Fail'
+            self.run_context.test_result='Fail'
             # return False indicating that there was a problem - note: this will end the execution of the entire
             # test script
             print('FAILURE: FLUIDICS DID NOT INITIALIZE')
-            f = open("test_scripts/test.csv", 'a', newline='')
-            # create the csv writer
-            writer = csv.DictWriter(f, fieldnames = header)
             time = datetime.datetime.now()
-            myDict = {'TestId':rowcount, 'UUT':UUT, 'FirmVersion':version, 'DateTimeStamp':time,'Description':'Initializing the Fluidics', 'Units':'Pass/Fail', 'MeasuredValue':'NRF_FAILURE','Result':'Fail'}
+            myDict = {'UUT':self.run_context.uut, 'FirmVersion':self.run_context.version, 'DateTimeStamp':time,'Description':'Initializing the Fluidics', 'Units':'Pass/Fail', 'MeasuredValue':'NRF_FAILURE','Result':'Fail'}
             #"Test Id", "UUT","DateTimeStamp","Description","Units","MeasuredValue","LowerRangeValue","HigherRangeValue","Result"
-            writer.writerow(myDict)
-            rowcount+=1
+            self.results.write_row(myDict)
             return False
 
+    def start_ble_discovery_on_exit(self, _test_step_index: int) -> bool:
+        """
+        This routine is called on the exit of the test step that turns the BLE radio on.  It starts scanning for the
+        advertisement of the unit with the scanned serial number in the background so the scan runs alongside the
+        following test steps.
+
+        :param _test_step_index: Current test step index of the test sequence.  Not used by this routine.
+        :return: True if this routine has executed properly or False if there was an error.
+        """
+        self.ble_discovery = ble_discovery.BleDiscovery(self.run_context.serial_val,
+                                                       service_address=SMOKE_BLE_SCAN_SERVICE)
+        self.ble_discovery.start()
+        return True
+
     def serial_response_parser(self, _test_step_index: int, _response_success: bool, error_code: AmiraErrorCodes,
                                     _command_str: str, _response_payload: dict) -> bool:
-        
-        global rowcount
-        global test_result
-        global bluetoothID
-
-        async def run():
-            global bluetoothID
-            devices = await BleakScanner.discover()
-            for d in devices:
-                if 'Amira' in str(d):
-                    bluetoothID=str(d)
-                    #print(d)
-                    break
-
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(run())
+        """
+        This function is used to customize the parsing of command responses received for the "mfg getwid" message.
+        It checks that the wireless ID of the unit is the scanned serial number.
 
+        :param _test_step_index: Index of the currently executing test step (not used by this routine).
+        :param _response_success: Success of the response parsing (not used by this routine).
+        :param error_code: Error code of the response (AmiraErrorCodes.NRF_SUCCESS or AmiraErrorCodes.NRFX_SUCCESS if
+                           the command was successful, otherwise another error code).
+        :param _command_str: Sub-command portion of the command string.  Not used by this routine.
+        :param _response_payload: JSON formatted response payload with the 'wirelessIdFull' of the unit.
+
+        :return: True if the command was successfully parsed/approved by this routine, otherwise False.
+        """
         if error_code == AmiraErrorCodes.NRF_SUCCESS or error_code == AmiraErrorCodes.NRFX_SUCCESS or \
                 error_code == AmiraErrorCodes.NRFX_ERROR_ALREADY_INITIALIZED or \
                 error_code == AmiraErrorCodes.NRF_ERROR_MODULE_ALREADY_INITIALIZED:
             # return True to indicate that the response was parsed properly with no errors
-            global UUT
-            UUT=_response_payload['wirelessIdFull'] #capture the id of the amira
-            if UUT!=serial_val:
+            self.run_context.uut=_response_payload['wirelessIdFull'] #capture the id of the amira
+            if self.run_context.uut!=self.run_context.serial_val:
                 print("Serial Values Set Incorrectly, Reinstall the firmware and try again")
-                print(UUT)
-                print(serial_val)
+                print(self.run_context.uut)
+                print(self.run_context.serial_val)
+                self.results.flush(sync=True)
                 return False
             else:
                 print("RFID Set Correctly")
-                            
-            if str(UUT)[-3:]==str(bluetoothID)[-3:]:
+            return True
+        else:
+            # return False indicating that there was a problem - note: this will end the execution of the entire
+            # test script
+            self.results.flush(sync=True)
+            return False
+
+    def bluetooth_response_parser(self, _test_step_index: int, _response_success: bool, error_code: AmiraErrorCodes,
+                                  _command_str: str, _response_payload: dict) -> bool:
+        """
+        This function is used to customize the parsing of command responses received for the "mfg getwid" message of
+        the Bluetooth check.  It collects the result of the background BLE scan and checks that the unit has been
+        seen advertising.
+
+        :param _test_step_index: Index of the currently executing test step (not used by this routine).
+        :param _response_success: Success of the response parsing (not used by this routine).
+        :param error_code: Error code of the response (AmiraErrorCodes.NRF_SUCCESS or AmiraErrorCodes.NRFX_SUCCESS if
+                           the command was successful, otherwise another error code).
+        :param _command_str: Sub-command portion of the command string.  Not used by this routine.
+        :param _response_payload: JSON formatted response payload.  Not used by this routine.
+
+        :return: True if the command was successfully parsed/approved by this routine, otherwise False.
+        """
+        if error_code == AmiraErrorCodes.NRF_SUCCESS or error_code == AmiraErrorCodes.NRFX_SUCCESS or \
+                error_code == AmiraErrorCodes.NRFX_ERROR_ALREADY_INITIALIZED or \
+                error_code == AmiraErrorCodes.NRF_ERROR_MODULE_ALREADY_INITIALIZED:
+            if self.ble_discovery is None:
+                self.ble_discovery = ble_discovery.BleDiscovery(self.run_context.serial_val,
+                                                               service_address=SMOKE_BLE_SCAN_SERVICE)
+            # take one snapshot of the discovery and use only that - the result is final once wait() has returned
+            discovery = self.ble_discovery.wait(SMOKE_BLE_RESULT_TIMEOUT_S)
+            self.run_context.bluetooth_id = discovery.description if discovery is not None else 'Not Found'
+            # the check runs late in the sequence, so its row gets its own result instead of the result of the run so far
+            if discovery is not None:
                 print("Bluetooth is functional")
+                bluetooth_result = 'Pass'
             else:
                 print("FAILURE BAD BLUETOOTH VALUES")
-                test_result='Fail'
+                bluetooth_result = 'Fail'
+                self.run_context.test_result='Fail'
 
-            f = open("test_scripts/test.csv", 'a', newline='')
-            # create the csv writer
-            writer = csv.DictWriter(f, fieldnames = header)
             time = datetime.datetime.now()
-            myDict = {'TestId':rowcount, 'UUT':UUT, 'FirmVersion':version, 'DateTimeStamp':time,'Description':'Bluetooth Test', 'Units':'Pass/Fail', 'MeasuredValue':str(bluetoothID),'Result':test_result}
+            myDict = {'UUT':self.run_context.uut, 'FirmVersion':self.run_context.version, 'DateTimeStamp':time,'Description':'Bluetooth Test', 'Units':'Pass/Fail', 'MeasuredValue':str(self.run_context.bluetooth_id),'Result':bluetooth_result}
             #"Test Id", "UUT","DateTimeStamp","Description","Units","MeasuredValue","LowerRangeValue","HigherRangeValue","Result"
-            writer.writerow(myDict)
-            rowcount+=1
+            self.results.write_row(myDict)
+
+            if discovery is not None:
+                # record the radio metrics of the advertisement - the signal strength and the time from turning the
+                # radio on until the unit was discovered
+                if discovery.rssi is not None:
+                    rssi_low = self.ble_discovery.min_rssi
+                    rssi_result = 'Pass' if (rssi_low is None or discovery.rssi >= rssi_low) and \
+                        discovery.rssi <= 0 else 'Fail'
+                    if rssi_result == 'Fail':
+                        self.run_context.test_result='Fail'
+                    myDict = {'UUT':self.run_context.uut, 'FirmVersion':self.run_context.version, 'DateTimeStamp':time,'Description':'Bluetooth RSSI', 'Units':'dBm', 'MeasuredValue':discovery.rssi,'LowerRangeValue':rssi_low,'HigherRangeValue':0,'Result':rssi_result}
+                    self.results.write_row(myDict)
+                discovery_time = round(discovery.discovery_time,3)
+                discovery_time_result = 'Pass' if 0 <= discovery_time <= self.ble_discovery.scan_timeout else 'Fail'
+                if discovery_time_result == 'Fail':
+                    self.run_context.test_result='Fail'
+                myDict = {'UUT':self.run_context.uut, 'FirmVersion':self.run_context.version, 'DateTimeStamp':time,'Description':'Bluetooth Discovery Time', 'Units':'Seconds', 'MeasuredValue':discovery_time,'LowerRangeValue':0,'HigherRangeValue':self.ble_discovery.scan_timeout,'Result':discovery_time_result}
+                self.results.write_row(myDict)
             return True
         else:
             # return False indicating that there was a problem - note: this will end the execution of the entire
             # test script
+            self.results.flush(sync=True)
             return False
 
     def version_response_parser(self, _test_step_index: int, _response_success: bool, error_code: AmiraErrorCodes,
@@ -409,18 +649,17 @@ class InitDebugCapture(object):
         
         # open the file in the write mode
         
-        global rowcount
         
         if error_code == AmiraErrorCodes.NRF_SUCCESS or error_code == AmiraErrorCodes.NRFX_SUCCESS or \
                 error_code == AmiraErrorCodes.NRFX_ERROR_ALREADY_INITIALIZED or \
                 error_code == AmiraErrorCodes.NRF_ERROR_MODULE_ALREADY_INITIALIZED:
             # return True to indicate that the response was parsed properly with no errors
-            global version
-            version=_response_payload['versionString']#capture the version of the amira
+            self.run_context.version=_response_payload['versionString']#capture the version of the amira
             return True
         else:
             # return False indicating that there was a problem - note: this will end the execution of the entire
             # test script
+            self.results.flush(sync=True)
             return False
 
     def door_init_response_parser(self, _test_step_index: int, _response_success: bool, error_code: AmiraErrorCodes,
@@ -445,35 +684,25 @@ class InitDebugCapture(object):
                  event code.
         """
         # allow the NRFX_ERROR_ALREADY_INITIALIZED error to occur which just means that the door has already been initialized
-        global rowcount
-        global test_result
         if error_code == AmiraErrorCodes.NRF_SUCCESS or error_code == AmiraErrorCodes.NRFX_SUCCESS or \
                 error_code == AmiraErrorCodes.NRFX_ERROR_ALREADY_INITIALIZED or \
                 error_code == AmiraErrorCodes.NRF_ERROR_MODULE_ALREADY_INITIALIZED:
             # return True to indicate that the response was parsed properly with no errors
 
-            f = open("test_scripts/test.csv", 'a', newline='')
-            # create the csv writer
-            writer = csv.DictWriter(f, fieldnames = header)
             time = datetime.datetime.now()
-            myDict = {'TestId':rowcount, 'UUT':UUT, 'FirmVersion':version, 'DateTimeStamp':time,'Description':'Initializing the Door', 'Units':'Pass/Fail', 'MeasuredValue':'NRF_SUCCESS','Result':'Pass'}
+            myDict = {'UUT':self.run_context.uut, 'FirmVersion':self.run_context.version, 'DateTimeStamp':time,'Description':'Initializing the Door', 'Units':'Pass/Fail', 'MeasuredValue':'NRF_SUCCESS','Result':'Pass'}
             #"Test Id", "UUT","DateTimeStamp","Description","Units","MeasuredValue","LowerRangeValue","HigherRangeValue","Result"
-            writer.writerow(myDict)
-            rowcount+=1
+            self.results.write_row(myDict)
             return True
         else:
-            test_result='Fail'
+            self.run_context.test_result='Fail'
             # return False indicating that there was a problem - note: this will end the execution of the entire
             # test script
             print('FAILURE: DOOR DID NOT INITIALIZE')
-            f = open("test_scripts/test.csv", 'a', newline='')
-            # create the csv writer
-            writer = csv.DictWriter(f, fieldnames = header)
             time = datetime.datetime.now()
-            myDict = {'TestId':rowcount, 'UUT':UUT, 'FirmVersion':version, 'DateTimeStamp':time,'Description':'Initializing the Door', 'Units':'Pass/Fail', 'MeasuredValue':'NRF_FAILURE','Result':'Fail'}
+            myDict = {'UUT':self.run_context.uut, 'FirmVersion':self.run_context.version, 'DateTimeStamp':time,'Description':'Initializing the Door', 'Units':'Pass/Fail', 'MeasuredValue':'NRF_FAILURE','Result':'Fail'}
             #"Test Id", "UUT","DateTimeStamp","Description","Units","MeasuredValue","LowerRangeValue","HigherRangeValue","Result"
-            writer.writerow(myDict)
-            rowcount+=1
+            self.results.write_row(myDict)
             return False
 
     def door_uninit_response_parser(self, _test_step_index: int, _response_success: bool, error_code: AmiraErrorCodes,
@@ -498,33 +727,24 @@ class InitDebugCapture(object):
                  event code.
         """
         # allow the NRFX_ERROR_ALREADY_INITIALIZED error to occur which just means that the door has already been initialized
-        global rowcount
-        global test_result
         if error_code == AmiraErrorCodes.NRF_SUCCESS or error_code == AmiraErrorCodes.NRFX_SUCCESS or \
                 error_code == AmiraErrorCodes.NRFX_ERROR_ALREADY_INITIALIZED or \
                 error_code == AmiraErrorCodes.NRF_ERROR_MODULE_ALREADY_INITIALIZED:
             # return True to indicate that the response was parsed properly with no errors
 
-            f = open("test_scripts/test.csv", 'a', newline='')
-            writer = csv.DictWriter(f, fieldnames = header)
             time = datetime.datetime.now()
-            myDict = {'TestId':rowcount, 'UUT':UUT, 'FirmVersion':version, 'DateTimeStamp':time,'Description':'UnInitializing the Door', 'Units':'Pass/Fail', 'MeasuredValue':'NRF_SUCCESS','Result':'Pass'}
+            myDict = {'UUT':self.run_context.uut, 'FirmVersion':self.run_context.version, 'DateTimeStamp':time,'Description':'UnInitializing the Door', 'Units':'Pass/Fail', 'MeasuredValue':'NRF_SUCCESS','Result':'Pass'}
             #"Test Id", "UUT","DateTimeStamp","Description","Units","MeasuredValue","LowerRangeValue","HigherRangeValue","Result"
-            writer.writerow(myDict)
-            rowcount+=1
+            self.results.write_row(myDict)
             return True
         else:
-            test_result='Fail'
+            self.run_context.test_result='Fail'
             # return False indicating that there was a problem - note: this will end the execution of the entire
             print('FAILURE: DOOR FAILED TO UNINITIALIZE')
-            f = open("test_scripts/test.csv", 'a', newline='')
-            # create the csv writer
-            writer = csv.DictWriter(f, fieldnames = header)
             time = datetime.datetime.now()
-            myDict = {'TestId':rowcount, 'UUT':UUT, 'FirmVersion':version, 'DateTimeStamp':time,'Description':'UnInitializing the Door', 'Units':'Pass/Fail', 'MeasuredValue':error_code,'Result':'Fail'}
+            myDict = {'UUT':self.run_context.uut, 'FirmVersion':self.run_context.version, 'DateTimeStamp':time,'Description':'UnInitializing the Door', 'Units':'Pass/Fail', 'MeasuredValue':error_code,'Result':'Fail'}
             #"Test Id", "UUT","DateTimeStamp","Description","Units","MeasuredValue","LowerRangeValue","HigherRangeValue","Result"
-            writer.writerow(myDict)
-            rowcount+=1
+            self.results.write_row(myDict)
             return False
 
 
@@ -550,33 +770,24 @@ class InitDebugCapture(object):
                      event code.
             """
             # allow the NRFX_ERROR_ALREADY_INITIALIZED error to occur which just means that the optics has
-            global rowcount
-            global test_result
             if error_code == AmiraErrorCodes.NRF_SUCCESS or error_code == AmiraErrorCodes.NRFX_SUCCESS or \
                     error_code == AmiraErrorCodes.NRFX_ERROR_ALREADY_INITIALIZED or \
                     error_code == AmiraErrorCodes.NRF_ERROR_MODULE_ALREADY_INITIALIZED:
                 # return True to indicate that the response was parsed properly with no errors
 
-                f = open("test_scripts/test.csv", 'a', newline='')
-                writer = csv.DictWriter(f, fieldnames = header)
                 time = datetime.datetime.now()
-                myDict = {'TestId':rowcount, 'UUT':UUT, 'FirmVersion':version, 'DateTimeStamp':time,'Description':'Initializing the Optics', 'Units':'Pass/Fail', 'MeasuredValue':'NRF_SUCCESS','Result':'Pass'}
+                myDict = {'UUT':self.run_context.uut, 'FirmVersion':self.run_context.version, 'DateTimeStamp':time,'Description':'Initializing the Optics', 'Units':'Pass/Fail', 'MeasuredValue':'NRF_SUCCESS','Result':'Pass'}
                 #"Test Id", "UUT","DateTimeStamp","Description","Units","MeasuredValue","LowerRangeValue","HigherRangeValue","Result"
-                writer.writerow(myDict)
-                rowcount+=1
+                self.results.write_row(myDict)
                 return True
             else:
-                test_result='Fail'
+                self.run_context.test_result='Fail'
                 # return False indicating that there was a problem - note: this will end the execution of the entire
                 print('FAILURE: OPTICS FAILED TO INITIALIZE')
-                f = open("test_scripts/test.csv", 'a', newline='')
-                # create the csv writer
-                writer = csv.DictWriter(f, fieldnames = header)
                 time = datetime.datetime.now()
-                myDict = {'TestId':rowcount, 'UUT':UUT, 'FirmVersion':version, 'DateTimeStamp':time,'Description':'Initializing the Optics', 'Units':'Pass/Fail', 'MeasuredValue':'Error','Result':'Fail'}
+                myDict = {'UUT':self.run_context.uut, 'FirmVersion':self.run_context.version, 'DateTimeStamp':time,'Description':'Initializing the Optics', 'Units':'Pass/Fail', 'MeasuredValue':'Error','Result':'Fail'}
                 #"Test Id", "UUT","DateTimeStamp","Description","Units","MeasuredValue","LowerRangeValue","HigherRangeValue","Result"
-                writer.writerow(myDict)
-                rowcount+=1
+                self.results.write_row(myDict)
                 return False
 
 
@@ -619,7 +830,6 @@ class InitDebugCapture(object):
         # for proper sequencing of events
         result = AmiraTestEventParserReturnValues.ignore
 
-        global rowcount
 
         if event_code == AmiraEventCodes.app_fsm_door_open: #If door open as been detected
             log.msg('custom_door_open_event_parser: the door has been opened successfully!', logLevel=logging.INFO)
@@ -628,15 +838,11 @@ class InitDebugCapture(object):
                     'rtc_ticks: {3}, payload: {4}'.format(test_step_index, event_code, time_of_day, time_str,
                                                           rtc_ticks, event_payload), logLevel=logging.INFO)
             
-            f = open("test_scripts/test.csv", 'a', newline='')
-            # create the csv writer
             
-            writer = csv.DictWriter(f, fieldnames = header)
             time = datetime.datetime.now()
-            myDict = {'TestId':rowcount, 'UUT':UUT,'FirmVersion':version, 'DateTimeStamp':time,'Description':'Opening the Door', 'Units':'Pass/Fail', 'MeasuredValue':'app_fsm_door_open','Result':'Pass'}
+            myDict = {'UUT':self.run_context.uut,'FirmVersion':self.run_context.version, 'DateTimeStamp':time,'Description':'Opening the Door', 'Units':'Pass/Fail', 'MeasuredValue':'app_fsm_door_open','Result':'Pass'}
             #"Test Id", "UUT","DateTimeStamp","Description","Units","MeasuredValue","LowerRangeValue","HigherRangeValue","Result"
-            writer.writerow(myDict)
-            rowcount+=1
+            self.results.write_row(myDict)
             # indicate that the event was successfully parsed and the test sequence should proceed to the next
             # test step
             result = AmiraTestEventParserReturnValues.success
@@ -668,26 +874,18 @@ class InitDebugCapture(object):
         # note: use the Twisted library's logging call "log" instead of the standard Python logging library
         # for proper sequencing of events
         result = AmiraTestEventParserReturnValues.ignore
-        global test_result
-        global rowcount
-        global ref_optics_test
-        global main_optics_test
         if event_code == AmiraEventCodes.optics_measurement_complete:
-            f = open("test_scripts/test.csv", 'a', newline='')
-            # create the csv writer
-            writer = csv.DictWriter(f, fieldnames = header)
             time = datetime.datetime.now()
-            test_result='Fail'
+            self.run_context.test_result='Fail'
             
-            main_optics_test=event_payload['main-pd']#Set Values for measure_half tests
+            self.run_context.main_optics_test=event_payload['main-pd']#Set Values for measure_half tests
             if event_payload['main-pd']<50000 and event_payload['main-pd']>1000:#Checks to make sure the values is a passsing value
-                test_result='Pass'
-            if test_result=='Fail':
+                self.run_context.test_result='Pass'
+            if self.run_context.test_result=='Fail':
                 print('FAILURE: BAD MAIN PD OPTICS TEST')
-            myDict = {'TestId':rowcount, 'UUT':UUT,'FirmVersion':version, 'DateTimeStamp':time,'Description':'Main PD Optics Measurement', 'Units':'Saturation', 'MeasuredValue':event_payload['main-pd'],'LowerRangeValue':1000,'HigherRangeValue':50000,'Result':test_result}
+            myDict = {'UUT':self.run_context.uut,'FirmVersion':self.run_context.version, 'DateTimeStamp':time,'Description':'Main PD Optics Measurement', 'Units':'Saturation', 'MeasuredValue':event_payload['main-pd'],'LowerRangeValue':1000,'HigherRangeValue':50000,'Result':self.run_context.test_result}
             #"Test Id", "UUT","DateTimeStamp","Description","Units","MeasuredValue","LowerRangeValue","HigherRangeValue","Result"
-            writer.writerow(myDict)
-            rowcount+=1
+            self.results.write_row(myDict)
 
             result = AmiraTestEventParserReturnValues.success
         else:
@@ -718,26 +916,21 @@ class InitDebugCapture(object):
         # note: use the Twisted library's logging call "log" instead of the standard Python logging library
         # for proper sequencing of events
         result = AmiraTestEventParserReturnValues.ignore
-        global test_result
-        global rowcount
         test1='Fail'
         test2='Fail'
         if event_code == AmiraEventCodes.optics_measurement_complete:
-            f = open("test_scripts/test.csv", 'a', newline='')
-            # create the csv writer
-            writer = csv.DictWriter(f, fieldnames = header)
             time = datetime.datetime.now()
             
 
-            test_result='Fail'
-            ratio=main_optics_test/(event_payload['main-pd']+.0001)
+            self.run_context.test_result='Fail'
+            ratio=self.run_context.main_optics_test/(event_payload['main-pd']+.0001)
             if ratio>1.8:#Checks to make sure the values is a passsing value
                 test1='Pass'
             else:
-                test_result='Fail'
+                self.run_context.test_result='Fail'
             if event_payload['main-pd']<25000 and event_payload['main-pd']>500:
                 if test1=='Pass':                    
-                    test_result='Pass'
+                    self.run_context.test_result='Pass'
                 test2='Pass'
             else:
                 test2='Fail'
@@ -745,15 +938,13 @@ class InitDebugCapture(object):
                 print('FAILURE: BAD MAIN PD HALF OPTICS TEST')
             if test1=='Fail':
                 print('FAILURE: BAD MAIN PD Ratio OPTICS TEST')
-            myDict = {'TestId':rowcount, 'UUT':UUT,'FirmVersion':version, 'DateTimeStamp':time,'Description':'Half Power Main PD Optics Measurement', 'Units':'Saturation'.format(ratio), 'MeasuredValue':event_payload['main-pd'],'LowerRangeValue':500,'HigherRangeValue':25000,'Result':test2}
+            myDict = {'UUT':self.run_context.uut,'FirmVersion':self.run_context.version, 'DateTimeStamp':time,'Description':'Half Power Main PD Optics Measurement', 'Units':'Saturation'.format(ratio), 'MeasuredValue':event_payload['main-pd'],'LowerRangeValue':500,'HigherRangeValue':25000,'Result':test2}
             #"Test Id", "UUT","DateTimeStamp","Description","Units","MeasuredValue","LowerRangeValue","HigherRangeValue","Result"
-            writer.writerow(myDict)
-            rowcount+=1
+            self.results.write_row(myDict)
 
-            myDict = {'TestId':rowcount, 'UUT':UUT,'FirmVersion':version, 'DateTimeStamp':time,'Description':'Half Power Ratio Measurement', 'Units':'Ratio', 'MeasuredValue':ratio,'LowerRangeValue':1.8,'HigherRangeValue':5.0,'Result':test1}
+            myDict = {'UUT':self.run_context.uut,'FirmVersion':self.run_context.version, 'DateTimeStamp':time,'Description':'Half Power Ratio Measurement', 'Units':'Ratio', 'MeasuredValue':ratio,'LowerRangeValue':1.8,'HigherRangeValue':5.0,'Result':test1}
             #"Test Id", "UUT","DateTimeStamp","Description","Units","MeasuredValue","LowerRangeValue","HigherRangeValue","Result"
-            writer.writerow(myDict)
-            rowcount+=1
+            self.results.write_row(myDict)
 
             result = AmiraTestEventParserReturnValues.success
         else:
@@ -773,18 +964,13 @@ class InitDebugCapture(object):
         :param user_input:  User entered string.
         :return: None.
         """
-        global test_result
-        global rowcount
-        test_result='Fail'
+        self.run_context.test_result='Fail'
         if user_input=='y' or user_input=='Y':#Checks to see if the user says test passed
-            test_result='Pass'
-        f = open("test_scripts/test.csv", 'a', newline='')
-        writer = csv.DictWriter(f, fieldnames = header)
+            self.run_context.test_result='Pass'
         time = datetime.datetime.now()
-        myDict = {'TestId':rowcount, 'UUT':UUT, 'FirmVersion':version, 'DateTimeStamp':time,'Description':'Manual LED Test', 'Units':'Pass/Fail','Result':test_result}
+        myDict = {'UUT':self.run_context.uut, 'FirmVersion':self.run_context.version, 'DateTimeStamp':time,'Description':'Manual LED Test', 'Units':'Pass/Fail','Result':self.run_context.test_result}
         #"Test Id", "UUT","DateTimeStamp","Description","Units","MeasuredValue","LowerRangeValue","HigherRangeValue","Result"
-        writer.writerow(myDict)
-        rowcount+=1
+        self.results.write_row(myDict)
             
 
     def custom_strip_user_input_parser(self, test_step_index: int, user_input: str) -> None:
@@ -798,18 +984,52 @@ class InitDebugCapture(object):
         :param user_input:  User entered string.
         :return: None.
         """
-        global rowcount
-        global test_result
-        test_result='Fail'
+        self.run_context.test_result='Fail'
         if user_input=='y' or user_input=='Y':#If the user entered that it passed change result value
-            test_result='Pass'
-        f = open("test_scripts/test.csv", 'a', newline='')
-        writer = csv.DictWriter(f, fieldnames = header)
+            self.run_context.test_result='Pass'
         time = datetime.datetime.now()
-        myDict = {'TestId':rowcount, 'UUT':UUT, 'FirmVersion':version, 'DateTimeStamp':time,'Description':'Manual Strip Tension Test', 'Units':'Pass/Fail','Result':test_result}
+        myDict = {'UUT':self.run_context.uut, 'FirmVersion':self.run_context.version, 'DateTimeStamp':time,'Description':'Manual Strip Tension Test', 'Units':'Pass/Fail','Result':self.run_context.test_result}
         #"Test Id", "UUT","DateTimeStamp","Description","Units","MeasuredValue","LowerRangeValue","HigherRangeValue","Result"
-        writer.writerow(myDict)
-        rowcount+=1
+        self.results.write_row(myDict)
+
+    def led_sweep_response_parser(self, _test_step_index: int, _response_success: bool, error_code: AmiraErrorCodes,
+                                  _command_str: str, _response_payload: dict) -> bool:
+        """
+        This function is used to customize the parsing of the responses to the pipelined "ins ui-led setstate"
+        commands of an LED phase.  The responses of all the commands of the phase arrive in the last step of the phase.
+
+        :param _test_step_index: Index of the currently executing test step (not used by this routine).
+        :param _response_success: Success of the response parsing (not used by this routine).
+        :param error_code: Error code of the response (AmiraErrorCodes.NRF_SUCCESS or AmiraErrorCodes.NRFX_SUCCESS if
+                           the command was successful, otherwise another error code).
+        :param _command_str: Sub-command portion of the command string.  Not used by this routine.
+        :param _response_payload: JSON formatted response payload.  Not used by this routine.
+
+        :return: True if the command was successfully parsed/approved by this routine, otherwise False.
+        """
+        if error_code == AmiraErrorCodes.NRF_SUCCESS or error_code == AmiraErrorCodes.NRFX_SUCCESS:
+            self.led_sweep_responses += 1
+            return True
+        print('FAILURE: UI LED COMMAND FAILED')
+        return False
+
+    def led_sweep_verify_on_exit(self, expected_responses: int, test_step_index: int) -> bool:
+        """
+        This routine is called on the exit of the last step of a pipelined LED phase and checks that every command of
+        the phase has been answered successfully.
+
+        :param expected_responses: Number of LED commands in the phase.
+        :param test_step_index: Current test step index of the test sequence.
+        :return: True if every command has been answered, otherwise False which fails the script.
+        """
+        responses = self.led_sweep_responses
+        self.led_sweep_responses = 0
+        if responses < expected_responses:
+            log.msg('led_sweep_verify_on_exit: test step {0}: {1} of {2} LED commands answered'.format(
+                test_step_index, responses, expected_responses), logLevel=logging.ERROR)
+            print('FAILURE: UI LED COMMANDS NOT ANSWERED')
+            return False
+        return True
 
     def failure_lights_command_generator(self, _test_step_index: int) -> str:
         """
@@ -818,10 +1038,10 @@ class InitDebugCapture(object):
         :param _test_step_index: Current test step index.  Not used by this routine.
         :return: String with command to send during the test step.
         """
-        global test_result
-        global test_failed
-        if test_result == 'Fail' or test_failed:#This only entered if each of the two temperature values are alread recorded
-            test_failed=True
+        # this step follows every test group so write the results of the group to the results file
+        self.results.flush()
+        if self.run_context.test_result == 'Fail' or self.run_context.test_failed:#This only entered if each of the two temperature values are alread recorded
+            self.run_context.test_failed=True
             return 'ins ui-led setstate-all 1'
         else:
             return 'mfg getwid'#If not setting heater send dummy command
@@ -833,56 +1053,81 @@ class InitDebugCapture(object):
         :param _test_step_index: Current test step index.  Not used by this routine.
         :return: String with command to send during the test step.
         """
-        global serial_val
         #print("hi")
-        formatted_serial=serial_val[5:10]+serial_val[11:]
+        formatted_serial=self.run_context.serial_val[5:10]+self.run_context.serial_val[11:]
         #print(formatted_serial)
         return 'mfg setwid {0}'.format(formatted_serial)
         
 
 
-serial_val='error'
-serial_val = input("Scan in the serial number on the bottom of the device")
-input("Insert the Amira into the docking station and hit enter")
-#print(serial_val)
-
-# create an instance of inits debug capture
-inits_debug = InitDebugCapture()
-
-
-# create the csv writer
-f = open("test_scripts/test.csv", 'a', newline='')
-rowcount = 0
-header=["TestId", "UUT","FirmVersion","DateTimeStamp","Description","Units","MeasuredValue","LowerRangeValue","HigherRangeValue","Result"]#csv header columns
-#iterating through the whole file
-for row in open("test_scripts/test.csv"):
-    rowcount+= 1
-if rowcount==0:#checks to see if this is the first test
-    writer = csv.DictWriter(f, fieldnames = header)
-    writer.writeheader()#if is first test write the header
-writer = csv.DictWriter(f, fieldnames = header)
-writer.writerow({'Units':' '})# This creates a space between the last test group and this test group
-f.close()
- 
-
-#Finds the current TestId
-rowcount=1 #A placeholder for the number of rows in the file
-with open('test_scripts/test.csv', newline='') as csvfile: #This finds the most recent test and sets the rowcount rows so that tests are numbered correctly
-    reader = csv.DictReader(csvfile)
-    for row in reader:
-        if row['TestId']!='':#Make sure row is populated
-            if int(row['TestId'])>=rowcount:#If value is larger than current testid set as current testid
-                rowcount=int(row['TestId'])+1 #increment row number
-
-
-bluetoothID='IDs'
-UUT=0 #Placeholder for the ID of the unit
-version=0 #Placeholder for the unit version
-home_test=0 #Place holder for the motor's location in the home movement
-test_result='Pass'
-test_failed=False
-ref_optics_test=0 #Placeholeder for the value recorded by the optics ref PD reading
-main_optics_test=0 #Placeholeder for the value recorded by the optics main PD reading
+def build_led_sweep_steps(inits_debug: InitDebugCapture, sweep: Sequence[Tuple[Sequence[int], int, int]],
+                          pipelined: bool = False) -> List[dict]:
+    """
+    This routine expands an LED pattern into test steps.  Each phase of the pattern becomes one "ins ui-led setstate"
+    command per LED followed by a delay step that holds the pattern.
+
+    :param inits_debug: Inits debug capture instance of the unit.
+    :param sweep: LED pattern - list of (LED indexes, state, hold seconds) phases.
+    :param pipelined: True to write the commands of a phase back to back and verify all the responses in the last
+                      step of the phase, False to wait for the response of each command.
+    :return: List of test steps.
+    """
+    steps = []
+    for leds, state, hold in sweep:
+        commands = ['ins ui-led setstate {0} {1}'.format(led, state) for led in leds]
+        if pipelined:
+            # the raw commands don't wait for their responses - they are all collected by the last command's parser
+            steps.extend({'action': AmiraTestOperations.send_raw_command, 'command': command, 'commandDelay': 0}
+                         for command in commands[:-1])
+            steps.append({'action': AmiraTestOperations.send_command, 'command': commands[-1],
+                          'timeout': SMOKE_LED_COMMAND_TIMEOUT_S,
+                          'customResponseParser': inits_debug.led_sweep_response_parser,
+                          'customOnExitHandler': functools.partial(inits_debug.led_sweep_verify_on_exit,
+                                                                   len(commands))})
+        else:
+            steps.extend({'action': AmiraTestOperations.send_command, 'command': command,
+                          'timeout': SMOKE_LED_COMMAND_TIMEOUT_S} for command in commands)
+        if hold > 0:
+            steps.append({'action': AmiraTestOperations.delay, 'timeout': hold})
+    return steps
+
+
+def build_init_steps(inits_debug: InitDebugCapture, concurrent: bool = False) -> List[dict]:
+    """
+    This routine builds the test steps that initialize the heater, fluidics and door.  The heater is always
+    initialized first and a failed heater init ends the script before the fluidics and door are moved.  Each init
+    response is checked by its own init response parser either way.
+
+    :param inits_debug: Inits debug capture instance of the unit.
+    :param concurrent: True to send the fluidics and door inits together and wait for both responses, False to send
+                       the door init after the fluidics init has completed.
+    :return: List of test steps.
+    """
+    failure_lights_step = {'action': AmiraTestOperations.send_command, 'timeout': 2,
+                           'customCommandGenerator': inits_debug.failure_lights_command_generator}
+    heater_steps = [
+        # enable heater debug output
+        {'action': AmiraTestOperations.send_command, 'command': 'ins heater debug enable', 'timeout': 2},
+        # initialize the heater - ignore any already initialized errors
+        {'action': AmiraTestOperations.send_command, 'command': 'ins heater init', 'timeout': 2,
+         'customResponseParser': inits_debug.heater_init_response_parser,
+         'customStepDisplayMessage': 'Initializing heater ...'},
+    ]
+    fluidics_step = {'action': AmiraTestOperations.send_command, 'command': 'ins fluidics init', 'timeout': 20,
+                     'customResponseParser': inits_debug.fluidics_init_response_parser,
+                     'customStepDisplayMessage': 'Initializing fluidics ...'}
+    # setup the door to begin sending state data
+    door_step = {'action': AmiraTestOperations.send_command, 'command': 'ins door init', 'timeout': 20,
+                 'customResponseParser': inits_debug.door_init_response_parser,
+                 'customStepDisplayMessage': 'Initializing door ...'}
+    steps = [*step_pipelining.pipeline_steps(heater_steps, SMOKE_COMMAND_PIPELINING), dict(failure_lights_step)]
+    if concurrent:
+        return steps + [*step_pipelining.pipeline_steps([fluidics_step, door_step], name='init'),
+                        dict(failure_lights_step)]
+    return steps + [fluidics_step, dict(failure_lights_step),
+                    door_step, dict(failure_lights_step)]
+
+
 """
 This is the list of test steps that the test tool will execute sequentially, one step at a time.
 
@@ -963,264 +1208,259 @@ customEventParser': Callable[[int, AmiraEventCodes, int, str, int, dict], AmiraT
            AmiraTestOperations.delay, a timeout will result in the failure of the entire test sequence with
            a AmiraTestInternalErrors.timeout error code. 
 """
-test_step_list = \
-    [
-        # send the "cli echo off" command to disable the instrument from echoing back each command - this
-        # command does not generate a JSON formatted response so use the .send_raw_command action instead
-        # of .send_command - NOTE: if the instrument has been idle for a long time, it's possible that
-        # it's gone into low power mode and disabled the serial interface so to be safe, send this message
-        # twice - if the instrument has disabled the interface, the first message will be partially lost but
-        # it will wake up the interface - sending the message twice is harmless and won't cause any problems
-        {'action': AmiraTestOperations.send_raw_command, 'command': 'cli echo off', 'commandDelay': 1},
-        {'action': AmiraTestOperations.send_raw_command, 'command': 'cli echo off', 'commandDelay': 1},
+def create_unit_test(serial_val: str, station: str = SMOKE_STATION_NAME) -> InitDebugCapture:
+    """
+    This routine creates the run context and the instance of inits debug capture for the smoke test of one unit - the
+    unit's results are written to a partition of the station in the result store that no other test of this process
+    is writing to, with TestIds from the TestIdAllocator the tests of the station share.  A runner that loads this
+    script as a library calls it once per unit and builds the test steps with build_test_step_list().
+
+    :param serial_val: Serial number scanned from the bottom of the device.
+    :param station: Name of the station the unit is tested on.
+    :return: InitDebugCapture instance of the unit - close() it once the test has ended.
+    """
+    store = result_store.PartitionedResultStore(SMOKE_RESULTS_DIR, station, SMOKE_CSV_HEADER,
+                                                legacy_filename=SMOKE_LEGACY_RESULTS_FILENAME)
+    test_ids = result_store.station_test_id_allocator(store)
+    return InitDebugCapture(SmokeRunContext(serial_val, test_ids.open_partition(), station), test_ids)
+
+
+def build_test_step_list(inits_debug: InitDebugCapture) -> List[dict]:
+    """
+    This routine builds the list of test steps for one unit.  Every unit gets its own InitDebugCapture instance and
+    its own list of test steps.
+
+    :param inits_debug: Inits debug capture instance of the unit.
+    :return: List of test steps.
+    """
+    return \
+        [
+            # send the "cli echo off" command to disable the instrument from echoing back each command - this
+            # command does not generate a JSON formatted response so use the .send_raw_command action instead
+            # of .send_command - NOTE: if the instrument has been idle for a long time, it's possible that
+            # it's gone into low power mode and disabled the serial interface so to be safe, send this message
+            # twice - if the instrument has disabled the interface, the first message will be partially lost but
+            # it will wake up the interface - sending the message twice is harmless and won't cause any problems
+            {'action': AmiraTestOperations.send_raw_command, 'command': 'cli echo off', 'commandDelay': 1},
+            {'action': AmiraTestOperations.send_raw_command, 'command': 'cli echo off', 'commandDelay': 1},
 
         
-        # send the "mfg reset" command to reset the device - this command does not generate a JSON formatted response
-        {'action': AmiraTestOperations.send_raw_command, 'command': 'mfg reset', 'commandDelay': 1,
- 'customStepDisplayMessage': 'Resetting the device ...'},
+            # send the "mfg reset" command to reset the device - this command does not generate a JSON formatted response
+            {'action': AmiraTestOperations.send_raw_command, 'command': 'mfg reset', 'commandDelay': 1,
+     'customStepDisplayMessage': 'Resetting the device ...'},
 
 
-        # wait up to 15 seconds for the instrument to reset and complete booting up
-        {'action': AmiraTestOperations.wait_for_event, 'event': AmiraEventCodes.app_general_startup_complete,
-         'timeout': 15, 'customStepDisplayMessage': 'Waiting for the device to restart ...'},
+            # wait up to 15 seconds for the instrument to reset and complete booting up
+            {'action': AmiraTestOperations.wait_for_event, 'event': AmiraEventCodes.app_general_startup_complete,
+             'timeout': 15, 'customStepDisplayMessage': 'Waiting for the device to restart ...'},
 
-         # wait 6 seconds
-        {'action': AmiraTestOperations.delay, 'timeout': 6},
+             # wait 6 seconds
+            {'action': AmiraTestOperations.delay, 'timeout': 6},
          
-        {'action': AmiraTestOperations.send_command, 'timeout': 20,
-         'customCommandGenerator': inits_debug.set_serial_command_generator},
+            {'action': AmiraTestOperations.send_command, 'timeout': 20,
+             'customCommandGenerator': inits_debug.set_serial_command_generator},
 
-         # wait 3 seconds
-        {'action': AmiraTestOperations.delay, 'timeout': 3},
+             # wait 3 seconds
+            {'action': AmiraTestOperations.delay, 'timeout': 3},
 
 
-        # disable the application FSM
-        {'action': AmiraTestOperations.send_command, 'command': 'ins state event set-bypass-fsm', 'timeout': 20},
+            # disable the application FSM
+            {'action': AmiraTestOperations.send_command, 'command': 'ins state event set-bypass-fsm', 'timeout': 20},
 
-        # send the "mfg reset" command to reset the device - this command does not generate a JSON formatted response
-        {'action': AmiraTestOperations.send_command, 'command': 'mfg app-info', 'timeout': 2,
-         'customResponseParser': inits_debug.version_response_parser},
+            # send the "mfg reset" command to reset the device - this command does not generate a JSON formatted response
+            {'action': AmiraTestOperations.send_command, 'command': 'mfg app-info', 'timeout': 2,
+             'customResponseParser': inits_debug.version_response_parser},
 
-        # disable the application FSM
-        {'action': AmiraTestOperations.send_command, 'command': 'ble radio-on', 'timeout': 20},
+            # disable the application FSM
+            # start scanning for the unit's advertisements in the background as soon as the radio is on
+            {'action': AmiraTestOperations.send_command, 'command': 'ble radio-on', 'timeout': 20,
+             'customOnExitHandler': inits_debug.start_ble_discovery_on_exit},
         
-        # send the "mfg reset" command to reset the device - this command does not generate a JSON formatted response
-        {'action': AmiraTestOperations.send_command, 'command': 'mfg getwid', 'timeout': 20,
-         'customResponseParser': inits_debug.serial_response_parser},
+            # send the "mfg reset" command to reset the device - this command does not generate a JSON formatted response
+            {'action': AmiraTestOperations.send_command, 'command': 'mfg getwid', 'timeout': 20,
+             'customResponseParser': inits_debug.serial_response_parser},
 
         
 
-        # turn on the power rails - these commands generate a JSON formatted response
-        {'action': AmiraTestOperations.send_command, 'command': 'ins pwr 0 1', 'timeout': 2},
-        {'action': AmiraTestOperations.send_command, 'command': 'ins pwr 1 1', 'timeout': 2},
-
-
-        # waiting 5 seconds
-        {'action': AmiraTestOperations.delay, 'timeout': 5,
-         'customStepDisplayMessage': 'Watch the UI LEDs Turn White then Pink then Red then off...'},
-         #Turns all Led's white
-        {'action': AmiraTestOperations.send_command, 'command': 'ins ui-led setstate 0 1', 'timeout': 2},
-        {'action': AmiraTestOperations.send_command, 'command': 'ins ui-led setstate 2 1', 'timeout': 2},
-        {'action': AmiraTestOperations.send_command, 'command': 'ins ui-led setstate 4 1', 'timeout': 2},
-        {'action': AmiraTestOperations.send_command, 'command': 'ins ui-led setstate 6 1', 'timeout': 2},
-        {'action': AmiraTestOperations.send_command, 'command': 'ins ui-led setstate 8 1', 'timeout': 2},
-        {'action': AmiraTestOperations.send_command, 'command': 'ins ui-led setstate 10 1', 'timeout': 2},
-        {'action': AmiraTestOperations.send_command, 'command': 'ins ui-led setstate 12 1', 'timeout': 2},
-
-        # Delay to see light white
-        {'action': AmiraTestOperations.delay, 'timeout': 3},
-        #Turns all Led's pink
-        {'action': AmiraTestOperations.send_command, 'command': 'ins ui-led setstate 1 1', 'timeout': 2},
-        {'action': AmiraTestOperations.send_command, 'command': 'ins ui-led setstate 3 1', 'timeout': 2},
-        {'action': AmiraTestOperations.send_command, 'command': 'ins ui-led setstate 5 1', 'timeout': 2},
-        {'action': AmiraTestOperations.send_command, 'command': 'ins ui-led setstate 7 1', 'timeout': 2},
-        {'action': AmiraTestOperations.send_command, 'command': 'ins ui-led setstate 9 1', 'timeout': 2},
-        {'action': AmiraTestOperations.send_command, 'command': 'ins ui-led setstate 11 1', 'timeout': 2},
-        {'action': AmiraTestOperations.send_command, 'command': 'ins ui-led setstate 13 1', 'timeout': 2},
-
-         # Delay to see light pink
-        {'action': AmiraTestOperations.delay, 'timeout': 3},
-
-        #Turns all Led's red by turning off white light
-        {'action': AmiraTestOperations.send_command, 'command': 'ins ui-led setstate 0 0', 'timeout': 2},
-        {'action': AmiraTestOperations.send_command, 'command': 'ins ui-led setstate 2 0', 'timeout': 2},
-        {'action': AmiraTestOperations.send_command, 'command': 'ins ui-led setstate 4 0', 'timeout': 2},
-        {'action': AmiraTestOperations.send_command, 'command': 'ins ui-led setstate 6 0', 'timeout': 2},
-        {'action': AmiraTestOperations.send_command, 'command': 'ins ui-led setstate 8 0', 'timeout': 2},
-        {'action': AmiraTestOperations.send_command, 'command': 'ins ui-led setstate 10 0', 'timeout': 2},
-        {'action': AmiraTestOperations.send_command, 'command': 'ins ui-led setstate 12 0', 'timeout': 2},
-
-        # Delay to see light red
-        {'action': AmiraTestOperations.delay, 'timeout': 3},
-
-        {'action': AmiraTestOperations.send_command, 'command': 'ins ui-led setstate 1 0', 'timeout': 2},
-        {'action': AmiraTestOperations.send_command, 'command': 'ins ui-led setstate 3 0', 'timeout': 2},
-        {'action': AmiraTestOperations.send_command, 'command': 'ins ui-led setstate 5 0', 'timeout': 2},
-        {'action': AmiraTestOperations.send_command, 'command': 'ins ui-led setstate 7 0', 'timeout': 2},
-        {'action': AmiraTestOperations.send_command, 'command': 'ins ui-led setstate 9 0', 'timeout': 2},
-        {'action': AmiraTestOperations.send_command, 'command': 'ins ui-led setstate 11 0', 'timeout': 2},
-        {'action': AmiraTestOperations.send_command, 'command': 'ins ui-led setstate 13 0', 'timeout': 2},
-
-        # wait for user input
-        {'action': AmiraTestOperations.wait_for_user_input,
-         'customStepDisplayMessage': 'Did the LEDs turn on and off properly? y=yes n=no ...',
-         'customUserInputParser': inits_debug.custom_light_user_input_parser},
-         
-         {'action': AmiraTestOperations.send_command, 'timeout': 2,
-         'customCommandGenerator': inits_debug.failure_lights_command_generator},
-
-        # enable heater debug output
-        {'action': AmiraTestOperations.send_command, 'command': 'ins heater debug enable', 'timeout': 2},
-
-        # initialize the heater - ignore any already initialized errors
-        {'action': AmiraTestOperations.send_command, 'command': 'ins heater init', 'timeout': 2,
-         'customResponseParser': inits_debug.heater_init_response_parser,
-         'customStepDisplayMessage': 'Initializing heater ...'},
+            # turn on the power rails - these commands generate a JSON formatted response
+            *step_pipelining.pipeline_steps([
+                {'action': AmiraTestOperations.send_command, 'command': 'ins pwr 0 1', 'timeout': 2},
+                {'action': AmiraTestOperations.send_command, 'command': 'ins pwr 1 1', 'timeout': 2},
+            ], SMOKE_COMMAND_PIPELINING),
 
-         {'action': AmiraTestOperations.send_command, 'timeout': 2,
-         'customCommandGenerator': inits_debug.failure_lights_command_generator},
 
-        # setup the optics to output ADC counts to the console in JSON formatted events
-        {'action': AmiraTestOperations.send_command, 'command': 'ins fluidics init',
-         'timeout': 20, 'customResponseParser': inits_debug.fluidics_init_response_parser,
-         'customStepDisplayMessage': 'Initializing fluidics ...'},
+            # waiting 5 seconds
+            {'action': AmiraTestOperations.delay, 'timeout': 5,
+             'customStepDisplayMessage': 'Watch the UI LEDs Turn White then Pink then Red then off...'},
+            # turn the LEDs white, then pink, then red (white off) and then off - see SMOKE_LED_SWEEP
+            *build_led_sweep_steps(inits_debug, SMOKE_LED_SWEEP, SMOKE_LED_PIPELINED),
 
-         {'action': AmiraTestOperations.send_command, 'timeout': 2,
-         'customCommandGenerator': inits_debug.failure_lights_command_generator},
+            # wait for user input
+            {'action': AmiraTestOperations.wait_for_user_input,
+             'customStepDisplayMessage': 'Did the LEDs turn on and off properly? y=yes n=no ...',
+             'customUserInputParser': inits_debug.custom_light_user_input_parser},
+         
+             {'action': AmiraTestOperations.send_command, 'timeout': 2,
+             'customCommandGenerator': inits_debug.failure_lights_command_generator},
 
-         # setup the door to begin sending state data
-	    {'action': AmiraTestOperations.send_command, 'command': 'ins door init',
-         'timeout': 20, 'customResponseParser': inits_debug.door_init_response_parser,
-         'customStepDisplayMessage': 'Initializing door ...'},
+            # initialize the heater, fluidics and door - see SMOKE_CONCURRENT_INIT
+            *build_init_steps(inits_debug, SMOKE_CONCURRENT_INIT),
 
-         {'action': AmiraTestOperations.send_command, 'timeout': 2,
-         'customCommandGenerator': inits_debug.failure_lights_command_generator},
+            # check the result of the BLE scan that has been running in the background since the radio was turned on
+            {'action': AmiraTestOperations.send_command, 'command': 'mfg getwid', 'timeout': 20,
+             'customResponseParser': inits_debug.bluetooth_response_parser,
+             'customStepDisplayMessage': 'Checking Bluetooth ...'},
 
-        # report the state of the door
-        {'action': AmiraTestOperations.send_command, 'command': 'ins door get-state', 'timeout': 2
-         },
+            # report the state of the door
+            {'action': AmiraTestOperations.send_command, 'command': 'ins door get-state', 'timeout': 2
+             },
 
-        # wait up to 20 seconds for the door to be opened
-        # if a door event is received, call the custom event handler custom_door_open_event_parser()
-        {'action': AmiraTestOperations.wait_for_event, 'event': AmiraEventCodes.app_fsm_door_open,
-         'customEventParser': inits_debug.custom_door_open_event_parser, 'timeout': 200,
-         'customStepDisplayMessage': 'Open the Door ...'},
+            # wait up to 20 seconds for the door to be opened
+            # if a door event is received, call the custom event handler custom_door_open_event_parser()
+            {'action': AmiraTestOperations.wait_for_event, 'event': AmiraEventCodes.app_fsm_door_open,
+             'customEventParser': inits_debug.custom_door_open_event_parser, 'timeout': 200,
+             'customStepDisplayMessage': 'Open the Door ...'},
 
-         # report the state of the door
-        {'action': AmiraTestOperations.send_command, 'command': 'ins door get-state', 'timeout': 2},
+             # report the state of the door
+            {'action': AmiraTestOperations.send_command, 'command': 'ins door get-state', 'timeout': 2},
 
-         # stop monitoring the state of the door
-	    {'action': AmiraTestOperations.send_command, 'command': 'ins door uninit',
-         'timeout': 2, 'customResponseParser': inits_debug.door_uninit_response_parser},
+             # stop monitoring the state of the door
+    	    {'action': AmiraTestOperations.send_command, 'command': 'ins door uninit',
+             'timeout': 2, 'customResponseParser': inits_debug.door_uninit_response_parser},
 
-         {'action': AmiraTestOperations.send_command, 'timeout': 2,
-         'customCommandGenerator': inits_debug.failure_lights_command_generator},
+             {'action': AmiraTestOperations.send_command, 'timeout': 2,
+             'customCommandGenerator': inits_debug.failure_lights_command_generator},
 
-         #Move motor test
-        #{'action': AmiraTestOperations.send_command, 'command': 'ins motor mode idle', 'timeout': 2},
-        {'action': AmiraTestOperations.send_command, 'command': 'ins motor moveto 1740', 
-         'customStepDisplayMessage': 'Waiting for motor away movement to complete ...','timeout': 20},
+             #Move motor test
+            #{'action': AmiraTestOperations.send_command, 'command': 'ins motor mode idle', 'timeout': 2},
+            {'action': AmiraTestOperations.send_command, 'command': 'ins motor moveto 1740', 
+             'customStepDisplayMessage': 'Waiting for motor away movement to complete ...','timeout': 20},
         
 
-         # wait for user input
-        {'action': AmiraTestOperations.wait_for_user_input,
-         'customStepDisplayMessage': 'Insert the Strip and Hit enter'},
-
-        {'action': AmiraTestOperations.send_command, 'command': 'ins motor config home', 'timeout': 2},
-        {'action': AmiraTestOperations.send_command, 'command': 'ins motor move', 'timeout': 2},
-        # wait for the motor home movement to complete
-        {'action': AmiraTestOperations.wait_for_event, 'event': AmiraEventCodes.motor_fsm_move_complete,
-         'customEventParser': inits_debug.motor_home_movement_complete_event_parser,
-         'customStepDisplayMessage': 'Waiting for motor home movement to complete ...', 'timeout': 30},
+             # wait for user input
+            {'action': AmiraTestOperations.wait_for_user_input,
+             'customStepDisplayMessage': 'Insert the Strip and Hit enter'},
 
-          {'action': AmiraTestOperations.send_command, 'timeout': 2,
-         'customCommandGenerator': inits_debug.failure_lights_command_generator},
+            {'action': AmiraTestOperations.send_command, 'command': 'ins motor config home', 'timeout': 2},
+            {'action': AmiraTestOperations.send_command, 'command': 'ins motor move', 'timeout': 2},
+            # wait for the motor home movement to complete
+            {'action': AmiraTestOperations.wait_for_event, 'event': AmiraEventCodes.motor_fsm_move_complete,
+             'customEventParser': inits_debug.motor_home_movement_complete_event_parser,
+             'customStepDisplayMessage': 'Waiting for motor home movement to complete ...', 'timeout': 30},
 
-         # wait for user input
-        {'action': AmiraTestOperations.wait_for_user_input,
-         'customStepDisplayMessage': 'Lightly pull the strip. Did the strip have tension when attempting to pull it? y=yes n=no ...',
-         'customUserInputParser': inits_debug.custom_strip_user_input_parser},
+              {'action': AmiraTestOperations.send_command, 'timeout': 2,
+             'customCommandGenerator': inits_debug.failure_lights_command_generator},
 
-         {'action': AmiraTestOperations.send_command, 'timeout': 2,
-         'customCommandGenerator': inits_debug.failure_lights_command_generator},
+             # wait for user input
+            {'action': AmiraTestOperations.wait_for_user_input,
+             'customStepDisplayMessage': 'Lightly pull the strip. Did the strip have tension when attempting to pull it? y=yes n=no ...',
+             'customUserInputParser': inits_debug.custom_strip_user_input_parser},
 
-         {'action': AmiraTestOperations.send_command, 'command': 'ins motor moveto 1740', 'customStepDisplayMessage': 'Waiting for motor away movement to complete ...', 'timeout': 20},
-        #{'action': AmiraTestOperations.send_command, 'command': 'ins motor config decompress', 'timeout': 2},
-        #{'action': AmiraTestOperations.send_command, 'command': 'ins motor move', 'timeout': 2},
-        # wait for the motor away movement to complete
-        #{'action': AmiraTestOperations.wait_for_event, 'event': AmiraEventCodes.motor_fsm_move_complete,
-         #'customEventParser': inits_debug.motor_away_movement_complete_event_parser,
-         #'customStepDisplayMessage': 'Waiting for motor away movement to complete ...', 'timeout': 30},
+             {'action': AmiraTestOperations.send_command, 'timeout': 2,
+             'customCommandGenerator': inits_debug.failure_lights_command_generator},
 
-         {'action': AmiraTestOperations.send_command, 'timeout': 2,
-         'customCommandGenerator': inits_debug.failure_lights_command_generator},
+             {'action': AmiraTestOperations.send_command, 'command': 'ins motor moveto 1740', 'customStepDisplayMessage': 'Waiting for motor away movement to complete ...', 'timeout': 20},
+            #{'action': AmiraTestOperations.send_command, 'command': 'ins motor config decompress', 'timeout': 2},
+            #{'action': AmiraTestOperations.send_command, 'command': 'ins motor move', 'timeout': 2},
+            # wait for the motor away movement to complete
+            #{'action': AmiraTestOperations.wait_for_event, 'event': AmiraEventCodes.motor_fsm_move_complete,
+             #'customEventParser': inits_debug.motor_away_movement_complete_event_parser,
+             #'customStepDisplayMessage': 'Waiting for motor away movement to complete ...', 'timeout': 30},
 
-         # wait for user input
-        {'action': AmiraTestOperations.wait_for_user_input,
-         'customStepDisplayMessage': 'Remove the Strip, Close the door, and Hit enter'},
+             {'action': AmiraTestOperations.send_command, 'timeout': 2,
+             'customCommandGenerator': inits_debug.failure_lights_command_generator},
 
+             # wait for user input
+            {'action': AmiraTestOperations.wait_for_user_input,
+             'customStepDisplayMessage': 'Remove the Strip, Close the door, and Hit enter'},
 
-         #Initilize optics
-         {'action': AmiraTestOperations.send_command, 'command': 'ins optics init', 'timeout': 4, 
-          'customResponseParser': inits_debug.optics_init_response_parser,
-         'customStepDisplayMessage': 'Initializing optics ...'},
 
-         {'action': AmiraTestOperations.send_command, 'timeout': 2,
-         'customCommandGenerator': inits_debug.failure_lights_command_generator},
+             #Initilize optics
+             {'action': AmiraTestOperations.send_command, 'command': 'ins optics init', 'timeout': 4, 
+              'customResponseParser': inits_debug.optics_init_response_parser,
+             'customStepDisplayMessage': 'Initializing optics ...'},
 
-         #Set optics full power
-         #{'action': AmiraTestOperations.send_command, 'command': 'ins optics reg write 22 303F', 'timeout': 4},
-         #{'action': AmiraTestOperations.send_command, 'command': 'ins optics reg write 25 F800', 'timeout': 4},
+             {'action': AmiraTestOperations.send_command, 'timeout': 2,
+             'customCommandGenerator': inits_debug.failure_lights_command_generator},
 
-         {'action': AmiraTestOperations.send_command, 'command': 'ins optics led-current set 3 15 31', 'timeout': 4},
+             #Set optics full power
+             #{'action': AmiraTestOperations.send_command, 'command': 'ins optics reg write 22 303F', 'timeout': 4},
+             #{'action': AmiraTestOperations.send_command, 'command': 'ins optics reg write 25 F800', 'timeout': 4},
 
-         #Take an optics measurement
-         {'action': AmiraTestOperations.send_command, 'command': 'ins optics measure single', 'timeout': 4},
+             {'action': AmiraTestOperations.send_command, 'command': 'ins optics led-current set 3 15 31', 'timeout': 4},
 
-         # wait up to 20 seconds for the measurement
-        # if a measurement is received, call the custom event handler 
-        {'action': AmiraTestOperations.wait_for_event, 'event': AmiraEventCodes.app_fsm_measurement_complete,
-         'customEventParser': inits_debug.custom_measure_single_event_parser, 'timeout': 20,
-         'customStepDisplayMessage': 'Reading measurement ...'},
+             #Take an optics measurement
+             {'action': AmiraTestOperations.send_command, 'command': 'ins optics measure single', 'timeout': 4},
 
-         {'action': AmiraTestOperations.send_command, 'timeout': 2,
-         'customCommandGenerator': inits_debug.failure_lights_command_generator},
+             # wait up to 20 seconds for the measurement
+            # if a measurement is received, call the custom event handler 
+            {'action': AmiraTestOperations.wait_for_event, 'event': AmiraEventCodes.app_fsm_measurement_complete,
+             'customEventParser': inits_debug.custom_measure_single_event_parser, 'timeout': 20,
+             'customStepDisplayMessage': 'Reading measurement ...'},
 
-         #Set optics half power
-         #{'action': AmiraTestOperations.send_command, 'command': 'ins optics reg write 22 3038', 'timeout': 4},
-         #{'action': AmiraTestOperations.send_command, 'command': 'ins optics reg write 25 A000', 'timeout': 4},
+             {'action': AmiraTestOperations.send_command, 'timeout': 2,
+             'customCommandGenerator': inits_debug.failure_lights_command_generator},
 
-         {'action': AmiraTestOperations.send_command, 'command': 'ins optics reg write 22 3034', 'timeout': 4},
+             #Set optics half power
+             #{'action': AmiraTestOperations.send_command, 'command': 'ins optics reg write 22 3038', 'timeout': 4},
+             #{'action': AmiraTestOperations.send_command, 'command': 'ins optics reg write 25 A000', 'timeout': 4},
 
-         #Take an optics measurement at half power
-         {'action': AmiraTestOperations.send_command, 'command': 'ins optics measure single', 'timeout': 4},
+             {'action': AmiraTestOperations.send_command, 'command': 'ins optics reg write 22 3034', 'timeout': 4},
 
-         # if a measurement is received, call the custom event handler 
-        {'action': AmiraTestOperations.wait_for_event, 'event': AmiraEventCodes.app_fsm_measurement_complete,
-         'customEventParser': inits_debug.custom_measure_half_event_parser, 'timeout': 20,
-         'customStepDisplayMessage': 'Reading second measurement ...'},
+             #Take an optics measurement at half power
+             {'action': AmiraTestOperations.send_command, 'command': 'ins optics measure single', 'timeout': 4},
 
-         {'action': AmiraTestOperations.send_command, 'timeout': 2,
-         'customCommandGenerator': inits_debug.failure_lights_command_generator},
+             # if a measurement is received, call the custom event handler 
+            {'action': AmiraTestOperations.wait_for_event, 'event': AmiraEventCodes.app_fsm_measurement_complete,
+             'customEventParser': inits_debug.custom_measure_half_event_parser, 'timeout': 20,
+             'customStepDisplayMessage': 'Reading second measurement ...'},
 
-        #UnInitilize optics
-         {'action': AmiraTestOperations.send_command, 'command': 'ins optics uninit', 'timeout': 4},
+             {'action': AmiraTestOperations.send_command, 'timeout': 2,
+             'customCommandGenerator': inits_debug.failure_lights_command_generator},
 
-         #UnInitilize optics
-         {'action': AmiraTestOperations.send_command, 'command': 'ins fluidics uninit', 'timeout': 4},
+            #UnInitilize optics and fluidics
+            *step_pipelining.pipeline_steps([
+                {'action': AmiraTestOperations.send_command, 'command': 'ins optics uninit', 'timeout': 4},
+                {'action': AmiraTestOperations.send_command, 'command': 'ins fluidics uninit', 'timeout': 4},
+            ], SMOKE_COMMAND_PIPELINING),
 
          
-         # re-enable the application FSM so it will work normally again
-        {'action': AmiraTestOperations.send_command, 'command': 'ins state event clear-bypass-fsm', 'timeout': 2},
-
-        {'action': AmiraTestOperations.send_command, 'command': 'ins pwr 0 1', 'timeout': 2},#Allow LED error lights to turn on
-        {'action': AmiraTestOperations.send_command, 'command': 'ins pwr 1 1', 'timeout': 2},
-
-        {'action': AmiraTestOperations.send_command, 'timeout': 2,
-         'customCommandGenerator': inits_debug.failure_lights_command_generator},
-
-        # send the "cli echo on" command - this command does not generate a JSON formatted response
-        {'action': AmiraTestOperations.send_raw_command, 'command': 'cli echo on'}
-    ]
-
-
+             # re-enable the application FSM so it will work normally again
+            {'action': AmiraTestOperations.send_command, 'command': 'ins state event clear-bypass-fsm', 'timeout': 2},
+
+            #Allow LED error lights to turn on
+            *step_pipelining.pipeline_steps([
+                {'action': AmiraTestOperations.send_command, 'command': 'ins pwr 0 1', 'timeout': 2},
+                {'action': AmiraTestOperations.send_command, 'command': 'ins pwr 1 1', 'timeout': 2},
+            ], SMOKE_COMMAND_PIPELINING),
+
+            {'action': AmiraTestOperations.send_command, 'timeout': 2,
+             'customCommandGenerator': inits_debug.failure_lights_command_generator},
+
+            # send the "cli echo on" command - this command does not generate a JSON formatted response
+            {'action': AmiraTestOperations.send_raw_command, 'command': 'cli echo on'}
+        ]
+
+
+# ask for the unit connected to this computer and create its test - unless the script is loaded as a library by a
+# runner, which sets SMOKE_LIBRARY_IMPORT before the script runs and calls create_unit_test() and
+# build_test_step_list() itself for every unit it tests
+if not globals().get('SMOKE_LIBRARY_IMPORT', False):
+    serial_val = input("Scan in the serial number on the bottom of the device")
+    input("Insert the Amira into the docking station and hit enter")
+    #print(serial_val)
+
+    inits_debug = create_unit_test(serial_val)
+    run_context = inits_debug.run_context
+    atexit.register(inits_debug.close)
+
+    test_step_list = build_test_step_list(inits_debug)
+    if SMOKE_CALLBACK_PROFILE_DIR is not None:
+        callback_profiler = callback_profiling.CallbackProfiler(SMOKE_CALLBACK_PROFILE_DIR)
+        test_step_list = callback_profiler.instrument(test_step_list)
+        callback_profiler.start()
+        atexit.register(callback_profiler.close)
+    if SMOKE_STEP_TRACE_DIR is not None:
+        step_trace = step_timing.StepTimingTrace(lambda: '{0}_{1}'.format(SMOKE_STATION_NAME, run_context.uut))
+        test_step_list = step_trace.instrument(test_step_list)
+        atexit.register(step_trace.save, SMOKE_STEP_TRACE_DIR)
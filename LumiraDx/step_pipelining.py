@@ -0,0 +1,204 @@
+"""
+step_pipelining.py
+
+This module pipelines runs of independent send_command test steps.  The commands of a pipelined group are written to
+the instrument back to back without waiting for each response - all but the last as send_raw_command steps and the
+last as a send_command step that collects the responses of the whole group.  The responses are matched to their
+commands by command string in whatever order they arrive, and the customResponseParser of each original step is
+still called with its own response.  The send_command step ends with the first response it receives, so it's
+followed by short delay steps that keep collecting the remaining responses and take no time once every command has
+been answered.
+
+Only use a group for commands that don't depend on each other's results, and only with firmware that queues CLI
+input while it's executing a command.
+
+@copyright LumiraDx, 2021. All rights reserved. This code is provided on an
+           "AS IS" basis. LumiraDx DISCLAIMS ALL WARRANTIES, TERMS AND
+           CONDITIONS WITH RESPECT TO THE CODE, EXPRESS, IMPLIED, STATUTORY
+           OR OTHERWISE, INCLUDING WARRANTIES, TERMS OR CONDITIONS OF
+           MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NONINFRINGEMENT
+           AND SATISFACTORY QUALITY. TO THE FULL EXTENT ALLOWED BY LAW,
+           LUMIRADX ALSO EXCLUDES ANY LIABILITY, WHETHER BASED IN CONTRACT
+           OR TORT (INCLUDING NEGLIGENCE), FOR INCIDENTAL, CONSEQUENTIAL,
+           INDIRECT, SPECIAL OR PUNITIVE DAMAGES OF ANY KIND, OR FOR LOSS
+           OF REVENUE OR PROFITS, LOSS OF BUSINESS, LOSS OF INFORMATION OR
+           DATA, OR OTHER FINANCIAL LOSS ARISING OUT OF OR IN CONNECTION
+           WITH THE USE OR PERFORMANCE OF THE CODE.
+"""
+
+import logging
+import math
+from typing import List, Optional
+
+from amira_parser import AmiraErrorCodes
+from amira_test_state_machine import AmiraTestOperations
+from twisted.python import log
+
+
+# step keys that can't be carried over to a pipelined group - the group needs a fixed command string to match the
+# responses and it sends its commands itself
+UNSUPPORTED_STEP_KEYS = ('customCommandGenerator', 'customEventParser', 'commandDelay')
+
+# seconds of each delay step that collects the outstanding responses of a group
+PIPELINE_POLL_INTERVAL_S = 1
+
+
+def is_success(error_code: AmiraErrorCodes) -> bool:
+    """
+    This routine checks whether the error code of a response is a success code.
+
+    :param error_code: Error code of the response.
+    :return: True if the command was successful.
+    """
+    return error_code == AmiraErrorCodes.NRF_SUCCESS or error_code == AmiraErrorCodes.NRFX_SUCCESS
+
+
+def command_match_rank(command: str, command_str: str) -> Optional[int]:
+    """
+    This routine ranks how well a response's sub-command string matches a command.
+
+    :param command: Full command string (i.e. 'mfg app-info' or 'ins heater init').
+    :param command_str: Sub-command portion of the command string of the response (i.e. 'app-info').
+    :return: 0 for an exact match, 1 if the command starts with the sub-command, 2 if the sub-command is one of the
+             words of the command or None if the response isn't the response of the command.
+    """
+    sub_command = command.split(' ', 1)[1] if ' ' in command else command
+    if not command_str:
+        return None
+    if sub_command == command_str:
+        return 0
+    if sub_command.startswith(command_str + ' '):
+        return 1
+    if command_str in sub_command.split():
+        return 2
+    return None
+
+
+class PipelinedCommandGroup(object):
+    """
+    This class turns a run of independent send_command test steps into a pipelined group of test steps.
+    """
+
+    def __init__(self, steps: List[dict], name: Optional[str] = None):
+        """
+        Class initializer.
+
+        :param steps: The send_command test steps of the group, in the order the commands are sent.
+        :param name: Name of the group used as the testStepName of its steps and in log messages.
+        """
+        for step in steps:
+            if step.get('action') != AmiraTestOperations.send_command or 'command' not in step:
+                raise ValueError('only send_command steps with a fixed command can be pipelined: {0}'.format(step))
+            unsupported = [key for key in UNSUPPORTED_STEP_KEYS if key in step]
+            if unsupported:
+                raise ValueError('{0} can not be pipelined: {1}'.format(', '.join(unsupported), step['command']))
+        self.steps = steps
+        self.name = name or 'pipelined: ' + ', '.join(step['command'] for step in steps)
+        self.pending = []  # type: List[dict]
+        self.failed = False
+
+    def build_steps(self) -> List[dict]:
+        """
+        This routine builds the test steps of the group.
+
+        :return: List of test steps.
+        """
+        messages = [step['customStepDisplayMessage'] for step in self.steps if 'customStepDisplayMessage' in step]
+        # the commands run concurrently so the group takes as long as its slowest command
+        timeout = max(step.get('timeout', 0) for step in self.steps)
+        group_steps = [{'action': AmiraTestOperations.send_raw_command, 'command': step['command'], 'commandDelay': 0,
+                        'testStepName': self.name} for step in self.steps[:-1]]
+        group_steps.append({'action': AmiraTestOperations.send_command, 'command': self.steps[-1]['command'],
+                            'timeout': timeout, 'customResponseParser': self.response_parser,
+                            'testStepName': self.name})
+        group_steps.extend({'action': AmiraTestOperations.delay, 'customTimeoutGenerator': self.poll_timeout_generator,
+                            'customResponseParser': self.response_parser, 'testStepName': self.name}
+                           for _ in range(max(1, int(math.ceil(timeout / PIPELINE_POLL_INTERVAL_S)))))
+        group_steps[-1]['customOnExitHandler'] = self.group_on_exit
+        group_steps[0]['customOnEntryHandler'] = self.group_on_entry
+        if messages:
+            group_steps[0]['customStepDisplayMessage'] = ' '.join(messages)
+        return group_steps
+
+    def group_on_entry(self, test_step_index: int) -> bool:
+        """
+        This routine is called on the entry into the first step of the group.  It resets the pending commands and
+        calls the customOnEntryHandler of the original steps.
+
+        :param test_step_index: Current test step index of the test sequence.
+        :return: True if this routine and all the original handlers have executed properly, otherwise False.
+        """
+        self.pending = list(self.steps)
+        self.failed = False
+        return all([step['customOnEntryHandler'](test_step_index) for step in self.steps
+                    if 'customOnEntryHandler' in step])
+
+    def response_parser(self, test_step_index: int, response_success: bool, error_code: AmiraErrorCodes,
+                        command_str: str, response_payload: dict) -> bool:
+        """
+        This function is the customResponseParser of the group.  It matches the response to the oldest pending
+        command with the best matching command string and calls the customResponseParser of that command's original step -
+        a step without a parser accepts only success codes.
+
+        :param test_step_index: Index of the currently executing test step.
+        :param response_success: Success of the response parsing.
+        :param error_code: Error code of the response.
+        :param command_str: Sub-command portion of the command string of the response.
+        :param response_payload: JSON formatted response payload.
+        :return: False if the response failed its command's parser, otherwise True.
+        """
+        # the best match wins and commands with the same command string are answered in the order they were sent
+        ranked = [(command_match_rank(step['command'], command_str), index) for index, step in enumerate(self.pending)]
+        ranked = [match for match in ranked if match[0] is not None]
+        if not ranked:
+            log.msg('{0}: ignoring response to {1}'.format(self.name, command_str), logLevel=logging.INFO)
+            return True
+        step = self.pending.pop(min(ranked)[1])
+        if 'customResponseParser' in step:
+            result = step['customResponseParser'](test_step_index, response_success, error_code, command_str,
+                                                  response_payload)
+        else:
+            result = is_success(error_code)
+        if not result:
+            log.msg('{0}: {1} failed with {2}'.format(self.name, step['command'], error_code), logLevel=logging.ERROR)
+            self.failed = True
+        return result
+
+    def poll_timeout_generator(self, _test_step_index: int) -> int:
+        """
+        This routine generates the timeout of a delay step that collects the outstanding responses of the group.
+
+        :param _test_step_index: Current test step index.  Not used by this routine.
+        :return: PIPELINE_POLL_INTERVAL_S while a command hasn't been answered, otherwise 0 to skip the step.
+        """
+        return PIPELINE_POLL_INTERVAL_S if self.pending else 0
+
+    def group_on_exit(self, test_step_index: int) -> bool:
+        """
+        This routine is called on the exit of the last step of the group.  It checks that every command has been
+        answered and calls the customOnExitHandler of the original steps.
+
+        :param test_step_index: Current test step index of the test sequence.
+        :return: True if every command has been answered successfully and all the original handlers have executed
+                 properly, otherwise False which fails the script.
+        """
+        if self.pending:
+            log.msg('{0}: no response to {1}'.format(
+                self.name, ', '.join(step['command'] for step in self.pending)), logLevel=logging.ERROR)
+        handlers_ok = all([step['customOnExitHandler'](test_step_index) for step in self.steps
+                           if 'customOnExitHandler' in step])
+        return handlers_ok and not self.pending and not self.failed
+
+
+def pipeline_steps(steps: List[dict], enabled: bool = True, name: Optional[str] = None) -> List[dict]:
+    """
+    This routine pipelines a run of independent send_command test steps if pipelining is enabled.
+
+    :param steps: The send_command test steps.
+    :param enabled: True to pipeline the steps, False to return them unchanged.
+    :param name: Name of the group.
+    :return: List of test steps.
+    """
+    if not enabled or len(steps) < 2:
+        return list(steps)
+    return PipelinedCommandGroup(steps, name).build_steps()
@@ -0,0 +1,391 @@
+"""
+step_timing.py
+
+This module measures where the cycle time of a unit goes.  StepTimingTrace wraps the callbacks of every step of a
+test_step_list so each step is timed on entry, when its command is sent, when its response is received and on exit,
+keyed by step index and name, and writes the timings of the run to a compact per-run trace file.  The report
+aggregates the traces of many runs into p50/p95 timings per step and renders a Gantt view of a run, which tells the
+fixed delays, operator waits, device round-trips and host callbacks apart.
+
+Make a report with:  python step_timing.py report step_traces/*.csv [--gantt gantt_dir]
+
+@copyright LumiraDx, 2021. All rights reserved. This code is provided on an
+           "AS IS" basis. LumiraDx DISCLAIMS ALL WARRANTIES, TERMS AND
+           CONDITIONS WITH RESPECT TO THE CODE, EXPRESS, IMPLIED, STATUTORY
+           OR OTHERWISE, INCLUDING WARRANTIES, TERMS OR CONDITIONS OF
+           MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NONINFRINGEMENT
+           AND SATISFACTORY QUALITY. TO THE FULL EXTENT ALLOWED BY LAW,
+           LUMIRADX ALSO EXCLUDES ANY LIABILITY, WHETHER BASED IN CONTRACT
+           OR TORT (INCLUDING NEGLIGENCE), FOR INCIDENTAL, CONSEQUENTIAL,
+           INDIRECT, SPECIAL OR PUNITIVE DAMAGES OF ANY KIND, OR FOR LOSS
+           OF REVENUE OR PROFITS, LOSS OF BUSINESS, LOSS OF INFORMATION OR
+           DATA, OR OTHER FINANCIAL LOSS ARISING OUT OF OR IN CONNECTION
+           WITH THE USE OR PERFORMANCE OF THE CODE.
+"""
+
+import argparse
+import csv
+import logging
+import os
+import re
+import sys
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Union
+
+import numpy as np
+from amira_test_state_machine import AmiraTestOperations
+from twisted.python import log
+
+
+# columns of a trace file - the times are seconds since the entry into the first step of the run
+STEP_TRACE_HEADER = ['index', 'visit', 'name', 'action', 'entry', 'sent', 'response', 'exit', 'events']
+
+# actions that send a command
+SEND_ACTIONS = (AmiraTestOperations.send_command, AmiraTestOperations.send_raw_command,
+                AmiraTestOperations.send_repeat_command)
+
+# category of each action in the report and the Gantt view
+STEP_CATEGORIES = {
+    AmiraTestOperations.delay.name: 'fixed delay',
+    AmiraTestOperations.wait_for_user_input.name: 'operator',
+    AmiraTestOperations.wait_for_event.name: 'event wait',
+    AmiraTestOperations.send_command.name: 'command',
+    AmiraTestOperations.send_raw_command.name: 'command',
+    AmiraTestOperations.send_repeat_command.name: 'command',
+}
+CATEGORY_COLORS = {'fixed delay': 'tab:gray', 'operator': 'tab:orange', 'event wait': 'tab:purple',
+                   'command': 'tab:blue', 'other': 'tab:olive'}
+ROUND_TRIP_COLOR = 'tab:cyan'
+
+
+def step_name(step: dict) -> str:
+    """
+    This routine names a test step for the trace - its testStepName, otherwise its command or its action.
+
+    :param step: Test step.
+    :return: Name of the step.
+    """
+    return step.get('testStepName') or step.get('command') or step['action'].name
+
+
+class StepTimingTrace(object):
+    """
+    This class times the steps of one run of a test sequence.  The step callbacks are wrapped, so it works with any
+    engine that calls them: entry and exit are taken from the on entry and on exit handlers, the send time from the
+    command (or command generator) of the step and the response time from the first call of its response parser.  A
+    send_command step without a response parser ends with its response, so its exit time stands in for the response
+    time in the report.
+    """
+
+    def __init__(self, run_id: Union[str, Callable[[], str]] = '', clock: Callable[[], float] = time.perf_counter):
+        """
+        Class initializer.
+
+        :param run_id: Identifier of the run (i.e. the UUT) or a callable that returns it when the trace is saved.
+        :param clock: Time source in seconds.
+        """
+        self.run_id = run_id
+        self.clock = clock
+        self.started = None  # type: Optional[datetime]
+        self.records = []  # type: List[dict]
+        self._start = None  # type: Optional[float]
+        self._current = {}  # type: Dict[int, dict]
+
+    def instrument(self, test_step_list: List[dict]) -> List[dict]:
+        """
+        This routine builds a timed copy of a list of test steps.
+
+        :param test_step_list: List of test steps.
+        :return: List of timed test steps.
+        """
+        return [self._instrument_step(index, step) for index, step in enumerate(test_step_list)]
+
+    def _instrument_step(self, index: int, step: dict) -> dict:
+        """
+        This routine builds the timed copy of one test step.
+
+        :param index: Index of the step in the list.
+        :param step: Test step.
+        :return: Timed test step.
+        """
+        timed = dict(step)
+        on_entry = step.get('customOnEntryHandler')
+        on_exit = step.get('customOnExitHandler')
+
+        def timed_on_entry(test_step_index: int) -> bool:
+            self._enter(index, step)
+            return on_entry(test_step_index) if on_entry is not None else True
+
+        def timed_on_exit(test_step_index: int) -> bool:
+            result = on_exit(test_step_index) if on_exit is not None else True
+            self._mark(index, 'exit')
+            return result
+
+        timed['customOnEntryHandler'] = timed_on_entry
+        timed['customOnExitHandler'] = timed_on_exit
+
+        if step['action'] in SEND_ACTIONS:
+            command_generator = step.get('customCommandGenerator')
+            command = timed.pop('command', None)
+
+            def timed_command_generator(test_step_index: int) -> str:
+                generated = command_generator(test_step_index) if command_generator is not None else command
+                self._mark(index, 'sent')
+                return generated
+
+            timed['customCommandGenerator'] = timed_command_generator
+
+        if 'customResponseParser' in step:
+            response_parser = step['customResponseParser']
+
+            def timed_response_parser(test_step_index: int, response_success: bool, error_code, command_str: str,
+                                      response_payload: dict) -> bool:
+                self._mark(index, 'response', first_only=True)
+                return response_parser(test_step_index, response_success, error_code, command_str,
+                                       response_payload)
+
+            timed['customResponseParser'] = timed_response_parser
+
+        if 'customEventParser' in step:
+            event_parser = step['customEventParser']
+
+            def timed_event_parser(test_step_index: int, event_code, time_of_day: int, time_str: str,
+                                   rtc_ticks: int, event_payload: dict):
+                record = self._current.get(index)
+                if record is not None:
+                    record['events'] += 1
+                return event_parser(test_step_index, event_code, time_of_day, time_str, rtc_ticks, event_payload)
+
+            timed['customEventParser'] = timed_event_parser
+        return timed
+
+    def _enter(self, index: int, step: dict) -> None:
+        """
+        This routine starts the record of a visit of a step.
+
+        :param index: Index of the step.
+        :param step: Test step.
+        :return: None
+        """
+        now = self.clock()
+        if self._start is None:
+            self._start = now
+            self.started = datetime.today()
+        visit = sum(1 for record in self.records if record['index'] == index)
+        record = {'index': index, 'visit': visit, 'name': step_name(step), 'action': step['action'].name,
+                  'entry': now - self._start, 'sent': None, 'response': None, 'exit': None, 'events': 0}
+        self.records.append(record)
+        self._current[index] = record
+
+    def _mark(self, index: int, key: str, first_only: bool = False) -> None:
+        """
+        This routine records the time of an event of the current visit of a step.
+
+        :param index: Index of the step.
+        :param key: 'sent', 'response' or 'exit'.
+        :param first_only: True to keep the time of the first occurrence.
+        :return: None
+        """
+        record = self._current.get(index)
+        if record is None or (first_only and record[key] is not None):
+            return
+        record[key] = self.clock() - self._start
+
+    def save(self, trace_dir: str) -> Optional[str]:
+        """
+        This routine writes the trace of the run to a file in the trace directory.
+
+        :param trace_dir: Directory of the trace files.
+        :return: Name of the trace file or None if no step has been executed.
+        """
+        if not self.records:
+            return None
+        run_id = self.run_id() if callable(self.run_id) else self.run_id
+        filename = '{0}_{1}.csv'.format(re.sub(r'[^\w.-]+', '_', str(run_id)) or 'run',
+                                        self.started.strftime('%Y-%m-%d_%H-%M-%S'))
+        os.makedirs(trace_dir, exist_ok=True)
+        trace_filename = os.path.join(trace_dir, filename)
+        self.write(trace_filename)
+        log.msg('step timing: trace saved to {0}'.format(trace_filename), logLevel=logging.INFO)
+        return trace_filename
+
+    def write(self, trace_filename: str) -> None:
+        """
+        This routine writes the trace of the run to a file.
+
+        :param trace_filename: Name of the trace file.
+        :return: None
+        """
+        with open(trace_filename, 'w', newline='') as trace_file:
+            writer = csv.writer(trace_file)
+            writer.writerow(STEP_TRACE_HEADER)
+            for record in self.records:
+                writer.writerow(['' if record[key] is None else
+                                 '{0:.4f}'.format(record[key]) if isinstance(record[key], float) else record[key]
+                                 for key in STEP_TRACE_HEADER])
+
+
+def read_trace(trace_filename: str) -> List[dict]:
+    """
+    This routine reads a trace file.
+
+    :param trace_filename: Name of the trace file.
+    :return: List of the step visits of the run with the times as floats (None if not recorded).
+    """
+    with open(trace_filename, newline='') as trace_file:
+        records = list(csv.DictReader(trace_file))
+    for record in records:
+        record['index'] = int(record['index'])
+        record['visit'] = int(record['visit'])
+        record['events'] = int(record['events'])
+        for key in ('entry', 'sent', 'response', 'exit'):
+            record[key] = float(record[key]) if record[key] else None
+    return records
+
+
+def phase_durations(record: dict) -> Dict[str, Optional[float]]:
+    """
+    This routine splits a step visit into its phases.
+
+    :param record: Step visit of a trace.
+    :return: Dictionary with the 'total', 'host' (entry to command sent), 'device' (command sent to response) and
+             'after' (response to exit) durations in seconds - None for the phases the step doesn't have.
+    """
+    if record['exit'] is None:
+        return {'total': None, 'host': None, 'device': None, 'after': None}
+    response = record['response']
+    if response is None and record['sent'] is not None and record['action'] == AmiraTestOperations.send_command.name:
+        response = record['exit']
+    return {'total': record['exit'] - record['entry'],
+            'host': None if record['sent'] is None else record['sent'] - record['entry'],
+            'device': None if record['sent'] is None or response is None else response - record['sent'],
+            'after': None if response is None else record['exit'] - response}
+
+
+def summarize(traces: List[List[dict]]) -> List[dict]:
+    """
+    This routine aggregates the step timings of many runs.
+
+    :param traces: Traces of the runs (see read_trace()).
+    :return: List with the p50/p95 durations of each phase per step (index, name), sorted by the median total time
+             the step adds to a run, longest first.
+    """
+    phases = {}  # type: Dict[tuple, Dict[str, List[float]]]
+    totals_per_run = {}  # type: Dict[tuple, List[float]]
+    for trace in traces:
+        run_totals = {}
+        for record in trace:
+            key = (record['index'], record['name'], record['action'])
+            durations = phases.setdefault(key, {'total': [], 'host': [], 'device': [], 'after': []})
+            for phase, duration in phase_durations(record).items():
+                if duration is not None:
+                    durations[phase].append(duration)
+                    if phase == 'total':
+                        run_totals[key] = run_totals.get(key, 0.0) + duration
+        for key, total in run_totals.items():
+            totals_per_run.setdefault(key, []).append(total)
+
+    summary = []
+    for (index, name, action), durations in phases.items():
+        row = {'index': index, 'name': name, 'action': action, 'category': STEP_CATEGORIES.get(action, 'other'),
+               'runs': len(totals_per_run.get((index, name, action), [])),
+               'per_run_p50': float(np.median(totals_per_run[(index, name, action)]))
+               if (index, name, action) in totals_per_run else 0.0}
+        for phase, values in durations.items():
+            row['{0}_p50'.format(phase)] = float(np.percentile(values, 50)) if values else None
+            row['{0}_p95'.format(phase)] = float(np.percentile(values, 95)) if values else None
+        summary.append(row)
+    summary.sort(key=lambda row: row['per_run_p50'], reverse=True)
+    return summary
+
+
+def format_summary(summary: List[dict], top: Optional[int] = None) -> str:
+    """
+    This routine formats the step summary as a table.
+
+    :param summary: Step summary (see summarize()).
+    :param top: Number of steps to include or None for all of them.
+    :return: Table text.
+    """
+    def seconds(value: Optional[float]) -> str:
+        return '-' if value is None else '{0:.3f}'.format(value)
+
+    lines = ['{0:>5} {1:<40} {2:<12} {3:>5} {4:>9} {5:>9} {6:>9} {7:>9} {8:>9}'.format(
+        'step', 'name', 'category', 'runs', 'run p50', 'p50', 'p95', 'host p50', 'dev p50')]
+    for row in summary[:top]:
+        lines.append('{0:>5} {1:<40} {2:<12} {3:>5} {4:>9} {5:>9} {6:>9} {7:>9} {8:>9}'.format(
+            row['index'], row['name'][:40], row['category'], row['runs'], seconds(row['per_run_p50']),
+            seconds(row['total_p50']), seconds(row['total_p95']), seconds(row['host_p50']),
+            seconds(row['device_p50'])))
+    return '\n'.join(lines)
+
+
+def render_gantt(trace: List[dict], png_filename: str, title: str = '') -> None:
+    """
+    This routine renders the Gantt view of one run - one row per step visit in execution order, colored by step
+    category, with the device round-trip of the command steps overlaid.
+
+    :param trace: Trace of the run (see read_trace()).
+    :param png_filename: Name of the .png file.
+    :param title: Title of the chart.
+    :return: None
+    """
+    # imported here so the trace collection in the test scripts doesn't load matplotlib
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from matplotlib.patches import Patch
+
+    visits = [record for record in trace if record['exit'] is not None]
+    figure, axes = plt.subplots(figsize=(12, max(3.0, 0.18 * len(visits) + 1)))
+    try:
+        for row, record in enumerate(visits):
+            category = STEP_CATEGORIES.get(record['action'], 'other')
+            axes.barh(row, record['exit'] - record['entry'], left=record['entry'], height=0.8,
+                      color=CATEGORY_COLORS[category])
+            durations = phase_durations(record)
+            if durations['device'] is not None:
+                axes.barh(row, durations['device'], left=record['sent'], height=0.4, color=ROUND_TRIP_COLOR)
+        axes.set_yticks(range(len(visits)))
+        axes.set_yticklabels(['{0} {1}'.format(record['index'], record['name'][:30]) for record in visits],
+                             fontsize=6)
+        axes.invert_yaxis()
+        axes.set_xlabel('seconds')
+        axes.set_title(title)
+        axes.legend(handles=[Patch(color=color, label=category) for category, color in CATEGORY_COLORS.items()] +
+                    [Patch(color=ROUND_TRIP_COLOR, label='device round-trip')], loc='lower right', fontsize=7)
+        figure.tight_layout()
+        figure.savefig(png_filename)
+    finally:
+        plt.close(figure)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """
+    This routine is the command line entry point - prints the per-step report of a set of traces and renders their
+    Gantt views.
+
+    :param argv: Command line arguments - defaults to sys.argv.
+    :return: Process exit code.
+    """
+    parser = argparse.ArgumentParser(description='Report the step timings of test sequence runs.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    report_parser = subparsers.add_parser('report', help='p50/p95 per step across runs')
+    report_parser.add_argument('traces', nargs='+', help='trace files')
+    report_parser.add_argument('--top', type=int, default=None, help='only show the steps that take longest')
+    report_parser.add_argument('--gantt', metavar='DIR', help='render the Gantt view of each run into DIR')
+    args = parser.parse_args(argv)
+
+    traces = [read_trace(trace_filename) for trace_filename in args.traces]
+    print(format_summary(summarize(traces), args.top))
+    if args.gantt:
+        os.makedirs(args.gantt, exist_ok=True)
+        for trace_filename, trace in zip(args.traces, traces):
+            name = os.path.splitext(os.path.basename(trace_filename))[0]
+            render_gantt(trace, os.path.join(args.gantt, '{0}.png'.format(name)), name)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())